@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import collections
+import json
+
+# Bulk upserts of documents with deterministic IDs into one CouchDb
+# database.
+#
+# Only the latest revision of each document is kept, in a bounded LRU map.
+# Revisions missing from the map are fetched for a whole batch at once from
+# _all_docs, and documents rejected with a conflict (409) are retried with a
+# fresh revision. Documents that have to be merged with what is stored,
+# rather than replace it, are saved with a 'merge' function instead.
+#
+# 'database' may be a pycouchdb Database, or any stand-in providing its
+# resource.post(path, data=..., params=...) => (response, result).
+class SftpCdbBulkStore:
+
+    REV_CACHE_SIZE      = 100000
+    CONFLICT_RETRIES    = 3
+    SCAN_PAGE_SIZE      = 10000
+
+    def __init__(self, database, revCacheSize=REV_CACHE_SIZE):
+        self.database_      = database
+        self.rev_cache_size_= revCacheSize
+        self.revs_          = collections.OrderedDict()
+
+        self.fetch_cnt_     = 0
+        self.conflict_cnt_  = 0
+
+    def _post(self, path, body, params=None):
+        response, result = self.database_.resource.post(
+            path, data=json.dumps(body).encode("utf-8"), params=params)
+        return result
+
+    def _remember(self, docId, rev):
+        self.revs_[docId] = rev
+        self.revs_.move_to_end(docId)
+        if len(self.revs_) > self.rev_cache_size_:
+            self.revs_.popitem(last=False)
+
+    def forget(self, docId):
+        self.revs_.pop(docId, None)
+
+    # Look up the stored documents (or, without 'includeDocs', only their
+    # revisions) of 'docIds'; deleted and unknown documents are left out.
+    def _fetch(self, docIds, includeDocs):
+        found = {}
+        if len(docIds) == 0:
+            return found
+
+        self.fetch_cnt_ += 1
+        result = self._post("_all_docs", {"keys": docIds},
+            {"include_docs": "true"} if includeDocs else None)
+
+        for row in result["rows"]:
+            value = row.get("value")
+            if not value or value.get("deleted"):
+                continue
+
+            self._remember(row["id"], value["rev"])
+            found[row["id"]] = row["doc"] if includeDocs else value["rev"]
+
+        return found
+
+    # Return the 'fields' of every stored document, read from _find in pages
+    # of 'pageSize' documents
+    def scan(self, fields, pageSize=SCAN_PAGE_SIZE):
+        docs = []
+        query = {"selector": {"_id": {"$gt": None}}, "fields": fields,
+                 "limit": pageSize}
+        while True:
+            self.fetch_cnt_ += 1
+            result = self._post("_find", query)
+            docs.extend(result["docs"])
+            if len(result["docs"]) < pageSize:
+                return docs
+            query["bookmark"] = result["bookmark"]
+
+    # Return the documents of 'docs' (ID => document) as they are to be
+    # saved: stamped with their current revision, or merged with the stored
+    # document by 'merge(stored, doc)', where 'stored' may be None.
+    def _prepare(self, docs, merge):
+        if merge:
+            stored = self._fetch(list(docs), True)
+            return [merge(stored.get(docId), doc) for docId, doc in docs.items()]
+
+        self._fetch([docId for docId in docs if docId not in self.revs_], False)
+
+        prepared = []
+        for docId, doc in docs.items():
+            if docId in self.revs_:
+                doc["_rev"] = self.revs_[docId]
+                self.revs_.move_to_end(docId)
+            else:
+                doc.pop("_rev", None)
+            prepared.append(doc)
+        return prepared
+
+    # Save 'docs', each of which must have its "_id" set
+    def save(self, docs, merge=None):
+        pending = {doc["_id"]: doc for doc in docs}
+        failed  = []
+
+        for attempt in range(SftpCdbBulkStore.CONFLICT_RETRIES + 1):
+            results = self._post("_bulk_docs", {"docs": self._prepare(pending, merge)})
+
+            conflicts = {}
+            for result in results:
+                docId = result["id"]
+                if "error" not in result:
+                    self._remember(docId, result["rev"])
+                elif result["error"] == "conflict":
+                    conflicts[docId] = pending[docId]
+                    self.forget(docId)
+                else:
+                    failed.append("{0}: {1}".format(docId, result["error"]))
+
+            if len(conflicts) == 0:
+                break
+
+            self.conflict_cnt_ += len(conflicts)
+            pending = conflicts
+        else:
+            failed.extend("{0}: conflict".format(docId) for docId in pending)
+
+        if len(failed) > 0:
+            raise RuntimeError("{0} of {1} documents not saved ({2}{3})".format(
+                len(failed), len(docs), ", ".join(failed[:3]),
+                ", ..." if len(failed) > 3 else ""))
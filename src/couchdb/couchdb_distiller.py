@@ -3,31 +3,164 @@
 import pycouchdb
 import json
 import logging
-
-class SftpLogCdbDistiller :
-
-    BATCH_SIZE = 1000
-
-    def __init__(self, connStr) :
+import time
+
+from couchdb.couchdb_bulk    import SftpCdbBulkStore
+from sftp.sftp_session       import SftpSession
+from sftp.sftp_log_distiller import SftpLogBatchDistiller
+from sftp.sftp_log_writer    import SftpLogBatch
+from sftp.sftp_log_writer    import SftpLogCoalescer
+from sftp.sftp_log_writer    import SftpLogWriter
+
+# Documents are saved with deterministic IDs: the account name for
+# accounts, and the session key for sessions. Accounts are merged with the
+# stored document when saved, so only their new sessions are held. Once a
+# session has been saved, only its header is cached; its later commands
+# are saved as a tail document, which is merged with the stored one rather
+# than replacing it, as is a session the parser carried on after evicting
+# it, which arrives without its earlier commands.
+class SftpLogCdbDistiller(SftpLogBatchDistiller) :
+
+    # Batches are flushed at BATCH_SIZE distinct documents, about BATCH_BYTES
+    # of documents, or BATCH_SECS after their first update
+    BATCH_SIZE  = SftpLogBatch.MAX_DOCS
+    BATCH_BYTES = SftpLogBatch.MAX_BYTES
+    BATCH_SECS  = SftpLogBatch.MAX_SECS
+
+    # Batches are saved by an SftpLogWriter thread, with up to 'maxInFlight'
+    # of them pending while parsing continues; 0 saves each batch inline.
+    def __init__(self, connStr, maxInFlight=SftpLogWriter.MAX_IN_FLIGHT,
+                 batchSize=BATCH_SIZE, batchBytes=BATCH_BYTES,
+                 batchSecs=BATCH_SECS, coalesce=False,
+                 checkpointSecs=SftpLogCoalescer.CHECKPOINT_SECS) :
+
+        SftpLogBatchDistiller.__init__(self, batchSize, batchBytes, batchSecs,
+            coalesce, checkpointSecs)
 
         self.conn_str_          = connStr
         self.cdb_server_        = None
         self.cdb_account_db_    = None
         self.cdb_session_db_    = None
+        self.max_in_flight_     = maxInFlight
+
+        # Bulk stores, holding the revisions of saved documents; only used by
+        # the writer, so that a batch still in flight can't leave a later one
+        # with a stale revision.
+        self.account_store_     = None
+        self.session_store_     = None
 
-        self.account_cache_     = {}
-        self.account_batch_     = set()
-        self.account_batch_cnt_ = 0
+        # Account names, and the sessions added to each account since it was
+        # last saved (as an ordered set)
+        self.account_names_     = {}
+        self.account_pending_   = {}
 
-        self.session_cache_     = {}
-        self.session_batch_     = set()
-        self.session_batch_cnt_ = 0
+        # Sessions whose cached document holds only their later commands
+        self.session_tails_     = set()
 
-    def connect(self, acctDb, sessDb):
-        self.cdb_server_ = pycouchdb.Server(self.conn_str_)
+    ACCOUNT_DB  = "sftp_accounts"
+    SESSION_DB  = "sftp_sessions"
+
+    # 'server' may be given in place of a pycouchdb Server, e.g. a local
+    # stand-in for testing; see SftpCdbBulkStore.
+    def connect(self, acctDb=ACCOUNT_DB, sessDb=SESSION_DB, server=None):
+        self.cdb_server_ = server if server else pycouchdb.Server(self.conn_str_)
         self.cdb_account_db_ = self.cdb_server_.database(acctDb)
         self.cdb_session_db_ = self.cdb_server_.database(sessDb)
 
+        self.account_store_ = SftpCdbBulkStore(self.cdb_account_db_)
+        self.session_store_ = SftpCdbBulkStore(self.cdb_session_db_)
+
+        self.writers_.append(SftpLogWriter(self.max_in_flight_))
+
+    # Return all saved accounts, as account name => ID; design documents and
+    # others without an account are skipped
+    def load_accounts(self):
+        idMap = {}
+        for doc in self.account_store_.scan(["accountName", "accountId"]):
+            if "accountName" in doc and "accountId" in doc:
+                idMap[doc["accountName"]] = doc["accountId"]
+        return idMap
+
+    # Add an account's new sessions to those already stored
+    @classmethod
+    def _mergeAccount(classobj, stored, account):
+        if stored is None:
+            return account
+
+        sessions = dict.fromkeys(stored.get("sessions", []))
+        sessions.update(dict.fromkeys(account["sessions"]))
+
+        stored["accountName"] = account["accountName"]
+        stored["accountId"]   = account["accountId"]
+        stored["sessions"]    = list(sessions)
+        return stored
+
+    # Runs on the writer thread
+    def _saveAccounts(self, acctDocs):
+        self.account_store_.save(acctDocs, SftpLogCdbDistiller._mergeAccount)
+
+    # Add the commands of a session document holding only the later ones to
+    # the stored document
+    @classmethod
+    def _mergeSession(classobj, stored, session):
+        if stored is None:
+            return session
+        return SftpSession.mergeJSON(stored, session)
+
+    # Runs on the writer thread. Revisions of final sessions are dropped
+    # once saved.
+    def _saveSessions(self, sessDocs, tailDocs, finalIds, batchBytes, batchStart):
+        startTime = time.perf_counter()
+        waitSecs  = time.monotonic() - batchStart
+
+        if sessDocs:
+            self.session_store_.save(sessDocs)
+        if tailDocs:
+            self.session_store_.save(tailDocs, SftpLogCdbDistiller._mergeSession)
+
+        for sid in finalIds:
+            self.session_store_.forget(sid)
+
+        self.flush_stats_.add(len(sessDocs) + len(tailDocs), batchBytes,
+            waitSecs, time.perf_counter() - startTime)
+
+    def _flushAccounts(self):
+        if len(self.account_batch_) == 0:
+            return
+
+        acctDocs = []
+        for aid in self.account_batch_:
+            acctDocs.append({
+                "_id"           : self.account_names_[aid],
+                "accountName"   : self.account_names_[aid],
+                "accountId"     : aid,
+                "sessions"      : list(self.account_pending_.pop(aid, ()))})
+
+        self.account_batch_.clear()
+
+        self.writers_[0].submit(self._saveAccounts, acctDocs)
+
+    # Sessions still open keep only their header cached, so their later
+    # commands make tail documents
+    def _submitSessions(self, sessDocs, finalIds, batchBytes, batchStart):
+        fullDocs = []
+        tailDocs = []
+        for session in sessDocs:
+            sid = session["sessionId"]
+            session["_id"] = sid
+            if sid in self.session_tails_:
+                tailDocs.append(session)
+            else:
+                fullDocs.append(session)
+
+            if sid in finalIds:
+                self.session_tails_.discard(sid)
+            else:
+                self.session_tails_.add(sid)
+
+        self.writers_[0].submit(self._saveSessions,
+            fullDocs, tailDocs, finalIds, batchBytes, batchStart)
+
     # Process a JSON document 'account' with the specified 'state', either:
     #   'N' => new
     #   'X' => existing
@@ -35,105 +168,50 @@ class SftpLogCdbDistiller :
         try:
             #doc = self.cdb_account_db_.save(account)
 
-            # Preserve CouchDb metadata when updating existing accounts
-            if state == 'X' and acctId in self.account_cache_:
-                currAcct = self.account_cache_[acctId]
-                if "_id" in currAcct:
-                    account["_id"] = currAcct["_id"]
-                if "_rev" in currAcct:
-                    account["_rev"] = currAcct["_rev"]
-
-            self.account_cache_[acctId] = account
-
-            self.account_batch_.add(acctId)
-            self.account_batch_cnt_ += 1
-
-            if self.account_batch_cnt_ == SftpLogCdbDistiller.BATCH_SIZE:
-
-                acctDocs = []
-                for aid in self.account_batch_:
-                    acctDocs.append(self.account_cache_[aid])
+            self.account_names_[acctId] = account["accountName"]
+            pending = self.account_pending_.setdefault(acctId, {})
+            pending.update(dict.fromkeys(account["sessions"]))
 
-                results = self.cdb_account_db_.save_bulk(acctDocs)
+            self.account_batch_.add(acctId, SftpLogBatch.DOC_BYTES)
 
-                for doc in results:
-                    aid = doc["accountId"]
-                    self.account_cache_[aid]["_id"]  = doc["_id"]
-                    self.account_cache_[aid]["_rev"] = doc["_rev"]
-                
-                self.account_batch_.clear()
-                self.account_batch_cnt_ = 0
+            if self.account_batch_.isFull():
+                self._flushAccounts()
 
         except Exception as err:
             print("Error in SftpLogCdbDistiller::process_account : {0}".format(err))
 
-    # Process a JSON document 'session' with the specified 'state', either:
-    #   'N' => new
-    #   'X' => existing
-    def process_session(self, sessId, session, state):
-        try:
-
-            if state == 'N':
-                # get account ID and update account with new session
-                acctId = 0
-                if "accountId" in session and isinstance(session["accountId"], int):
-                    acctId = session["accountId"]
-
-                    if acctId in self.account_cache_:
-                        account = self.account_cache_[acctId]
-                        account["sessions"].append(sessId)
-                        self.process_account(acctId, account, "X")
-            
-            if sessId in self.session_cache_:
-                # Preserve CouchDb metadata when updating existing accounts
-                currSession = self.session_cache_[sessId]
-                if "_id" in currSession:
-                    session["_id"]  = currSession["_id"]
-                if "_rev" in currSession:
-                    session["_rev"] = currSession["_rev"]
-            self.session_cache_[sessId] = session
-
-            # Append the session update to 
-            self.session_batch_.add(sessId)
-            self.session_batch_cnt_ += 1
-
-            if self.session_batch_cnt_ == SftpLogCdbDistiller.BATCH_SIZE:
-
-                sessDocs = []
-                for sid in self.session_batch_:
-                    sessDocs.append(self.session_cache_[sid])
-
-                results = self.cdb_session_db_.save_bulk(sessDocs)
-
-                for doc in results:
-                    sid = doc["sessionId"]
-                    self.session_cache_[sid]["_id"] = doc["_id"]
-                    self.session_cache_[sid]["_rev"] = doc["_rev"]
-                
-                self.session_batch_.clear()
-                self.session_batch_cnt_ = 0
-
-        except Exception as err:
-            print("Error in SftpLogCdbDistiller::process_session : {0}".format(err))
-
+    # Link each new session to its account, which is saved with it; the
+    # account's sessions are a set, so adding it again is harmless. A session
+    # whose first command isn't its first holds only the later ones.
+    def _addSession(self, sessId, session):
+        acctId = session.get("accountId")
+        if isinstance(acctId, int) and acctId in self.account_names_:
+            account = {
+                "accountName"   : self.account_names_[acctId],
+                "accountId"     : acctId,
+                "sessions"      : [sessId]}
+            self.process_account(acctId, account, "X")
+
+        if session["commands"] and session["commands"][0]["sequenceId"] > 0:
+            self.session_tails_.add(sessId)
 
     def cleanup(self):
-        # Process any pending updates in the batch lists
-        acctDocs = []
-        for aid in self.account_batch_:
-            acctDocs.append(self.account_cache_[aid])
+        errorCnt = self._closeWriters()
 
-        results = self.cdb_account_db_.save_bulk(acctDocs)
         self.cdb_account_db_.cleanup()
         self.cdb_account_db_ = None
 
-        sessDocs = []
-        for sid in self.session_batch_:
-            sessDocs.append(self.session_cache_[sid])
-
-        results = self.cdb_session_db_.save_bulk(sessDocs)
         self.cdb_session_db_.cleanup()
         self.cdb_session_db_ = None
 
         self.cdb_server_ = None
-          
+
+        print("SftpLogCdbDistiller revision lookups : {0}, conflicts retried : {1}".format(
+            self.account_store_.fetch_cnt_ + self.session_store_.fetch_cnt_,
+            self.account_store_.conflict_cnt_ + self.session_store_.conflict_cnt_))
+
+        # Batches that failed for good were reported as they failed; don't
+        # let the run pass for a complete one.
+        if errorCnt > 0:
+            raise RuntimeError(
+                "{0} batches could not be saved".format(errorCnt))
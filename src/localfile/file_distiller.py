@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+
+import json
+import os
+import os.path
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from sftp.sftp_session       import SftpSession
+from sftp.sftp_log_distiller import SftpLogDistiller
+from sftp.sftp_log_writer    import SftpLogCoalescer
+
+# Write accounts and sessions as newline-delimited JSON, one document per
+# line, to accounts.ndjson and sessions.ndjson. Sessions keep their commands
+# inline, as they are sent to the database.
+class SftpNdjsonWriter:
+
+    EXTENSION = "ndjson"
+
+    # With 'append' set, lines are added to existing files
+    def __init__(self, outDir, bufferBytes, append=False):
+        mode = "a" if append else "w"
+        self.encoder_       = json.JSONEncoder(
+            separators=(",", ":"), check_circular=False)
+        self.account_file_  = open(os.path.join(outDir, "accounts.ndjson"),
+            mode, encoding="utf-8", buffering=bufferBytes)
+        self.session_file_  = open(os.path.join(outDir, "sessions.ndjson"),
+            mode, encoding="utf-8", buffering=bufferBytes)
+
+    def writeAccount(self, account):
+        self.account_file_.write(self.encoder_.encode(account))
+        self.account_file_.write("\n")
+
+    def writeSession(self, session):
+        self.session_file_.write(self.encoder_.encode(session))
+        self.session_file_.write("\n")
+
+    def poll(self):
+        self.account_file_.flush()
+        self.session_file_.flush()
+
+    # Make everything written so far durable
+    def flush(self):
+        for fhandle in (self.account_file_, self.session_file_,):
+            fhandle.flush()
+            os.fsync(fhandle.fileno())
+
+    def close(self):
+        self.account_file_.close()
+        self.session_file_.close()
+
+# Write accounts, sessions and commands as three Parquet tables, with one row
+# per account, session update and command update. Rows are buffered and
+# written a row group at a time. Requires pyarrow. A Parquet file is only
+# readable once closed, so it can't be appended to or checkpointed.
+class SftpParquetWriter:
+
+    EXTENSION       = "parquet"
+    ROW_GROUP_ROWS  = 100000
+
+    def __init__(self, outDir, bufferBytes, append=False):
+        if pyarrow is None:
+            raise RuntimeError("Parquet output requires the pyarrow package")
+        if append:
+            raise RuntimeError("Parquet output can't be appended to")
+
+        self.tables_ = {}
+        self._addTable(outDir, "accounts", [
+            ("accountId",   pyarrow.int64()),
+            ("accountName", pyarrow.string())])
+        self._addTable(outDir, "sessions", [
+            ("sessionId",   pyarrow.string()),
+            ("accountId",   pyarrow.int64()),
+            ("sessionDate", pyarrow.int32()),
+            ("pid",         pyarrow.int64()),
+            ("startTime",   pyarrow.int64()),
+            ("endTime",     pyarrow.int64()),
+            ("ipAddress",   pyarrow.int64())])
+        self._addTable(outDir, "commands", [
+            ("sessionId",   pyarrow.string()),
+            ("sequenceId",  pyarrow.int32()),
+            ("type",        pyarrow.int8()),
+            ("timeOffset",  pyarrow.int64()),
+            ("target",      pyarrow.string()),
+            ("source",      pyarrow.string()),
+            ("status",      pyarrow.int8())])
+
+    # Each table is kept as [schema, ParquetWriter, column name => values]
+    def _addTable(self, outDir, name, fields):
+        schema = pyarrow.schema(fields)
+        writer = pyarrow.parquet.ParquetWriter(
+            os.path.join(outDir, name + ".parquet"), schema)
+        self.tables_[name] = [schema, writer, {f[0]: [] for f in fields}]
+
+    def _appendRow(self, name, doc):
+        schema, writer, columns = self.tables_[name]
+        for key, values in columns.items():
+            values.append(doc[key])
+
+        if len(values) >= SftpParquetWriter.ROW_GROUP_ROWS:
+            self._writeRowGroup(name)
+
+    def _writeRowGroup(self, name):
+        schema, writer, columns = self.tables_[name]
+        if len(next(iter(columns.values()))) == 0:
+            return
+
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+        for values in columns.values():
+            values.clear()
+
+    def writeAccount(self, account):
+        self._appendRow("accounts", account)
+
+    # Session PIDs are sent as strings; they are stored as integers, as the
+    # database does
+    def writeSession(self, session):
+        self._appendRow("sessions", dict(session, pid=int(session["pid"])))
+
+        sessId = session["sessionId"]
+        for cmd in session["commands"]:
+            cmd["sessionId"] = sessId
+            self._appendRow("commands", cmd)
+
+    def poll(self):
+        pass
+
+    def flush(self):
+        raise RuntimeError("Parquet output can't be checkpointed")
+
+    def close(self):
+        for name, table in self.tables_.items():
+            self._writeRowGroup(name)
+            table[1].close()
+
+# A distiller that writes to local files rather than a database, for offline
+# ingestion and for bulk loading later on.
+#
+# Each session update is written as it arrives, as the delta it was sent as;
+# to rebuild a session, merge its records in order by sessionId and command
+# sequenceId, as the database upserts do. With 'coalesce' set, updates are
+# merged in memory and each session is written once it is final (or at a
+# checkpoint, if it stays open for long). Each account is written once, when
+# first seen; its sessions are those with its accountId.
+#
+# With 'append' set, as when resuming from a checkpoint, output is added to
+# existing files. Records written after the last checkpoint are written
+# again on resuming, which merging them makes harmless.
+class SftpLogFileDistiller(SftpLogDistiller):
+
+    FORMATS         = {
+        SftpNdjsonWriter.EXTENSION  : SftpNdjsonWriter,
+        SftpParquetWriter.EXTENSION : SftpParquetWriter}
+
+    BUFFER_BYTES    = 1024 * 1024
+
+    def __init__(self, outDir, outFormat=SftpNdjsonWriter.EXTENSION,
+                 coalesce=False,
+                 checkpointSecs=SftpLogCoalescer.CHECKPOINT_SECS,
+                 bufferBytes=BUFFER_BYTES, append=False):
+
+        if outFormat not in SftpLogFileDistiller.FORMATS:
+            raise ValueError("Unknown output format '{0}'".format(outFormat))
+
+        self.out_dir_           = outDir
+        self.out_format_        = outFormat
+        self.buffer_bytes_      = bufferBytes
+        self.append_            = append
+        self.writer_            = None
+
+        self.account_ids_       = set()
+
+        # Sessions held back while coalescing, merged from their updates
+        self.session_cache_     = {}
+        self.coalescer_         = None
+        if coalesce:
+            self.coalescer_     = SftpLogCoalescer(checkpointSecs)
+
+        self.account_cnt_       = 0
+        self.session_cnt_       = 0
+        self.command_cnt_       = 0
+        self.error_cnt_         = 0
+        self.start_time_        = 0
+
+    def connect(self):
+        os.makedirs(self.out_dir_, exist_ok=True)
+        self.writer_ = SftpLogFileDistiller.FORMATS[self.out_format_](
+            self.out_dir_, self.buffer_bytes_, self.append_)
+        self.start_time_ = time.perf_counter()
+
+    def _writeSession(self, session):
+        self.writer_.writeSession(session)
+        self.session_cnt_ += 1
+        self.command_cnt_ += len(session["commands"])
+
+    # Process a JSON document 'account' with the specified 'state', either:
+    #   'N' => new
+    #   'X' => existing
+    def process_account(self, acctId, account, state):
+        try:
+            if acctId in self.account_ids_:
+                return
+            self.account_ids_.add(acctId)
+
+            self.writer_.writeAccount({
+                "accountId"     : acctId,
+                "accountName"   : account["accountName"]})
+            self.account_cnt_ += 1
+
+        except Exception as err:
+            self.error_cnt_ += 1
+            print("Error in SftpLogFileDistiller::process_account : {0}".format(err))
+
+    # Process a JSON document 'session' with the specified 'state', either:
+    #   'N' => new
+    #   'X' => existing
+    #   'F' => final
+    def process_session(self, sessId, session, state):
+        try:
+            # The final update of a session evicted idle adds nothing to it
+            if self.coalescer_ is None:
+                if session["commands"]:
+                    self._writeSession(session)
+                return
+
+            if sessId in self.session_cache_:
+                SftpSession.mergeJSON(self.session_cache_[sessId], session)
+            else:
+                self.session_cache_[sessId] = session
+
+            # Once written, later updates start a new record
+            if self.coalescer_.update(sessId, state == 'F'):
+                self._writeSession(self.session_cache_.pop(sessId))
+
+        except Exception as err:
+            self.error_cnt_ += 1
+            print("Error in SftpLogFileDistiller::process_session : {0}".format(err))
+
+    def _writeHeldSessions(self, sessIds):
+        for sid in sessIds:
+            self._writeSession(self.session_cache_.pop(sid))
+
+    def _flushPending(self):
+        if self.coalescer_ is not None:
+            self._writeHeldSessions(self.coalescer_.drain())
+
+    # Write sessions held back for long enough, and hand buffered output to
+    # the OS, so that readers of the files keep up with a followed log
+    def poll(self):
+        try:
+            if self.coalescer_ is not None:
+                self._writeHeldSessions(self.coalescer_.due())
+            self.writer_.poll()
+
+        except Exception as err:
+            self.error_cnt_ += 1
+            print("Error in SftpLogFileDistiller::poll : {0}".format(err))
+
+    def flush(self):
+        self._flushPending()
+        self.writer_.flush()
+
+        if self.error_cnt_ > 0:
+            raise RuntimeError(
+                "{0} documents could not be written".format(self.error_cnt_))
+
+    def cleanup(self):
+        self._flushPending()
+
+        self.writer_.close()
+        self.writer_ = None
+
+        elapsed = time.perf_counter() - self.start_time_
+        print("SftpLogFileDistiller wrote {0} accounts, {1} session records, "
+              "{2} commands to {3} ({4}) in {5:.2f} s".format(
+            self.account_cnt_, self.session_cnt_, self.command_cnt_,
+            self.out_dir_, self.out_format_, elapsed))
+
+        if self.error_cnt_ > 0:
+            raise RuntimeError(
+                "{0} documents could not be written".format(self.error_cnt_))
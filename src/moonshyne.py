@@ -1,32 +1,98 @@
 #!/usr/bin/python3
 
 import argparse
-import datetime
 import glob
-import io
-import json
 import logging
 import os
 import os.path
+import signal
 import sys
 import time
 
-from postgresql.pgsql_distiller import SftpLogPgSqlDistiller
-from couchdb.couchdb_distiller  import SftpLogCdbDistiller 
-
-from sftp.sftp_session          import SftpSessionJsonEncoder 
+from sftp.sftp_account          import SftpAccountRegistry
+from sftp.sftp_log_check        import SftpLogChecker
+from sftp.sftp_log_check        import SftpLogCheckReport
+from sftp.sftp_log_checkpoint   import SftpLogCheckpoint
 from sftp.sftp_log_parser       import SftpLogParser
+from sftp.sftp_log_pool         import SftpLogParserPool
+from sftp.sftp_log_writer       import SftpLogBatch
+from sftp.sftp_log_writer       import SftpLogCoalescer
+from sftp.sftp_log_writer       import SftpLogWriter
 
 log_mod = "moonshyne"
 
-acctFile = None
-sessFile = None
- 
-def account_callback(acct, action):
-    acctFile.write(json.dumps(vars(acct)))
+SINKS = ("pgsql", "couchdb", "ndjson", "parquet",)
+
+DEFAULT_PGSQL_CONN  = "host=172.17.0.2 dbname=postgres user=postgres"
+DEFAULT_COUCHDB_URL = "http://127.0.0.1:5984"
+
+# Construct the distiller for 'args.sink'. Sink modules are only imported
+# when chosen, so that a sink's client library need not be installed to use
+# another one.
+def create_distiller(args):
+    batchArgs = {
+        "coalesce"       : args.coalesce,
+        "checkpointSecs" : args.checkpointSecs}
+
+    # Files written by an interrupted run are added to when resuming it
+    if args.sink in ("ndjson", "parquet",):
+        from localfile.file_distiller import SftpLogFileDistiller
+        return SftpLogFileDistiller(args.sinkPath if args.sinkPath else ".",
+            outFormat=args.sink, append=(args.checkpointFile is not None and
+                os.path.exists(args.checkpointFile)), **batchArgs)
+
+    batchArgs.update({
+        "maxInFlight"    : args.inFlight,
+        "batchSize"      : args.batchSize,
+        "batchBytes"     : args.batchMB * 1024 * 1024,
+        "batchSecs"      : args.batchSecs})
+
+    if args.sink == "couchdb":
+        from couchdb.couchdb_distiller import SftpLogCdbDistiller
+        return SftpLogCdbDistiller(
+            args.sinkPath if args.sinkPath else DEFAULT_COUCHDB_URL, **batchArgs)
+
+    from postgresql.pgsql_distiller import SftpLogPgSqlDistiller
+    return SftpLogPgSqlDistiller(
+        args.sinkPath if args.sinkPath else DEFAULT_PGSQL_CONN,
+        copyMode=args.pgCopy, connections=args.pgConnections, **batchArgs)
+
+# Preload the accounts saved by earlier runs into 'acctRegistry', so that
+# each account keeps its ID: from --accountCache if it exists, or else from
+# the sink, in one query.
+def preload_accounts(args, logDistiller, acctRegistry):
+    if args.accountCache:
+        acctCnt = acctRegistry.load(args.accountCache)
+        if acctCnt is not None:
+            print("Loaded {0} accounts from {1}".format(acctCnt, args.accountCache))
+            return
+
+    idMap = logDistiller.load_accounts()
+    acctRegistry.preload(idMap)
+    print("Loaded {0} accounts from the {1} sink".format(len(idMap), args.sink))
+
+# With --check, register an anomaly checker for the log 'logName' with the
+# parser reading it, so that the log is checked in the same read as it is
+# distilled; 'checks' collects what write_checks() reports.
+def add_checker(args, parser, logName, checks):
+    if not args.check:
+        return
 
-def session_callback(sess, action):
-    sessFile.write(SftpSessionJsonEncoder().encode(sess))
+    report = SftpLogCheckReport("{0}.{1}".format(args.check, len(checks)),
+        args.checkErrors)
+    parser.addConsumer(SftpLogChecker(report))
+    checks.append((logName, parser, report,))
+
+# Write the report of the checks made by add_checker() to 'args.check'
+def write_checks(args, checks):
+    if not args.check:
+        return
+
+    results = []
+    for logName, parser, report in checks:
+        report.finish()
+        results.append((logName, parser.line_cnt_, report, None,))
+    SftpLogCheckReport.writeMerged(args.check, results, args.checkErrors)
 
 exit_code = 0
 try:
@@ -41,8 +107,138 @@ try:
         metavar='verbosity', dest='verbosity',
         help='Verbosity level for Python Logging framework (default=DEBUG)')
 
+    argcheck.add_argument('--workers',
+        metavar='workers', dest='workers', type=int, default=1,
+        help='Number of worker processes used to parse log files (default=1)')
+
+    argcheck.add_argument('--idleTimeout',
+        metavar='seconds', dest='idleTimeout', type=int,
+        help='Evict sessions idle for this many seconds of log time; should '
+             'exceed the longest pause within a session (default: evict only '
+             'on session close)')
+
+    argcheck.add_argument('--concat',
+        dest='concat', action='store_true',
+        help='Kept for compatibility; matching log files are always read, '
+             'oldest first, as one continuous log, so that sessions spanning '
+             'a rotation are joined')
+
+    argcheck.add_argument('--follow',
+        dest='follow', action='store_true',
+        help='Read the matching log files, oldest first, as one log, then '
+             'follow the newest as it grows and is rotated, like tail -F, '
+             'until interrupted; updates are written within about '
+             '--batchSecs of being logged')
+
+    argcheck.add_argument('--chunkSize',
+        metavar='MB', dest='chunkSize', type=int,
+        help='With --workers > 1, split plain log files into chunks of this '
+             'many MB to be parsed in parallel (default={0})'.format(
+                 SftpLogParserPool.CHUNK_SIZE // (1024 * 1024)))
+
+    argcheck.add_argument('--sink',
+        metavar='sink', dest='sink', choices=SINKS, default="pgsql",
+        help='Where distilled accounts and sessions are written: one of '
+             '{0} (default=pgsql)'.format(", ".join(SINKS)))
+
+    argcheck.add_argument('--sinkPath',
+        metavar='path', dest='sinkPath',
+        help='PostgreSQL connection string, CouchDB URL, or output directory '
+             'of the ndjson/parquet files, per --sink (default: "{0}", '
+             '"{1}", or the current directory)'.format(
+                 DEFAULT_PGSQL_CONN, DEFAULT_COUCHDB_URL))
+
+    argcheck.add_argument('--pgCopy',
+        dest='pgCopy', action='store_true',
+        help='Load sessions into PostgreSQL with COPY into staging tables, '
+             'rather than as JSON documents')
+
+    argcheck.add_argument('--pgConnections',
+        metavar='connections', dest='pgConnections', type=int, default=1,
+        help='Number of PostgreSQL connections to save batches over '
+             'concurrently, with sessions partitioned by account (default=1)')
+
+    argcheck.add_argument('--inFlight',
+        metavar='batches', dest='inFlight', type=int,
+        default=SftpLogWriter.MAX_IN_FLIGHT,
+        help='Number of batches the distiller may be saving in the '
+             'background while parsing continues; 0 saves each batch before '
+             'parsing resumes (default={0})'.format(SftpLogWriter.MAX_IN_FLIGHT))
+
+    argcheck.add_argument('--batchSize',
+        metavar='sessions', dest='batchSize', type=int,
+        default=SftpLogBatch.MAX_DOCS,
+        help='Flush a batch once it holds this many distinct sessions '
+             '(default={0})'.format(SftpLogBatch.MAX_DOCS))
+
+    argcheck.add_argument('--batchMB',
+        metavar='MB', dest='batchMB', type=int,
+        default=SftpLogBatch.MAX_BYTES // (1024 * 1024),
+        help='Flush a batch once it holds about this many MB of documents '
+             '(default={0})'.format(SftpLogBatch.MAX_BYTES // (1024 * 1024)))
+
+    argcheck.add_argument('--batchSecs',
+        metavar='seconds', dest='batchSecs', type=float,
+        default=SftpLogBatch.MAX_SECS,
+        help='Flush a batch once its oldest update is this many seconds old '
+             '(default={0})'.format(SftpLogBatch.MAX_SECS))
+
+    argcheck.add_argument('--coalesce',
+        dest='coalesce', action='store_true',
+        help='Write each session once, when it closes or at the end of input, '
+             'rather than with every batch it is updated in')
+
+    argcheck.add_argument('--checkpointSecs',
+        metavar='seconds', dest='checkpointSecs', type=float,
+        default=SftpLogCoalescer.CHECKPOINT_SECS,
+        help='With --coalesce, also write sessions still open after this '
+             'many seconds of unsaved updates (default={0})'.format(
+                 SftpLogCoalescer.CHECKPOINT_SECS))
+
+    argcheck.add_argument('--checkpointFile',
+        metavar='path', dest='checkpointFile',
+        help='Save progress through the log files to this file, and resume '
+             'from it if it exists, so that a failed run can be rerun from '
+             'its last flush (not with --workers > 1 or --sink parquet)')
+
+    argcheck.add_argument('--checkpointInterval',
+        metavar='seconds', dest='checkpointInterval', type=float,
+        default=SftpLogCheckpoint.INTERVAL_SECS,
+        help='With --checkpointFile, flush and save a checkpoint this often, '
+             'as well as after each file (default={0})'.format(
+                 SftpLogCheckpoint.INTERVAL_SECS))
+
+    argcheck.add_argument('--accountCache',
+        metavar='path', dest='accountCache',
+        help='Load account IDs from this file, if it exists, rather than '
+             'from the sink, and save them to it once done; the file must '
+             'not be stale with respect to the sink')
+
+    argcheck.add_argument('--check',
+        metavar='report', dest='check',
+        help='Also check the logs for anomalies as sftp_log_check.py does, '
+             'in the same read of them, writing the findings to this report '
+             '(not with --workers > 1 or --checkpointFile)')
+
+    argcheck.add_argument('--checkErrors',
+        dest='checkErrors', action='store_true',
+        help='With --check, also list client SFTP errors in the report')
+
     args = argcheck.parse_args()
 
+    if args.check and args.workers > 1:
+        argcheck.error("--check can't be used with --workers > 1")
+    if args.check and args.checkpointFile:
+        argcheck.error("--check can't be used with --checkpointFile")
+    if args.checkpointFile and args.workers > 1:
+        argcheck.error("--checkpointFile can't be used with --workers > 1")
+    if args.checkpointFile and args.sink == "parquet":
+        argcheck.error("--checkpointFile can't be used with --sink parquet")
+    if args.follow and args.workers > 1:
+        argcheck.error("--follow can't be used with --workers > 1")
+    if args.chunkSize and args.workers < 2:
+        argcheck.error("--chunkSize requires --workers > 1")
+
     logger = logging.getLogger(log_mod)
 
     verbosity = "DEBUG"
@@ -64,31 +260,63 @@ try:
     fileHandler.setFormatter(formatter)
     logger.addHandler(fileHandler)
 
-    # !!! TESTING !!!
-    #logDistiller = SftpLogCdbDistiller("http://127.0.0.1:5984")
-    #logDistiller.connect("sftp_accounts", "sftp_sessions")
-
-    logDistiller = SftpLogPgSqlDistiller('host=172.17.0.2 dbname=postgres user=postgres')
+    logDistiller = create_distiller(args)
     logDistiller.connect()
 
-    #acctFile = open("accounts.txt", "w")
-    #sessFile = open("sessions.txt", "w")
+    # One registry numbers the accounts of every log file and worker
+    acctRegistry = SftpAccountRegistry()
+    preload_accounts(args, logDistiller, acctRegistry)
+
+    checkpoint = None
+    if args.checkpointFile:
+        checkpoint = SftpLogCheckpoint(args.checkpointFile,
+            logDistiller.flush, args.checkpointInterval)
 
-    for infile in glob.glob(args.files):
-        parser = SftpLogParser(infile)
-        parser.parse(logDistiller.process_account, logDistiller.process_session)
-        #parser.parse(account_callback, session_callback)
+    logFiles = glob.glob(args.files)
+    checks = []
+
+    if args.follow:
+        # A log that doesn't exist yet is waited for
+        if len(logFiles) == 0:
+            logFiles = [args.files]
+        logFiles.sort(key=lambda f: os.path.getmtime(f) if os.path.exists(f) else 0)
+        parser = SftpLogParser(logFiles, deltaMode=True,
+            acctRegistry=acctRegistry, idleTimeout=args.idleTimeout,
+            follow=True)
+        add_checker(args, parser, args.files, checks)
+
+        # Stop following on SIGINT/SIGTERM, then save what has been parsed
+        signal.signal(signal.SIGINT, lambda signum, frame: parser.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: parser.stop())
+
+        parser.parse(logDistiller.process_account, logDistiller.process_session,
+            checkpoint, logDistiller.poll)
+    elif args.workers > 1:
+        logFiles.sort(key=os.path.getmtime)
+        chunkSize = SftpLogParserPool.CHUNK_SIZE
+        if args.chunkSize:
+            chunkSize = args.chunkSize * 1024 * 1024
+        parserPool = SftpLogParserPool(args.workers, deltaMode=True,
+            idleTimeout=args.idleTimeout)
+        parserPool.parse(logFiles,
+            logDistiller.process_account, logDistiller.process_session,
+            acctRegistry, chunkSize)
+    elif len(logFiles) > 0:
+        logFiles.sort(key=os.path.getmtime)
+        parser = SftpLogParser(logFiles, deltaMode=True,
+            acctRegistry=acctRegistry, idleTimeout=args.idleTimeout)
+        add_checker(args, parser, args.files, checks)
+        parser.parse(logDistiller.process_account, logDistiller.process_session,
+            checkpoint)
 
     logDistiller.cleanup()
+    if args.accountCache:
+        acctRegistry.save(args.accountCache)
+    write_checks(args, checks)
 
 except Exception as e:
     logger.error("Encountered error in moonshyne::main - {0}".format(e))
     exit_code = 16 
 
-if acctFile:
-    acctFile.close()
-if sessFile:
-    sessFile.close()
-
 logger.info("Exit moonshyne main.")
 sys.exit(exit_code)
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Compare the PostgreSQL save paths of SftpLogPgSqlDistiller on a real log
+# file, by throughput and by session batch latency as the tables grow, and
+# check that a session batch updates only its own sessions. Run from the src
+# directory against a scratch database, since each run truncates the
+# moonshyne_sftp tables first, e.g.:
+#
+#   python3 -m postgresql.pgsql_bench --conn 'host=172.17.0.2 dbname=postgres user=postgres' \
+#       --logfile /var/log/sftp.log
+
+import argparse
+import json
+import psycopg2
+import sys
+
+from postgresql.pgsql_distiller import SftpLogPgSqlDistiller
+from sftp.sftp_log_parser       import SftpLogParser
+from sftp.sftp_log_writer       import SftpLogFlushStats
+
+# Parse the log once, keeping the callbacks as JSON text so that each run
+# replays its own copy of the documents.
+def _recordCallbacks(logFile):
+    callbacks = []
+
+    def accountCallback(acctId, account, state):
+        callbacks.append((True, acctId, json.dumps(account), state,))
+
+    def sessionCallback(sessId, session, state):
+        callbacks.append((False, sessId, json.dumps(session), state,))
+
+    parser = SftpLogParser(logFile, deltaMode=True)
+    parser.parse(accountCallback, sessionCallback)
+    return callbacks
+
+def _resetDatabase(connStr):
+    pgdb_server = psycopg2.connect(connStr)
+    try:
+        pgsql_cmd = pgdb_server.cursor()
+        pgsql_cmd.execute(
+            "truncate moonshyne_sftp.commands, moonshyne_sftp.sessions, "
+            "moonshyne_sftp.accounts;")
+        pgdb_server.commit()
+        pgsql_cmd.close()
+    finally:
+        pgdb_server.close()
+
+# Replay the callbacks into a distiller, returning the rows saved, the total
+# save time and the latency of each session batch flushed along the way.
+def benchSaveSessions(connStr, callbacks, copyMode):
+    _resetDatabase(connStr)
+
+    distiller = SftpLogPgSqlDistiller(connStr, copyMode=copyMode)
+    distiller.flush_stats_ = SftpLogFlushStats(None)
+    distiller.connect()
+
+    for isAccount, docId, doc, state in callbacks:
+        if isAccount:
+            distiller.process_account(docId, json.loads(doc), state)
+        else:
+            distiller.process_session(docId, json.loads(doc), state)
+
+    distiller.cleanup()
+
+    latencies = list(distiller.flush_stats_.latencies_)
+
+    return (distiller.rows_saved_, distiller.save_secs_, latencies,)
+
+# Regression check: saving a batch holding one existing session must touch
+# only that session's row, however many sessions the table holds. Runs in a
+# transaction that is rolled back, and returns a list of failures.
+def checkSessionUpdateScope(connStr, callbacks):
+    sessDoc = None
+    for isAccount, docId, doc, state in callbacks:
+        if not isAccount:
+            sessDoc = json.loads(doc)
+    if sessDoc is None:
+        return []
+
+    sessStr  = json.dumps([sessDoc])
+    failures = []
+
+    pgdb_server = psycopg2.connect(connStr)
+    try:
+        pgsql_cmd = pgdb_server.cursor()
+
+        pgsql_cmd.execute("select count(*) from moonshyne_sftp.sessions;")
+        sessCnt = pgsql_cmd.fetchone()[0]
+
+        for func in ("save_sessions", "update_sessions"):
+            pgsql_cmd.execute(
+                "select moonshyne_sftp.{0}(cast(%s as json));".format(func),
+                (sessStr,))
+            touched = pgsql_cmd.fetchone()[0]
+
+            print("{0:<28} {1:>14,} {2:>14,}".format(
+                func, touched, sessCnt))
+            if touched != 1:
+                failures.append("{0} touched {1} sessions, expected 1".format(
+                    func, touched))
+
+        pgsql_cmd.close()
+        pgdb_server.rollback()
+    finally:
+        pgdb_server.close()
+
+    return failures
+
+# Mean batch latency over each tenth of the run; with indexed upserts it
+# should stay flat as the tables grow.
+def _reportLatencies(name, latencies, buckets=10):
+    print("{0:<28} {1:>14} {2:>14}".format(
+        "{0} batches".format(name), "batches", "mean ms"))
+
+    bucketSize = max(1, -(-len(latencies) // buckets))
+    for first in range(0, len(latencies), bucketSize):
+        bucket = latencies[first:first+bucketSize]
+        print("{0:<28} {1:>14,} {2:>14.1f}".format(
+            "  {0:,} - {1:,}".format(first + 1, first + len(bucket)),
+            len(bucket), 1000 * sum(bucket) / len(bucket)))
+
+if __name__ == "__main__":
+    argcheck = argparse.ArgumentParser(
+        description="Compare the JSON and COPY PostgreSQL save paths.")
+
+    argcheck.add_argument('--conn',
+        metavar='connStr', required=True,
+        help='libpq connection string of a scratch moonshyne database')
+
+    argcheck.add_argument('--logfile',
+        metavar='logfile', required=True,
+        help='FQN of SFTP log file to load')
+
+    args = argcheck.parse_args()
+
+    callbacks = _recordCallbacks(args.logfile)
+
+    results = []
+    for name, copyMode in (("JSON", False), ("COPY", True)):
+        results.append((name,) + benchSaveSessions(args.conn, callbacks, copyMode))
+
+    print("{0:<28} {1:>14} {2:>14} {3:>14}".format(
+        "save path", "rows", "seconds", "rows/sec"))
+    for name, rows, secs, latencies in results:
+        print("{0:<28} {1:>14,} {2:>14.2f} {3:>14,.0f}".format(
+            name, rows, secs, rows / secs if secs > 0 else 0))
+
+    for name, rows, secs, latencies in results:
+        _reportLatencies(name, latencies)
+
+    print("{0:<28} {1:>14} {2:>14}".format(
+        "one-session batch", "touched", "sessions"))
+    failures = checkSessionUpdateScope(args.conn, callbacks)
+    for failure in failures:
+        print("FAILED: {0}".format(failure))
+
+    sys.exit(1 if failures else 0)
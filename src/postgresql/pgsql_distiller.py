@@ -1,29 +1,207 @@
 #!/usr/bin/python3
 
+import csv
+import io
 import json
 import logging
 import psycopg2
-
-class SftpLogPgSqlDistiller :
-
-    BATCH_SIZE      = 1000
+import psycopg2.pool
+import threading
+import time
+
+from sftp.sftp_log_distiller import SftpLogBatchDistiller
+from sftp.sftp_log_writer    import SftpLogBatch
+from sftp.sftp_log_writer    import SftpLogCoalescer
+from sftp.sftp_log_writer    import SftpLogWriter
+
+class SftpLogPgSqlDistiller(SftpLogBatchDistiller) :
+
+    # Session batches are flushed at BATCH_SIZE distinct sessions, about
+    # BATCH_BYTES of documents, or BATCH_SECS after their first update
+    BATCH_SIZE      = SftpLogBatch.MAX_DOCS
+    BATCH_BYTES     = SftpLogBatch.MAX_BYTES
+    BATCH_SECS      = SftpLogBatch.MAX_SECS
     ACCT_BATCH_SIZE = 50
 
-    def __init__(self, connStr) :
+    # Transient failures (lost connections, deadlocks, serialization
+    # failures) are retried up to RETRY_LIMIT times per batch, backing off
+    # from RETRY_SECS
+    RETRY_LIMIT     = 5
+    RETRY_SECS      = 0.5
+
+    # With 'copyMode' set, session batches are streamed into staging tables
+    # with COPY and merged by moonshyne_sftp.merge_stage(), rather than sent
+    # as one JSON document to moonshyne_sftp.save_sessions().
+    #
+    # Batches are saved by an SftpLogWriter thread, with up to 'maxInFlight'
+    # of them pending while parsing continues; 0 saves each batch inline.
+    #
+    # With 'connections' above 1, sessions are partitioned by account over
+    # that many writers, each saving on its own pooled connection, so that
+    # batches are saved concurrently while each session's updates are still
+    # saved in order.
+    def __init__(self, connStr, copyMode=False,
+                 maxInFlight=SftpLogWriter.MAX_IN_FLIGHT, connections=1,
+                 batchSize=BATCH_SIZE, batchBytes=BATCH_BYTES,
+                 batchSecs=BATCH_SECS, coalesce=False,
+                 checkpointSecs=SftpLogCoalescer.CHECKPOINT_SECS) :
+
+        SftpLogBatchDistiller.__init__(self, batchSize, batchBytes, batchSecs,
+            coalesce, checkpointSecs, SftpLogPgSqlDistiller.ACCT_BATCH_SIZE)
 
         self.conn_str_          = connStr
-        self.pgdb_server_       = None
+        self.pgdb_pool_         = None
+        self.copy_mode_         = copyMode
+        self.max_in_flight_     = maxInFlight
+        self.connections_       = max(1, connections)
 
         self.account_cache_     = {}
-        self.account_batch_     = set()
-        self.account_batch_cnt_ = 0
 
-        self.session_cache_     = {}
-        self.session_batch_     = set()
-        self.session_batch_cnt_ = 0
+        # Session and command rows saved, and the time spent saving them
+        self.rows_saved_        = 0
+        self.save_secs_         = 0.0
+        self.stats_lock_        = threading.Lock()
 
     def connect(self):
-        self.pgdb_server_ =  psycopg2.connect(self.conn_str_)
+        self.pgdb_pool_ = psycopg2.pool.ThreadedConnectionPool(
+            1, self.connections_, self.conn_str_)
+
+        for lane in range(self.connections_):
+            self.writers_.append(SftpLogWriter(self.max_in_flight_))
+
+    # Runs on a writer thread. Run 'saveFunc(pgsql_cmd, *args)' in a
+    # transaction on a pooled connection, retrying transient failures.
+    # Connections found closed are dropped from the pool, so a retry gets a
+    # fresh one. The save functions are upserts, so a batch that is saved
+    # twice (e.g. committed just as the connection dropped) comes to no harm.
+    def _transact(self, saveFunc, *args):
+        attempt = 0
+        while True:
+            pgdb_conn = self.pgdb_pool_.getconn()
+            try:
+                pgsql_cmd = pgdb_conn.cursor()
+                try:
+                    saveFunc(pgsql_cmd, *args)
+                finally:
+                    pgsql_cmd.close()
+
+                pgdb_conn.commit()
+                return
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                attempt += 1
+                if attempt > SftpLogPgSqlDistiller.RETRY_LIMIT:
+                    raise
+
+                print("SftpLogPgSqlDistiller retrying {0} ({1}/{2}) : {3}".format(
+                    saveFunc.__name__, attempt, SftpLogPgSqlDistiller.RETRY_LIMIT,
+                    err))
+                time.sleep(SftpLogPgSqlDistiller.RETRY_SECS * 2 ** (attempt - 1))
+
+            finally:
+                if pgdb_conn.closed == 0:
+                    try:
+                        pgdb_conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                self.pgdb_pool_.putconn(pgdb_conn, close=(pgdb_conn.closed != 0))
+
+    def _loadAccounts(self, pgsql_cmd, idMap):
+        pgsql_cmd.execute(
+            "select account_name, account_id from moonshyne_sftp.accounts;")
+        idMap.update(pgsql_cmd.fetchall())
+
+    # Return all saved accounts, as account name => ID, in one query
+    def load_accounts(self):
+        idMap = {}
+        self._transact(self._loadAccounts, idMap)
+        return idMap
+
+    def _saveAccounts(self, pgsql_cmd, acctDocs):
+        acctStr = json.dumps(acctDocs)
+        pgsql_cmd.execute("select moonshyne_sftp.save_accounts(cast(%s as json));",
+            (acctStr,))
+
+    def _saveSessionsJson(self, pgsql_cmd, sessDocs):
+        sessStr = json.dumps(sessDocs)
+        pgsql_cmd.execute("select moonshyne_sftp.save_sessions(cast(%s as json));",
+              (sessStr,))
+
+    # Stage the batch as CSV; the session key fields are repeated on each
+    # command row so merge_stage() can resolve session IDs in one join.
+    def _saveSessionsCopy(self, pgsql_cmd, sessDocs):
+        sessBuf = io.StringIO()
+        cmdBuf  = io.StringIO()
+        sessCsv = csv.writer(sessBuf)
+        cmdCsv  = csv.writer(cmdBuf)
+
+        for sess in sessDocs:
+            sessCsv.writerow((
+                sess["accountId"], sess["pid"], sess["sessionDate"],
+                sess["startTime"], sess["endTime"], sess["ipAddress"]))
+
+            for cmd in sess["commands"]:
+                cmdCsv.writerow((
+                    sess["accountId"], sess["pid"], sess["sessionDate"],
+                    cmd["sequenceId"], cmd["timeOffset"], cmd["type"],
+                    cmd["target"], cmd["source"], cmd["status"]))
+
+        sessBuf.seek(0)
+        cmdBuf.seek(0)
+        pgsql_cmd.execute("select moonshyne_sftp.prepare_stage();")
+        pgsql_cmd.copy_expert(
+            "copy pg_temp.session_stage from stdin with (format csv)", sessBuf)
+        # csv.writer writes empty strings as bare fields, which COPY would
+        # otherwise read as NULL; most commands have an empty source
+        pgsql_cmd.copy_expert(
+            "copy pg_temp.command_stage from stdin with (format csv, "
+            "force_not_null (command_target, command_source))", cmdBuf)
+        pgsql_cmd.execute("select moonshyne_sftp.merge_stage();")
+
+    # Runs on a writer thread
+    def _saveSessions(self, sessDocs, rowCnt, batchBytes, batchStart):
+        startTime = time.perf_counter()
+        waitSecs  = time.monotonic() - batchStart
+
+        if self.copy_mode_:
+            self._transact(self._saveSessionsCopy, sessDocs)
+        else:
+            self._transact(self._saveSessionsJson, sessDocs)
+
+        saveSecs = time.perf_counter() - startTime
+        with self.stats_lock_:
+            self.rows_saved_ += rowCnt
+            self.save_secs_  += saveSecs
+            self.flush_stats_.add(len(sessDocs), batchBytes, waitSecs, saveSecs)
+
+    def _flushAccounts(self):
+        if len(self.account_batch_) == 0:
+            return
+
+        acctDocs = []
+        for aid in self.account_batch_:
+            acctDocs.append(self.account_cache_[aid])
+
+        self.account_batch_.clear()
+
+        self.writers_[0].submit(self._transact, self._saveAccounts, acctDocs)
+
+    # Hand the batch's documents over to the writers, split by account
+    def _submitSessions(self, sessDocs, finalIds, batchBytes, batchStart):
+        laneDocs = [[] for writer in self.writers_]
+        laneRows = [0] * len(self.writers_)
+        for sess in sessDocs:
+            lane = sess["accountId"] % len(self.writers_)
+            laneDocs[lane].append(sess)
+            laneRows[lane] += 1 + len(sess["commands"])
+
+        batchRows = sum(laneRows)
+
+        # Each writer's share of the batch is reported as a flush of its own
+        for writer, laneSess, rowCnt in zip(self.writers_, laneDocs, laneRows):
+            if len(laneSess) > 0:
+                writer.submit(self._saveSessions, laneSess, rowCnt,
+                    batchBytes * rowCnt // batchRows, batchStart)
 
     # Process a JSON document 'account' with the specified 'state', either:
     #   'N' => new
@@ -36,115 +214,27 @@ class SftpLogPgSqlDistiller :
             # Only handling new account creation; don't need to update
             # account to session relationships.
             if state == 'N':
-                self.account_batch_.add(acctId)
-            self.account_batch_cnt_ += 1
+                self.account_batch_.add(acctId, SftpLogBatch.DOC_BYTES)
 
-            if self.account_batch_cnt_ == SftpLogPgSqlDistiller.ACCT_BATCH_SIZE:
-
-                pgsql_cmd = None
-                try:
-                    acctDocs = []
-                    for aid in self.account_batch_:
-                        acctDocs.append(self.account_cache_[aid])
-
-                    pgsql_cmd = self.pgdb_server_.cursor()
-
-                    acctStr = json.dumps(acctDocs)
-                    pgsql_cmd.execute("select moonshyne_sftp.save_accounts(cast(%s as json));",
-                        (acctStr,))
-
-                    self.account_batch_.clear()
-                    self.account_batch_cnt_ = 0
-
-                    self.pgdb_server_.commit()
-                finally:
-                    if pgsql_cmd:
-                        pgsql_cmd.close()
-                        pgsql_cmd = None
+            if self.account_batch_.isFull():
+                self._flushAccounts()
 
         except Exception as err:
             print("Error in SftpLogPgSqlDistiller::process_account : {0}".format(err))
 
-    # Process a JSON document 'session' with the specified 'state', either:
-    #   'N' => new
-    #   'X' => existing
-    def process_session(self, sessId, session, state):
-        try:
-
-            if sessId in self.session_cache_:
-                oldSess = self.session_cache_[sessId]
-                if "wasSaved" in oldSess:
-                    session["wasSaved"] = True
-
-            self.session_cache_[sessId] = session
-
-            # Append the session update to
-            self.session_batch_.add(sessId)
-            self.session_batch_cnt_ += 1
-
-            if self.session_batch_cnt_ == SftpLogPgSqlDistiller.BATCH_SIZE:
-                pgsql_cmd = None
-                try:
-                    sessDocs = []
-
-                    for sid in self.session_batch_:
-
-                        sess = self.session_cache_[sid]
-                        sessDocs.append(sess)
-
-                    pgsql_cmd = self.pgdb_server_.cursor()
-
-                    sessStr = json.dumps(sessDocs)
-                    pgsql_cmd.execute("select moonshyne_sftp.save_sessions(cast(%s as json));",
-                          (sessStr,))
-
-                    self.pgdb_server_.commit()
-
-                    self.session_batch_.clear()
-                    self.session_batch_cnt_ = 0
-
-                finally:
-                    if pgsql_cmd:
-                        pgsql_cmd.close()
-                        pgsql_cmd = None
-
-        except Exception as err:
-            print("Error in SftpLogPgSqlDistiller::process_session : {0}".format(err))
-
-
     def cleanup(self):
-        # Process any pending updates in the batch lists
-        acctDocs = []
-        for aid in self.account_batch_:
-            acctDocs.append(self.account_cache_[aid])
-
-        pgsql_cmd = None
-        try:
-            pgsql_cmd = self.pgdb_server_.cursor()
-
-            acctStr = json.dumps(acctDocs)
-            pgsql_cmd.execute("select moonshyne_sftp.save_accounts(cast(%s as json));",
-                (acctStr,))
-
-            sessDocs = []
-
-            for sid in self.session_batch_:
-
-                sess = self.session_cache_[sid]
-                sessDocs.append(sess)
-
-            cursor = self.pgdb_server_.cursor()
-
-            sessStr = json.dumps(sessDocs)
-            pgsql_cmd.execute("select moonshyne_sftp.save_sessions(cast(%s as json));",
-                   (sessStr,))
+        errorCnt = self._closeWriters()
 
-            self.pgdb_server_.commit()
+        self.pgdb_pool_.closeall()
+        self.pgdb_pool_ = None
 
-        finally:
-            if pgsql_cmd:
-                pgsql_cmd.close()
-                pgsql_cmd = None
+        rowRate = self.rows_saved_ / self.save_secs_ if self.save_secs_ > 0 else 0
+        print("SftpLogPgSqlDistiller saved {0} rows in {1:.2f}s : {2:.0f} rows/sec ({3})".format(
+            self.rows_saved_, self.save_secs_, rowRate,
+            "COPY" if self.copy_mode_ else "JSON"))
 
-        self.pgdb_server_.close()
-        self.pgdb_server_ = None
+        # Batches that failed for good were reported as they failed; don't
+        # let the run pass for a complete one.
+        if errorCnt > 0:
+            raise RuntimeError(
+                "{0} batches could not be saved".format(errorCnt))
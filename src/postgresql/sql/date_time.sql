@@ -29,7 +29,7 @@ begin
 
    jdays := cast(to_char(dt, 'J') as integer);
    return jdays;
-end;$$ language plpgsql;
+end;$$ language plpgsql stable;
 
 create or replace function date_time.julian_date(days integer)
 returns date 
@@ -40,5 +40,5 @@ begin
 
    jdate := to_date(cast(days as text), 'J');
    return jdate;
-end;$$ language plpgsql;
+end;$$ language plpgsql stable;
 
@@ -53,6 +53,10 @@ create table moonshyne_sftp.sessions (
    entry_datetime    timestamp   not null
 );
 
+-- Natural key of a session; see get_session_key()
+create unique index idx_ak1_sessions on moonshyne_sftp.sessions
+   (account_id, session_pid, session_date);
+
 create table moonshyne_sftp.command_types (
    command_type      smallint    not null primary key,
    command_name      text        not null
@@ -61,7 +65,7 @@ create table moonshyne_sftp.command_types (
 create table moonshyne_sftp.commands (
    command_id        serial      not null primary key,
    session_id        serial      not null references moonshyne_sftp.sessions,
-   command_seq_id    smallint    not null,
+   command_seq_id    integer     not null,
    time_offset       bigint      not null,
    command_type      smallint    not null references moonshyne_sftp.command_types,
    command_target    text        not null,
@@ -70,6 +74,9 @@ create table moonshyne_sftp.commands (
    entry_datetime    timestamp   not null
 );
 
+create unique index idx_ak1_commands on moonshyne_sftp.commands
+   (session_id, command_seq_id);
+
 -------------------------------------------------------------------------------
 -- "SFTP" functions
 create or replace function moonshyne_sftp.create_accounts(acct_json json)
@@ -99,6 +106,7 @@ declare
    rv   integer := 0;
 begin
 
+      -- Accounts already saved, under their ID or name, are left as they are
       insert into moonshyne_sftp.accounts
          (account_id, account_name, entry_datetime)
          select
@@ -107,10 +115,7 @@ begin
             json_to_recordset(acct_json)
          as
             x(sessions text, "accountId" integer, "accountName" text)
-         where
-            not exists (
-               select 1 from moonshyne_sftp.accounts a where x."accountId" = a.account_id
-            );
+      on conflict do nothing;
 
       return rv;
 
@@ -149,7 +154,7 @@ begin
       )
       select
          s2.session_id,
-         cast(cmd->>'sequenceId' as smallint),
+         cast(cmd->>'sequenceId' as integer),
          cast(cmd->>'timeOffset' as bigint),
          cast(cmd->>'type' as int),
          cast(cmd->>'target' as text),
@@ -179,8 +184,8 @@ declare
    seq  integer := -1;
 begin
 
-   -- Update session cols
-   update moonshyne_sftp.sessions
+   -- Update session cols of the sessions in the batch
+   update moonshyne_sftp.sessions s
    set
       --session_start = sess.start_time,
       session_end = sess.end_time,
@@ -188,6 +193,8 @@ begin
    from
    (
       select
+         "accountId" as account_id, "pid" as session_pid,
+         date_time.julian_date("sessionDate") as session_date,
          "startTime" as start_time, "endTime" as end_time,
          "ipAddress" as ip_address
       from
@@ -196,21 +203,34 @@ begin
       x("serverId" integer,
         "accountId" integer,
         "pid" integer,
+        "sessionDate" integer,
         "startTime" bigint,
         "endTime" bigint,
         "ipAddress" bigint)
-   ) as sess;
+   ) as sess
+   where
+      s.account_id   = sess.account_id and
+      s.session_pid  = sess.session_pid and
+      s.session_date = sess.session_date;
+
+   -- Sessions updated
+   get diagnostics rv = row_count;
 
-   -- Insert new session commands in the update batch
+   -- Insert new session commands in the update batch, and update the
+   -- status of those already saved
    insert into moonshyne_sftp.commands
       (session_id,command_seq_id,time_offset,command_type,command_target,
           command_source,command_status,entry_datetime)
       with sess as (
-         select value as sessn from json_array_elements(session_json)
+         select
+            value as sessn,
+            date_time.julian_date(cast(value->>'sessionDate' as int)) as sess_date
+         from
+            json_array_elements(session_json)
       )
       select
          s2.session_id,
-         cast(cmd->>'sequenceId' as smallint),
+         cast(cmd->>'sequenceId' as integer),
          cast(cmd->>'timeOffset' as bigint),
          cast(cmd->>'type' as int),
          cast(cmd->>'target' as text),
@@ -225,41 +245,10 @@ begin
          moonshyne_sftp.sessions s2 on
             cast(s1.sessn->>'accountId' as int) = s2.account_id and
             cast(s1.sessn->>'pid' as int)       = s2.session_pid and
-            date_time.julian_date(cast(s1.sessn->>'sessionDate' as int)) = s2.session_date
-      where
-         not exists
-         (
-            select 1 from moonshyne_sftp.commands c
-            where c.session_id = s2.session_id and
-            c.command_seq_id = cast(cmd->>'sequenceId' as smallint)
-         );
-
-   -- Update existing session commands in the update batch
-   update moonshyne_sftp.commands
+            s1.sess_date                        = s2.session_date
+   on conflict (session_id, command_seq_id) do update
       set
-         command_status = cmds.status
-      from
-      (
-         with sess as (
-            select value as sessn from json_array_elements(session_json)
-         )
-         select
-            s2.session_id sess_id,
-            cast(cmd->>'sequenceId' as smallint) cmd_seq,
-            cast(cmd->>'status' as int) as status
-         from
-            sess s1
-               cross join
-            json_array_elements(s1.sessn->'commands') cmd
-               join
-            moonshyne_sftp.sessions s2 on
-               cast(s1.sessn->>'accountId' as int) = s2.account_id and
-               cast(s1.sessn->>'pid' as int)       = s2.session_pid and
-               date_time.julian_date(cast(s1.sessn->>'sessionDate' as int)) = s2.session_date
-      ) as cmds
-      where
-         session_id = sess_id and
-         command_seq_id = cmd_seq;
+         command_status = excluded.command_status;
 
    return rv;
 
@@ -274,7 +263,7 @@ declare
    seq  integer := -1;
 begin
 
-   -- Create new sessions
+   -- Create new sessions, or update those that already exist
    insert into moonshyne_sftp.sessions
       (account_id, session_pid, session_date, session_start,
           session_end, ip_address, entry_datetime)
@@ -291,53 +280,30 @@ begin
         "startTime" bigint,
         "endTime" bigint,
         "ipAddress" bigint)
-      where not exists (
-         select 1 from moonshyne_sftp.sessions s where
-         s.account_id = "accountId" and
-         s.session_pid = "pid" and
-         s.session_date = date_time.julian_date("sessionDate") 
-      );
+   on conflict (account_id, session_pid, session_date) do update
+      set
+         --session_start = excluded.session_start,
+         session_end = excluded.session_end,
+         ip_address  = excluded.ip_address;
 
+   -- Sessions created or updated
+   get diagnostics rv = row_count;
 
-   -- Update existing session 
-   update moonshyne_sftp.sessions
-   set
-      --session_start = sess.start_time,
-      session_end = sess.end_time,
-      ip_address  = sess.ip_address
-   from
-   (
-      select
-         "startTime" as start_time, "endTime" as end_time,
-         "ipAddress" as ip_address
-      from
-         json_to_recordset(session_json)
-      as
-      x("serverId" integer,
-        "accountId" integer,
-        "pid" integer,
-        "sessionDate" integer,
-        "startTime" bigint,
-        "endTime" bigint,
-        "ipAddress" bigint)
-      where exists (
-         select 1 from moonshyne_sftp.sessions s where
-         s.account_id = "accountId" and
-         s.session_pid = "pid" and
-         s.session_date =  date_time.julian_date("sessionDate")
-      )      
-   ) as sess;
-
-   -- Insert new session commands in the update batch
+   -- Insert new session commands in the update batch, and update the
+   -- status of those already saved
    insert into moonshyne_sftp.commands
       (session_id,command_seq_id,time_offset,command_type,command_target,
           command_source,command_status,entry_datetime)
       with sess as (
-         select value as sessn from json_array_elements(session_json)
+         select
+            value as sessn,
+            date_time.julian_date(cast(value->>'sessionDate' as int)) as sess_date
+         from
+            json_array_elements(session_json)
       )
       select
          s2.session_id,
-         cast(cmd->>'sequenceId' as smallint),
+         cast(cmd->>'sequenceId' as integer),
          cast(cmd->>'timeOffset' as bigint),
          cast(cmd->>'type' as int),
          cast(cmd->>'target' as text),
@@ -352,41 +318,108 @@ begin
          moonshyne_sftp.sessions s2 on
             cast(s1.sessn->>'accountId' as int) = s2.account_id and
             cast(s1.sessn->>'pid' as int)       = s2.session_pid and
-            date_time.julian_date(cast(s1.sessn->>'sessionDate' as int)) = s2.session_date
-      where
-         not exists
-         (
-            select 1 from moonshyne_sftp.commands c
-            where c.session_id = s2.session_id and
-            c.command_seq_id = cast(cmd->>'sequenceId' as smallint)
-         );
-
-   -- Update existing session commands in the update batch
-   update moonshyne_sftp.commands
+            s1.sess_date                        = s2.session_date
+   on conflict (session_id, command_seq_id) do update
       set
-         command_status = cmds.status
+         command_status = excluded.command_status;
+
+   return rv;
+
+end;$$ language plpgsql;
+
+-------------------------------------------------------------------------------
+-- Bulk (COPY) loading
+--
+-- The loader streams sessions and commands into per-connection staging
+-- tables with COPY, then merges them with merge_stage(). Staged dates are
+-- day numbers, as "sessionDate" is for save_sessions(); rows are cleared on
+-- commit.
+create or replace function moonshyne_sftp.prepare_stage()
+returns integer
+as $$
+declare
+   rv   integer := 0;
+begin
+
+   -- Called ahead of each load, so only create the tables once per
+   -- connection
+   if to_regclass('pg_temp.session_stage') is null then
+
+      create temp table session_stage (
+         account_id        integer     not null,
+         session_pid       integer     not null,
+         session_date      integer     not null,
+         session_start     bigint      null,
+         session_end       bigint      null,
+         ip_address        bigint      null
+      ) on commit delete rows;
+
+      create temp table command_stage (
+         account_id        integer     not null,
+         session_pid       integer     not null,
+         session_date      integer     not null,
+         command_seq_id    integer     not null,
+         time_offset       bigint      not null,
+         command_type      smallint    not null,
+         command_target    text        not null,
+         command_source    text        not null,
+         command_status    smallint    not null
+      ) on commit delete rows;
+
+   end if;
+
+   return rv;
+
+end;$$ language plpgsql;
+
+create or replace function moonshyne_sftp.merge_stage()
+returns integer
+as $$
+declare
+   rv   integer := 0;
+begin
+
+   -- Create staged sessions, or update those that already exist
+   insert into moonshyne_sftp.sessions
+      (account_id, session_pid, session_date, session_start,
+          session_end, ip_address, entry_datetime)
+      select
+         st.account_id, st.session_pid, date_time.julian_date(st.session_date),
+         st.session_start, st.session_end, st.ip_address, current_timestamp
       from
-      (
-         with sess as (
-            select value as sessn from json_array_elements(session_json)
-         )
+         session_stage st
+   on conflict (account_id, session_pid, session_date) do update
+      set
+         session_end = excluded.session_end,
+         ip_address  = excluded.ip_address;
+
+   -- Sessions created or updated
+   get diagnostics rv = row_count;
+
+   -- Create staged commands, or update the status of those already saved
+   insert into moonshyne_sftp.commands
+      (session_id,command_seq_id,time_offset,command_type,command_target,
+          command_source,command_status,entry_datetime)
+      with cmds as (
          select
-            s2.session_id sess_id,
-            cast(cmd->>'sequenceId' as smallint) cmd_seq,
-            cast(cmd->>'status' as int) as status
+            cs.*, date_time.julian_date(cs.session_date) as sess_date
          from
-            sess s1
-               cross join
-            json_array_elements(s1.sessn->'commands') cmd
-               join
-            moonshyne_sftp.sessions s2 on
-               cast(s1.sessn->>'accountId' as int) = s2.account_id and
-               cast(s1.sessn->>'pid' as int)       = s2.session_pid and
-               date_time.julian_date(cast(s1.sessn->>'sessionDate' as int)) = s2.session_date
-      ) as cmds
-      where
-         session_id = sess_id and
-         command_seq_id = cmd_seq;
+            command_stage cs
+      )
+      select
+         s.session_id, cmds.command_seq_id, cmds.time_offset,
+         cmds.command_type, cmds.command_target, cmds.command_source,
+         cmds.command_status, current_timestamp
+      from
+         cmds
+            join
+         moonshyne_sftp.sessions s on
+            s.account_id   = cmds.account_id and
+            s.session_pid  = cmds.session_pid and
+            s.session_date = cmds.sess_date
+   on conflict (session_id, command_seq_id) do update
+      set
+         command_status = excluded.command_status;
 
    return rv;
 
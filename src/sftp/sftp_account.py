@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
 import json
+import os
+import threading
 
 class SftpAccount:
 
@@ -29,3 +31,126 @@ class SftpAccountJsonEncoder(json.JSONEncoder):
 
         return SftpAccount.toJSON(obj)
 
+
+class _AccountCounter:
+
+    def __init__(self, start):
+        self.value = start
+
+# Assign account IDs by account name. A registry created with a
+# multiprocessing Manager can be handed to several worker processes, which
+# then share one account ID space; each instance also keeps a local cache so
+# that repeat lookups do not cross the process boundary.
+#
+# IDs are handed out from blocks of 'blockSize' reserved at a time from the
+# shared counter, so that a new account costs a single round trip to the
+# shared map rather than one per counter and lock operation. A process's
+# unused IDs are lost when it exits, so IDs assigned by several processes
+# can have gaps; a single process assigns them densely.
+#
+# The accounts known from earlier runs are loaded up front with preload(),
+# e.g. from the sink (SftpLogDistiller.load_accounts) or from a cache file
+# (load()), so that each account keeps its ID from run to run.
+class SftpAccountRegistry:
+
+    BLOCK_SIZE = 64
+
+    def __init__(self, manager=None, firstId=1, blockSize=BLOCK_SIZE):
+        if manager:
+            self.id_map_    = manager.dict()
+            self.lock_      = manager.Lock()
+            self.next_id_   = manager.Value('i', firstId)
+        else:
+            self.id_map_    = {}
+            self.lock_      = threading.Lock()
+            self.next_id_   = _AccountCounter(firstId)
+
+        self.local_map_ = {}
+
+        # This instance's reserved block of IDs: the next one to assign, and
+        # the end of the block
+        self.block_size_= blockSize
+        self.block_next_= 0
+        self.block_end_ = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["local_map_"] = {}
+        state["block_next_"]= 0
+        state["block_end_"] = 0
+        return state
+
+    # Return the next ID of this instance's block, reserving a new block
+    # from the shared counter if it is used up
+    def _nextId(self):
+        if self.block_next_ >= self.block_end_:
+            with self.lock_:
+                start = self.next_id_.value
+                self.next_id_.value = start + self.block_size_
+            self.block_next_= start
+            self.block_end_ = start + self.block_size_
+        return self.block_next_
+
+    # Return (accountId, isNew) for 'acctName'; isNew is True only for the
+    # caller that assigned the ID.
+    def lookup(self, acctName):
+        acctId = self.local_map_.get(acctName)
+        if acctId:
+            return (acctId, False)
+
+        # The shared map's setdefault() is atomic, so of several processes
+        # registering the same account at once only one assigns it an ID
+        newId = self._nextId()
+        acctId = self.id_map_.setdefault(acctName, newId)
+        isNew = acctId == newId
+        if isNew:
+            self.block_next_ += 1
+
+        self.local_map_[acctName] = acctId
+        return (acctId, isNew)
+
+    # Return all accounts registered so far, as account name => ID
+    def accounts(self):
+        with self.lock_:
+            return dict(self.id_map_)
+
+    # Register accounts already assigned IDs (account name => ID), e.g. by a
+    # previous run; new accounts are numbered after the highest of them.
+    # Should be called before IDs are assigned by other processes.
+    def preload(self, idMap):
+        if len(idMap) == 0:
+            return
+
+        with self.lock_:
+            self.id_map_.update(idMap)
+            lastId = max(idMap.values())
+            if lastId >= self.next_id_.value:
+                self.next_id_.value = lastId + 1
+
+        # Drop the rest of the reserved block if it holds preloaded IDs
+        if any(self.block_next_ <= acctId < self.block_end_
+               for acctId in idMap.values()):
+            self.block_next_= 0
+            self.block_end_ = 0
+
+        self.local_map_.update(idMap)
+
+    # Preload the accounts saved to 'path' by save(); returns the number of
+    # accounts loaded, or None if there is no such file
+    def load(self, path):
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "r", encoding="utf-8") as fhandle:
+            idMap = json.load(fhandle)
+        self.preload(idMap)
+        return len(idMap)
+
+    # Save all accounts registered so far to 'path', replacing it atomically
+    def save(self, path):
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w", encoding="utf-8") as fhandle:
+            json.dump(self.accounts(), fhandle, separators=(",", ":"))
+            fhandle.flush()
+            os.fsync(fhandle.fileno())
+        os.replace(tmpPath, path)
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# Micro-benchmarks for the SFTP log processing hot path. Run from the src
+# directory, e.g.:
+#
+#   python3 -m sftp.sftp_log_bench --lines 200000
+
+import argparse
+import gc
+import re
+import time
+import tracemalloc
+
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from sftp.sftp_session       import SftpCommand
+from sftp.sftp_session       import SftpCommandTypes
+from sftp.sftp_session       import SftpSession
+from sftp.sftp_session       import SftpStatusTypes
+from sftp.sftp_log_parser    import SftpLogParser
+from sftp.sftp_log_tokenizer import SFTP_LINE_REGEX
+from sftp.sftp_log_tokenizer import SftpTimestampDecoder
+from sftp.sftp_log_tokenizer import tokenizeLine
+
+# Representative SFTP log lines; the sshd lines are the ones the line
+# classifier has to reject.
+MATCHING_LINES = [
+    'Mar  1 10:00:01 sftp01 internal-sftp[24625]: time=2020-03-01 10:00:01.674 '
+        'user=dl781702 pid=24625 session opened for local user dl781702 from [10.20.30.40]\n',
+    'Mar  1 10:00:01 sftp01 internal-sftp[24625]: time=2020-03-01 10:00:01.702 '
+        'user=dl781702 pid=24625 open "/home/dl781702/inbound//c.tar.gz" flags WRITE,CREATE,TRUNCATE mode 0666\n',
+    'Mar  1 10:00:02 sftp01 internal-sftp[24625]: time=2020-03-01 10:00:02.118 '
+        'user=dl781702 pid=24625 close "/home/dl781702/inbound//c.tar.gz" bytes read 0 written 1048576\n',
+    'Mar  1 10:00:02 sftp01 internal-sftp[24625]: time=2020-03-01 10:00:02.120 '
+        'user=dl781702 pid=24625 sent status No such file\n']
+
+NONMATCHING_LINES = [
+    'Mar  1 10:00:01 sftp01 sshd[24624]: Accepted publickey for dl781702 from '
+        '10.20.30.40 port 53211 ssh2: RSA SHA256:b3bmOhGyjY8OqdNsbEx5wnz/Y9dWJ3YTumFtlHK5K5k\n',
+    'Mar  1 10:00:01 sftp01 sshd[24624]: pam_unix(sshd:session): session opened '
+        'for user dl781702 by (uid=0)\n',
+    'Mar  1 10:00:03 sftp01 sshd[24624]: Received disconnect from 10.20.30.40 '
+        'port 53211:11: disconnected by user\n']
+
+def _timeLines(func, lines, count):
+    start = time.perf_counter()
+    lineCnt = len(lines)
+    for i in range(count):
+        func(lines[i % lineCnt])
+    return count / (time.perf_counter() - start)
+
+def _report(name, legacyRate, fastRate):
+    print("{0:<28} {1:>14,.0f} {2:>14,.0f} {3:>8.1f}x".format(
+        name, legacyRate, fastRate, fastRate / legacyRate))
+
+def benchLineClassifier(count):
+    regex = re.compile(SFTP_LINE_REGEX)
+
+    print("{0:<28} {1:>14} {2:>14} {3:>9}".format(
+        "line classifier (lines/sec)", "regex", "tokenizer", "speedup"))
+
+    for name, lines in (("matching", MATCHING_LINES),
+                        ("non-matching", NONMATCHING_LINES)):
+        _report(name,
+            _timeLines(regex.match, lines, count),
+            _timeLines(tokenizeLine, lines, count))
+
+def benchTimestampDecoder(count):
+    timestamps = [tokenizeLine(line)[0] for line in MATCHING_LINES]
+    decoder = SftpTimestampDecoder(SftpSession.BIG_BANG)
+
+    def legacyDecode(timestamp):
+        logTime = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+        return int((logTime - SftpSession.BIG_BANG).total_seconds() * 1000)
+
+    print("{0:<28} {1:>14} {2:>14} {3:>9}".format(
+        "timestamps (decodes/sec)", "strptime", "cached", "speedup"))
+
+    _report("same minute",
+        _timeLines(legacyDecode, timestamps, count),
+        _timeLines(decoder.decode, timestamps, count))
+
+def _tracedBytes(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+# A command as sessions held them before they were stored column-wise: an
+# object with an attribute dict, its time offset a timedelta
+class _LegacyCommand:
+
+    def __init__(self, cmdType, timeOffset, target="", source=""):
+        self.cmd_type_      = cmdType
+        self.time_offset_   = timeOffset
+        self.target_        = target
+        self.source_        = source
+
+        if cmdType == SftpCommandTypes.StatusResponse:
+            self.status_    = SftpStatusTypes.Failure
+        else:
+            self.status_    = SftpStatusTypes.Success
+
+def benchSessionMemory(count):
+    parser  = SftpLogParser("")
+    records = [parser.tokenize(line) for line in MATCHING_LINES[1:]]
+
+    # Every command gets its own target string, as it would from the parser
+    def commands():
+        for i in range(count):
+            logTime, logDate, user, pid, cmdType, target, source = records[i % len(records)]
+            yield SftpCommand(cmdType, logTime + i, target + "." + str(i % 1000), source)
+
+    def commandObjects():
+        cmdList = []
+        for command in commands():
+            cmdList.append(_LegacyCommand(command.cmd_type_,
+                timedelta(milliseconds=command.time_offset_),
+                command.target_, command.source_))
+        return cmdList
+
+    def sessionColumns():
+        session = SftpSession(1, "24625", date(2020, 3, 1))
+        for command in commands():
+            session.add_command(command)
+        return session
+
+    objectBytes = _tracedBytes(commandObjects)
+    columnBytes = _tracedBytes(sessionColumns)
+
+    print("{0:<28} {1:>14} {2:>14} {3:>9}".format(
+        "memory (bytes/command)", "baseline", "columns", "saving"))
+    print("{0:<28} {1:>14,.0f} {2:>14,.0f} {3:>8.1f}x".format(
+        "{0:,} commands".format(count),
+        objectBytes / count, columnBytes / count, objectBytes / columnBytes))
+
+if __name__ == "__main__":
+    argcheck = argparse.ArgumentParser(
+        description="Micro-benchmarks for the SFTP log processing hot path.")
+
+    argcheck.add_argument('--lines',
+        metavar='lines', type=int, default=200000,
+        help='Number of lines to process per measurement (default=200000)')
+
+    args = argcheck.parse_args()
+
+    benchLineClassifier(args.lines)
+    benchTimestampDecoder(args.lines)
+    benchSessionMemory(args.lines)
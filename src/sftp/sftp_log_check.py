@@ -2,21 +2,27 @@
 
 import argparse
 import enum
+import glob
+import multiprocessing
 import os
 import os.path
-import re
 import sys
 
 from datetime import datetime
 from datetime import time
 
-file_dict = {}
+# Run as a script (./sftp_log_check.py) rather than as a module of the sftp
+# package, the package is found in the directory above this one
+if __name__ == "__main__" and not __package__:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-fhandle = sys.stdin
-
-warnMessage = []
-errMessage  = []
-outname = "logcheck.txt"
+from sftp.sftp_log_consumer import SftpLogConsumer
+from sftp.sftp_log_reader import SftpLogReader
+from sftp.sftp_log_tokenizer import SFTP_MARKER_BYTES
+from sftp.sftp_log_tokenizer import SftpOperationDecoder
+from sftp.sftp_log_tokenizer import SftpTimestampDecoder
+from sftp.sftp_log_tokenizer import tokenizeLine
+from sftp.sftp_session import SftpCommandTypes
 
 class LogOperations(enum.Enum):
     Unknown         = 0
@@ -39,100 +45,459 @@ class LogOperations(enum.Enum):
     Remove          = 17
     Set             = 18
 
-logOperationMap = {
-    "session opened "   : LogOperations.SessionStart,
-    "session closed "   : LogOperations.SessionFinish,
-    "open "             : LogOperations.FileOpen,
-    "close "            : LogOperations.FileClose,
-    "forced close "     : LogOperations.ForceFileClose,
-    "opendir "          : LogOperations.DirOpen,
-    "closedir "         : LogOperations.DirClose,
-    "forced closedir "  : LogOperations.ForceDirClose,
-    "mkdir "            : LogOperations.Mkdir,
-    "rmdir "            : LogOperations.Rmdir,
-    "sent status "      : LogOperations.StatusResponse,
-    "stat name "        : LogOperations.Stat,
-    "lstat name "       : LogOperations.LStat,
-    "statfs "           : LogOperations.StatFS,
-    "rename old "       : LogOperations.Rename,
-    "posix-rename old " : LogOperations.PosixRename,
-    "remove name "      : LogOperations.Remove,
-    "set "              : LogOperations.Set}
-
-def parseOperation(opString):
-
-    operation = LogOperations.Unknown
-    target = ""
-    opStr = ""
-    for pair in logOperationMap.items():
-        if opString.startswith(pair[0]):
-            operation = pair[1]
-            opStr = pair[0]
-
-    if operation != LogOperations.Unknown:
-        if operation == LogOperations.StatusResponse:
-            target = opString[len(opStr):]
-        elif opString[len(opStr)] == '"':
-            start = len(opStr)+1
-            for char in opString[start:]:
-                if char == "'" or char == '"':
-                    break
-                target += char
-
-    return (operation,target,)
-
-# Check the integrity of a session's opened file and directory handles 
-# (i.e. confirm they were closed), then purge the session from our map.
-def checkSessionHandles(sessionKey, sessionObj, sessionMap):
-    for fState in sessionObj.files_.items():  # iterate through file map
-        if inWindow and not sessionObj.has_warn_ and fState[1] == 1:
-            warnMessage.append(
-            ("{0},time={1},file '{2}' was opened "
-             "but never closed.").format(
-            entry[0],sessionObj.lastOpTime_,fState[0]))
-        sessionObj.has_warn_ = True
-
-    for dState in sessionObj.directories_.items():
-        if inWindow and not sessionObj.has_warn_ and dState[1] == 1:
-            warnMessage.append(
-            ("{0},time={1},directory '{2}' was opened "
-             "but never closed.").format(
-            entry[0],sessionObj.lastOpTime_,dState[0]))
-            sessionObj.has_warn_ = True
-
-    sessionMap.pop(sessionKey, 0)
-
-class SftpSession :
-
-    def __init__(self, op=LogOperations.Unknown,target="",time=datetime.now()):
-        self.lastOp_        = op
-        self.lastOpTarget_  = target
-        self.lastOpTime_    = time
-        self.files_         = {}    # map of files opened/closed in the session
-        self.directories_   = {}    # map of dirs opened/closed in the session
+# Shared with SftpLogParser; reports operations as LogOperations members
+opDecoder = SftpOperationDecoder(LogOperations)
+
+# SftpCommandTypes member => the LogOperations member of the same name
+_opTypes = {cmdType: LogOperations[cmdType.name] for cmdType in SftpCommandTypes}
+
+# The state of a client session kept while checking it: its last operation,
+# and the files and directories it has open, in the order opened (as dict
+# keys, so reports don't depend on string hashing). Handles that were
+# closed, or that failed to open, are forgotten.
+class _SessionState :
+
+    __slots__ = ("lastOp_", "lastOpTarget_", "lastOpTime_", "files_",
+                 "directories_", "has_warn_")
+
+    def __init__(self):
+        self.lastOp_        = LogOperations.Unknown
+        self.lastOpTarget_  = ""
+        self.lastOpTime_    = None
+        self.files_         = {}    # files open in the session
+        self.directories_   = {}    # directories open in the session
         self.has_warn_      = False # only report issues with the session 1 time
 
-# Set up a pre-compiled regex that matches and captures SFTP-specific log lines.
-# This will /not/ match sshd related log lines, e.g. authen, connec events
-regex = re.compile('^.* internal-sftp.*time=(....-..?-..? .*) user=(.*) pid=([0-9]+) (.*)$')
+# The report of a check, written as findings are made. Anomalies (and client
+# errors, if they are to be printed) are spooled to files beside the report
+# through large buffers, and put together under their totals once the check
+# is finished; so memory use doesn't grow with the findings, and a failed
+# check leaves the findings made so far behind. No report is written if
+# there are no findings.
+#
+# Once finish()ed, a report holds only the names of its spools and its
+# totals, so it can be handed from a worker process to the one that writes
+# the report of several checks (see writeMerged()).
+class SftpLogCheckReport :
+
+    BUFFER_BYTES = 1024 * 1024
+
+    RULE = "================================================================================\n"
+
+    def __init__(self, outName, printErrors=False):
+        self.out_name_      = outName
+        self.print_errors_  = printErrors
+        self.warn_cnt_      = 0
+        self.err_cnt_       = 0
+
+        self.warn_path_     = outName + ".anomalies"
+        self.warn_spool_    = open(self.warn_path_, "w",
+            buffering=SftpLogCheckReport.BUFFER_BYTES)
+
+        self.err_path_      = None
+        self.err_spool_     = None
+        if printErrors:
+            self.err_path_  = outName + ".errors"
+            self.err_spool_ = open(self.err_path_, "w",
+                buffering=SftpLogCheckReport.BUFFER_BYTES)
+
+    # Record an anomaly, formatted as 'fmt.format(*args)'
+    def warn(self, fmt, *args):
+        self.warn_cnt_ += 1
+        self.warn_spool_.write(fmt.format(*args))
+        self.warn_spool_.write("\n")
+
+    # Record a client error; it is only formatted if it is to be printed
+    def error(self, fmt, *args):
+        self.err_cnt_ += 1
+        if self.err_spool_:
+            self.err_spool_.write(fmt.format(*args))
+            self.err_spool_.write("\n")
+
+    # Close the spools; no more findings may be recorded
+    def finish(self):
+        if self.warn_spool_:
+            self.warn_spool_.close()
+            self.warn_spool_ = None
+        if self.err_spool_:
+            self.err_spool_.close()
+            self.err_spool_ = None
+
+    # Remove the spools, once the report has been written
+    def discard(self):
+        self.finish()
+        for path in (self.warn_path_, self.err_path_,):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def _copySpool(classobj, path, hOut):
+        with open(path, "r") as spool:
+            while True:
+                block = spool.read(SftpLogCheckReport.BUFFER_BYTES)
+                if len(block) == 0:
+                    break
+                hOut.write(block)
+
+    def close(self):
+        self.finish()
+
+        if self.warn_cnt_ > 0 or self.err_cnt_ > 0:
+            with open(self.out_name_, "w") as hOut:
+
+                hOut.write(SftpLogCheckReport.RULE)
+                hOut.write("SFTP Log Anomalies - {0} total\n".format(self.warn_cnt_))
+                hOut.write(SftpLogCheckReport.RULE)
+                self._copySpool(self.warn_path_, hOut)
+
+                hOut.write(SftpLogCheckReport.RULE)
+                hOut.write("SFTP Client Errors - {0} total\n".format(self.err_cnt_))
+                hOut.write(SftpLogCheckReport.RULE)
+
+                if self.err_path_:
+                    self._copySpool(self.err_path_, hOut)
+                else:
+                    hOut.write("xxx SFTP client error details not requested. \n")
+
+                hOut.flush()
+
+        self.discard()
+
+    # Write one report for the checks of several logs to 'outName': a
+    # summary with per-log and overall totals, then each log's anomalies and
+    # client errors under its name. 'results' holds a (logName, lineCnt,
+    # report, failure) tuple per log, where 'failure' describes why the log
+    # could not be checked (in full), or is None. The reports' spools are
+    # removed.
+    @classmethod
+    def writeMerged(classobj, outName, results, printErrors=False):
+        lineCnt = sum(result[1] for result in results)
+        warnCnt = sum(result[2].warn_cnt_ for result in results)
+        errCnt  = sum(result[2].err_cnt_ for result in results)
+
+        with open(outName, "w") as hOut:
+
+            hOut.write(classobj.RULE)
+            hOut.write(("SFTP Log Check - {0} logs, {1} lines, {2} anomalies, "
+                        "{3} client errors\n").format(
+                len(results), lineCnt, warnCnt, errCnt))
+            hOut.write(classobj.RULE)
+            for logName, logLines, report, failure in results:
+                hOut.write("{0} : {1} lines, {2} anomalies, {3} client errors{4}\n".format(
+                    logName, logLines, report.warn_cnt_, report.err_cnt_,
+                    "; FAILED - {0}".format(failure) if failure else ""))
+
+            hOut.write(classobj.RULE)
+            hOut.write("SFTP Log Anomalies - {0} total\n".format(warnCnt))
+            hOut.write(classobj.RULE)
+            for logName, logLines, report, failure in results:
+                if report.warn_cnt_ > 0:
+                    hOut.write("--- {0} - {1} anomalies\n".format(logName, report.warn_cnt_))
+                    classobj._copySpool(report.warn_path_, hOut)
+
+            hOut.write(classobj.RULE)
+            hOut.write("SFTP Client Errors - {0} total\n".format(errCnt))
+            hOut.write(classobj.RULE)
+            if printErrors:
+                for logName, logLines, report, failure in results:
+                    if report.err_cnt_ > 0:
+                        hOut.write("--- {0} - {1} client errors\n".format(logName, report.err_cnt_))
+                        classobj._copySpool(report.err_path_, hOut)
+            else:
+                hOut.write("xxx SFTP client error details not requested. \n")
+
+            hOut.flush()
+
+        for logName, logLines, report, failure in results:
+            report.discard()
+
+# Scan SFTP logs for client errors and logging anomalies, writing findings
+# to 'report' (an SftpLogCheckReport) as they are made.
+#
+# Only sessions in progress are held, and each is dropped at its
+# SessionFinish. The check scenarios will only be considered for entries
+# having timestamps between 'windowStart' and 'windowEnd'. This is intended
+# to disregard entries around the log rollover times, which for SFTP is
+# midnight, AFAIK.
+#
+# A log is checked either by check(), or as an SftpLogConsumer of the
+# SftpLogParser distilling it, so that it is read only once.
+class SftpLogChecker(SftpLogConsumer) :
+
+    WINDOW_START = time(hour=0,minute=5,second=0)
+    WINDOW_END   = time(hour=23,minute=55,second=0)
+
+    def __init__(self, report, windowStart=WINDOW_START, windowEnd=WINDOW_END):
+        self.report_        = report
+        self.window_start_  = windowStart
+        self.window_end_    = windowEnd
+        self.ts_decoder_    = SftpTimestampDecoder(datetime(2000,1,1))
+
+        # user/pid key => _SessionState
+        self.sessions_      = {}
+
+        self.line_cnt_      = 0
+        self.match_cnt_     = 0
+
+    # Check the integrity of a session's opened file and directory handles
+    # (i.e. confirm they were closed), then purge the session from our map.
+    def _checkSessionHandles(self, key, sessInfo, inWindow):
+        if inWindow and not sessInfo.has_warn_:
+            for fName in sessInfo.files_:
+                self.report_.warn(
+                    ("{0},time={1},file '{2}' was opened "
+                     "but never closed."),
+                    key,sessInfo.lastOpTime_,fName)
+                sessInfo.has_warn_ = True
+                break
+
+        if inWindow and not sessInfo.has_warn_:
+            for dName in sessInfo.directories_:
+                self.report_.warn(
+                    ("{0},time={1},directory '{2}' was opened "
+                     "but never closed."),
+                    key,sessInfo.lastOpTime_,dName)
+                sessInfo.has_warn_ = True
+                break
+
+        self.sessions_.pop(key, None)
+
+    # Check one log line (without its trailing newline)
+    def checkLine(self, line):
+
+        # Determine if line is of interest with respect to file processing
+        # operations. If it is, capture the desired fields.
+        # This will /not/ match sshd related log lines, e.g. authen, connec events
+        fields = tokenizeLine(line)
+        if not fields:
+            return
+
+        timestamp, user, pid, operation = fields
+        self.checkOperation(timestamp, user, pid, opDecoder.decode(operation))
+
+    # Check a line parsed by an SftpLogParser; 'operation' is decoded as
+    # SftpCommandTypes
+    def consume(self, timestamp, user, pid, operation):
+        cmdType, target, source = operation
+        self.checkOperation(timestamp, user, pid, (_opTypes[cmdType], target, source,))
+
+    # Check one SFTP operation, given the fields of its log line with the
+    # operation decoded by opDecoder
+    def checkOperation(self, timestamp, user, pid, opPair):
+        self.match_cnt_ += 1
+
+        # Don't check entries outside the window
+        entryDateTime = self.ts_decoder_.decodeDateTime(timestamp)
+        entryTime = entryDateTime.time()
+        inWindow = entryTime > self.window_start_ and entryTime < self.window_end_
+
+        # Construct a key that ~should~ uniqueley identify a client session.
+        # It's possible, but unlikely, the PID could wrap in a given log
+        # period, and then be re-used by the same user.
+        key = "user={0},pid={1}".format(user,pid)
+
+        # Either locate an session info for the given user & PID combo,
+        # or create and hash a new one.
+        sessInfo = self.sessions_.get(key)
+        if sessInfo is not None:
+
+            if inWindow and not sessInfo.has_warn_ and opPair[0] == LogOperations.SessionStart:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected new session "
+                     "without close of previous session for same user+PID; closing old session"),
+                    user,pid,timestamp)
+
+                self._checkSessionHandles(key, sessInfo, inWindow)
+                sessInfo.has_warn_ = True
+
+        else:
+            sessInfo = _SessionState()
+            self.sessions_[key] = sessInfo
+
+        # Note about processing of file names in conditional statements:
+        # Many Many file names carry duplicate path seperators ("/a/b//c")
+        # that do nothing but create Red Herrings, fake discrepancies
+        # between file name used for open vs close, so compress the dup
+        # path seperators using normpath().
+
+        # If the entry time fits within the winodw, perform our checks
+        if inWindow and not sessInfo.has_warn_ and sessInfo.lastOp_ == LogOperations.Unknown and opPair[0] != LogOperations.SessionStart:
+            self.report_.warn(
+                ("user={0},pid={1},time={2},detected operation '{3}' "
+                 "without prior session open"),
+                user,pid,timestamp,opPair[0])
+            sessInfo.has_warn_ = True
 
-# Define a set of 'window times' for framing the log entry checks.
-# The check scenarios will only be considered for entries having timestamps
-# between the window start : end. This is intended to disregard entries around
-# the log rollover times, which for SFTP is midnight, AFAIK
-logWindowStart = time(hour=0,minute=5,second=0)
-logWindowEnd = time(hour=23,minute=55,second=0)
-printErrors = False
+        elif opPair[0] == LogOperations.FileOpen:
+            fName = os.path.normpath(opPair[1])
+            if inWindow and not sessInfo.has_warn_ and fName in sessInfo.files_:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected open of file '{3}' "
+                     "that had been previously open"),
+                    user,pid,timestamp,fName)
+                sessInfo.has_warn_ = True
+            sessInfo.files_[fName] = None
+
+        elif opPair[0] == LogOperations.FileClose or opPair[0] == LogOperations.ForceFileClose:
+            fName = os.path.normpath(opPair[1])
+            if inWindow and not sessInfo.has_warn_ and fName not in sessInfo.files_:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected close of file '{3}' "
+                     "without prior open"),
+                    user,pid,timestamp,fName)
+                sessInfo.has_warn_ = True
+            sessInfo.files_.pop(fName, None)
+
+        elif opPair[0] == LogOperations.DirOpen:
+            dName = os.path.normpath(opPair[1])
+            if inWindow and not sessInfo.has_warn_ and dName in sessInfo.directories_:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected open of directory '{3}' "
+                     "that had been previously open"),
+                    user,pid,timestamp,dName)
+                sessInfo.has_warn_ = True
+            sessInfo.directories_[dName] = None
+
+        elif opPair[0] == LogOperations.DirClose or opPair[0] == LogOperations.ForceDirClose:
+            dName = os.path.normpath(opPair[1])
+            if inWindow and not sessInfo.has_warn_ and dName not in sessInfo.directories_:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected close of directory '{3}' "
+                     "without prior opendir"),
+                    user,pid,timestamp,dName)
+                sessInfo.has_warn_ = True
+            sessInfo.directories_.pop(dName, None)
+
+        elif opPair[0] == LogOperations.StatusResponse:
+            if inWindow and not sessInfo.has_warn_ and sessInfo.lastOp_ == LogOperations.Unknown or sessInfo.lastOp_ == LogOperations.StatusResponse:
+                self.report_.warn(
+                    ("user={0},pid={1},time={2},detected status response '{3}' "
+                     "without any prior client activity"),
+                    user,pid,timestamp,opPair[1])
+                sessInfo.has_warn_ = True
+            self.report_.error(
+                ("user={0},pid={1},time={2},"
+                 "sent status message '{3}' in response to operation '{4}'."),
+                user,
+                pid,
+                timestamp,
+                opPair[1],
+                sessInfo.lastOp_)
+
+            # The handle failed to open
+            if sessInfo.lastOp_ == LogOperations.FileOpen:
+                sessInfo.files_.pop(sessInfo.lastOpTarget_, None)
+            elif sessInfo.lastOp_ == LogOperations.DirOpen:
+                sessInfo.directories_.pop(sessInfo.lastOpTarget_, None)
+
+        elif opPair[0] == LogOperations.SessionFinish:
+
+            self._checkSessionHandles(key, sessInfo, inWindow)
+            return
+
+        sessInfo.lastOp_        = opPair[0]
+        sessInfo.lastOpTarget_  = os.path.normpath(opPair[1])
+        sessInfo.lastOpTime_    = entryDateTime
+
+    # Check the log 'fName' (a plain or compressed file, or "" for standard
+    # input)
+    def check(self, fName):
+        for line in SftpLogReader(fName):
+            try:
+
+                # Only decode lines that may be of interest
+                if SFTP_MARKER_BYTES in line:
+                    self.checkLine(line.decode("utf-8", errors="replace").rstrip("\r"))
+
+            except Exception as err:
+                print("Encountered error reading log line {0}: '{1}'.".format(
+                    self.line_cnt_ + 1,err))
+
+            finally:
+                self.line_cnt_ += 1
+
+                if (self.line_cnt_ % 1000000) == 0:
+                    print("Processed {0} lines: {1} matches so far.".format(
+                        self.line_cnt_,self.match_cnt_))
+
+    # Report sessions never closed, once all input has been checked
+    def finish(self):
+        for key, sessInfo in self.sessions_.items():     # iterate through account/pid map
+
+            # Skip the cleanup checks for sessions that are still in progress
+            # outside of the log window (i.e. good chance they'll span the log
+            # rollover so close event happens in next log file)
+            if sessInfo.lastOpTime_ is None or sessInfo.lastOpTime_.time() > self.window_end_:
+                continue
 
-lineCnt = 1
-try:
+            if not sessInfo.has_warn_:
+                # Never encountered a session close entry for this session, so it
+                # wasn't removed from the dictionary.
+                self.report_.warn(
+                    ("{0},time={1},detected session missing "
+                     "final session close"),
+                    key,sessInfo.lastOpTime_)
+                sessInfo.has_warn_ = True
 
+        self.sessions_.clear()
+
+# Check one log in a worker process of checkLogs(); see writeMerged() for
+# the result
+def _checkLog(task):
+    logName, spoolName, windowStart, windowEnd, printErrors = task
+
+    report  = SftpLogCheckReport(spoolName, printErrors)
+    checker = SftpLogChecker(report, windowStart, windowEnd)
+    failure = None
+    try:
+        checker.check(logName)
+        checker.finish()
+    except Exception as err:
+        failure = str(err)
+    finally:
+        report.finish()
+
+    return (logName, checker.line_cnt_, report, failure,)
+
+# Check several logs, each on its own as a single check would, in a pool of
+# 'workers' processes; then write one report of them all to 'outName'. Each
+# log's findings are spooled beside the report while it is checked.
+def checkLogs(logNames, outName, windowStart=SftpLogChecker.WINDOW_START,
+              windowEnd=SftpLogChecker.WINDOW_END, printErrors=False, workers=1):
+    tasks = [(logName, "{0}.{1}".format(outName, i), windowStart, windowEnd,
+              printErrors,) for i, logName in enumerate(logNames)]
+
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(_checkLog, tasks)
+    else:
+        results = [_checkLog(task) for task in tasks]
+
+    for logName, lineCnt, report, failure in results:
+        print("{0} : {1} lines, {2} anomalies, {3} client errors{4}".format(
+            logName, lineCnt, report.warn_cnt_, report.err_cnt_,
+            "; FAILED - {0}".format(failure) if failure else ""))
+
+    SftpLogCheckReport.writeMerged(outName, results, printErrors)
+    return results
+
+def main():
     argcheck = argparse.ArgumentParser(
         description="Scan SFTP logs for client errors and logging anomalies.")
 
     argcheck.add_argument('--logfile',
-        metavar='logfile', required=False,
-        help='FQN of SFTP log file to process')
+        metavar='logfile', required=False, nargs='+',
+        help='FQN of SFTP log file to process; several files, or glob '
+             'patterns, are checked in parallel into one report')
+
+    argcheck.add_argument('--report',
+        metavar='report', required=False,
+        help='FQN of the report of several log files (default=logcheck.txt)')
+
+    argcheck.add_argument('--workers',
+        metavar='workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes checking log files (default={0})'.format(
+            os.cpu_count()))
 
     argcheck.add_argument('--windowStart',
         metavar='time', required=False,
@@ -148,233 +513,60 @@ try:
 
     args = argcheck.parse_args()
 
+    logWindowStart = SftpLogChecker.WINDOW_START
     if vars(args)["windowStart"]:
         logWindowStart = datetime.strptime(args.windowStart, "%H:%M:%S").time()
 
+    logWindowEnd = SftpLogChecker.WINDOW_END
     if vars(args)["windowEnd"]:
         logWindowEnd = datetime.strptime(args.windowEnd, "%H:%M:%S").time()
 
+    printErrors = False
     if vars(args)["printErrors"]:
         printErrors = bool(args.printErrors)
 
-    name = "sftplog"
-    if vars(args)["logfile"]:
-        fhandle = open(args.logfile, "r")
-        name = args.logfile
-        outname = "{0}_logcheck.txt".format(name)
-
-    matchCnt= 0
-    line = fhandle.readline()
-    while len(line) > 0:
-        try:
-
-            # Use regex to determine if line is of interest with respect to file
-            # processing operations.
-            # If it is, capture the desired fields
-            reMatch = regex.match(line)
-            if not reMatch:
-                continue
-
-            matchCnt += 1
-            timestamp   = reMatch.group(1)
-            user        = reMatch.group(2)
-            pid         = reMatch.group(3)
-            operation   = reMatch.group(4)
-
-            # Don't check entries outside the window
-            entryDateTime = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            entryTime = entryDateTime.time()
-
-            sessInfo= None
-
-            # Construct a key that ~should~ uniqueley identify a client session.
-            # It's possible, but unlikely, the PID could wrap in a given log
-            # period, and then be re-used by the same user.
-
-            opPair = parseOperation(operation)
-
-            key = "user={0},pid={1}".format(user,pid)
-            # Either locate an session info for the given user & PID combo,
-            # or create and hash a new one.
-            if key in file_dict:
-                sessInfo = file_dict[key]
-
-                if inWindow and not sessInfo.has_warn_ and opPair[0] == LogOperations.SessionStart:
-                    warnMessage.append(
-                    ("user={0},pid={1},time={2},detected new session "
-                     "without close of previous session for same user+PID; closing old session").format(
-                    user,pid,timestamp))
-
-                    checkSessionHandles(key, sessInfo, file_dict)
-                    sessInfo.has_warn_ = True
-
-            else:
-                sessInfo = SftpSession()
-                file_dict[key] = sessInfo
-
-            # Note about processing of file names in conditional statements:
-            # Many Many file names carry duplicate path seperators ("/a/b//c")
-            # that do nothing but create Red Herrings, fake discrepancies
-            # between file name used for open vs close, so compress the dup
-            # path seperators using normpath().
-
-            inWindow = bool(entryTime > logWindowStart and entryTime < logWindowEnd)
-
-            # If the entry time fits within the winodw, perform our checks
-            if inWindow and not sessInfo.has_warn_ and sessInfo.lastOp_ == LogOperations.Unknown and opPair[0] != LogOperations.SessionStart:
-                warnMessage.append(
-                    ("user={0},pid={1},time={2},detected operation '{3}' "
-                     "without prior session open").format(
-                         user,pid,timestamp,opPair[0]))
-                sessInfo.has_warn_ = True
-
-            elif opPair[0] == LogOperations.FileOpen:
-                fName = os.path.normpath(opPair[1])
-                if inWindow and not sessInfo.has_warn_:
-                    exists = fName in sessInfo.files_
-                    status = sessInfo.files_[fName] if exists else None
-                    if exists and status == 1:
-                        warnMessage.append(
-                            ("user={0},pid={1},time={2},detected open of file '{3}' "
-                            "that had been previously open").format(
-                                user,pid,timestamp,fName))
-                        sessInfo.has_warn_ = True
-                sessInfo.files_[fName] = 1
-
-            elif opPair[0] == LogOperations.FileClose or opPair[0] == LogOperations.ForceFileClose:
-                fName = os.path.normpath(opPair[1])
-                if inWindow and not sessInfo.has_warn_:
-                    exists = fName in sessInfo.files_
-                    status = sessInfo.files_[fName] if exists else None
-                    if not exists or status != 1:
-                        warnMessage.append(
-                            ("user={0},pid={1},time={2},detected close of file '{3}' "
-                             "without prior open").format(
-                                user,pid,timestamp,fName))
-                        sessInfo.has_warn_ = True
-                sessInfo.files_[fName] = 0
-
-            elif opPair[0] == LogOperations.DirOpen:
-                dName = os.path.normpath(opPair[1])
-                if inWindow and not sessInfo.has_warn_ :
-                    exists = dName in sessInfo.directories_
-                    status = sessInfo.directories_[dName] if exists else None
-                    if exists and status == 1:
-                        warnMessage.append(
-                            ("user={0},pid={1},time={2},detected open of directory '{3}' "
-                            "that had been previously open").format(
-                                 user,pid,timestamp,dName))
-                        sessInfo.has_warn_ = True
-                sessInfo.directories_[dName] = 1
-
-            elif opPair[0] == LogOperations.DirClose or opPair[0] == LogOperations.ForceDirClose:
-                dName = os.path.normpath(opPair[1])
-                if inWindow and not sessInfo.has_warn_:
-                    exists = dName in sessInfo.directories_
-                    status = sessInfo.directories_[dName] if exists else None
-                    if not exists or status != 1:
-                        warnMessage.append(
-                            ("user={0},pid={1},time={2},detected close of directory '{3}' "
-                             "without prior opendir").format(
-                                user,pid,timestamp,dName))
-                        sessInfo.has_warn_ = True
-                sessInfo.directories_[dName] = 0
-
-            elif opPair[0] == LogOperations.StatusResponse:
-                if inWindow and not sessInfo.has_warn_ and sessInfo.lastOp_ == LogOperations.Unknown or sessInfo.lastOp_ == LogOperations.StatusResponse:
-                    warnMessage.append(
-                        ("user={0},pid={1},time={2},detected status response '{3}' "
-                         "without any prior client activity").format(
-                            user,pid,timestamp,opPair[1]))
-                    sessInfo.has_warn_ = True
-                errMessage.append(
-                    ("user={0},pid={1},time={2},"
-                    "sent status message '{3}' in response to operation '{4}'.").format(
-                    user,
-                    pid,
-                    timestamp,
-                    opPair[1],
-                    sessInfo.lastOp_))
-
-                if sessInfo.lastOp_ == LogOperations.FileOpen:
-                    sessInfo.files_[sessInfo.lastOpTarget_] = -1
-                elif sessInfo.lastOp_ == LogOperations.DirOpen:
-                    sessInfo.directories_[sessInfo.lastOpTarget_] = -1
-
-            elif opPair[0] == LogOperations.SessionFinish:
-
-                checkSessionHandles(key, sessInfo, file_dict)
-
-                continue
-
-            sessInfo.lastOp_        = opPair[0]
-            sessInfo.lastOpTarget_  = os.path.normpath(opPair[1])
-            sessInfo.lastOpTime_    = entryDateTime
-
-        except Exception as err:
-            print("Encountered error reading log line {0}: '{1}'.".format(
-                lineCnt,err))
-
-        finally:
-            lineCnt += 1
-
-            if (lineCnt % 1000000) == 0:
-                print("Processed {0} lines: {1} matches so far.".format(lineCnt,matchCnt))
-
-            line = fhandle.readline()
-
-    print("Checking cleanup of files, directories, and sessions...")
-    #import pdb
-    #pdb.set_trace()
-    for entry in file_dict.items():     # iterate through account/pid map
-
-        sessInfo = entry[1]
-
-        # Skip the cleanup checks for sessions that are still in progress
-        # outside of the log window (i.e. good chance they'll span the log
-        # rollover so close event happens in next log file)
-        if sessInfo.lastOpTime_.time() > logWindowEnd:
-            continue
-
-        if not sessInfo.has_warn_:
-            # Never encountered a session close entry for this session, so it
-            # wasn't removed from the dictionary.
-            warnMessage.append(
-            ("{0},time={1},detected session missing "
-             "final session close").format(
-                entry[0],sessInfo.lastOpTime_))
-            sessInfo.has_warn_ = True
-
-    print("SFTP log line count (total)            :  {0}".format(lineCnt))
-    print("Anomaly events (potential log issues)  :  {0}".format(len(warnMessage)))
-    print("Error events (client activity issues)  :  {0}".format(len(errMessage)))
-
-except Exception as e:
-
-    print("Encountered error at input line {0}: {1}".format(lineCnt, e))
-
-finally:
-    fhandle.close()
-
-    if len(warnMessage) > 0 or len(errMessage) > 0:
-        with open(outname, "w") as hOut:
-
-            hOut.write("================================================================================\n")
-            hOut.write("SFTP Log Anomalies - {0} total\n".format(len(warnMessage)))
-            hOut.write("================================================================================\n")
-            for warning in warnMessage:
-                hOut.write("{0}\n".format(warning))
-
-            hOut.write("================================================================================\n")
-            hOut.write("SFTP Client Errors - {0} total\n".format(len(errMessage)))
-            hOut.write("================================================================================\n")
-
-            if printErrors:
-                for error in errMessage:
-                    hOut.write("{0}\n".format(error))
-            else:
-                hOut.write("xxx SFTP client error details not requested. \n".format(len(errMessage)))
-
-            hOut.flush()
-
-
+    logNames = []
+    for pattern in args.logfile if args.logfile else []:
+        logNames.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+    if args.logfile and len(logNames) == 0:
+        argcheck.error("no log files match {0}".format(" ".join(args.logfile)))
+
+    if len(logNames) > 1 or args.report:
+        results = checkLogs(logNames, args.report if args.report else "logcheck.txt",
+            logWindowStart, logWindowEnd, printErrors, args.workers)
+        print("SFTP logs checked (total)              :  {0}".format(len(results)))
+        print("SFTP log line count (total)            :  {0}".format(
+            sum(result[1] for result in results)))
+        print("Anomaly events (potential log issues)  :  {0}".format(
+            sum(result[2].warn_cnt_ for result in results)))
+        print("Error events (client activity issues)  :  {0}".format(
+            sum(result[2].err_cnt_ for result in results)))
+        return
+
+    logName = ""
+    outName = "logcheck.txt"
+    if len(logNames) > 0:
+        logName = logNames[0]
+        outName = "{0}_logcheck.txt".format(logName)
+
+    report = SftpLogCheckReport(outName, printErrors)
+    checker = SftpLogChecker(report, logWindowStart, logWindowEnd)
+    try:
+        checker.check(logName)
+
+        print("Checking cleanup of files, directories, and sessions...")
+        checker.finish()
+
+        print("SFTP log line count (total)            :  {0}".format(checker.line_cnt_))
+        print("Anomaly events (potential log issues)  :  {0}".format(report.warn_cnt_))
+        print("Error events (client activity issues)  :  {0}".format(report.err_cnt_))
+
+    except Exception as e:
+
+        print("Encountered error at input line {0}: {1}".format(checker.line_cnt_, e))
+
+    finally:
+        report.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import os
+import os.path
+import time
+
+# A checkpoint of a run over a set of log files, so that a rerun after a
+# failure resumes where the last successful flush left off, rather than
+# from the start of each file.
+#
+# Each file is identified by its device and inode plus a hash of its head,
+# so that it is still recognized after logrotate has renamed it, while a new
+# file reusing the inode is not. The checkpoint records, for each file, the
+# offset its lines have been read up to and whether it has been read to the
+# end; and, for the file last read, the parser's open sessions and the
+# tombstones of its evicted ones at that offset (see SftpLogParser.saveState). The account IDs assigned so far are
+# kept across files.
+#
+# A checkpoint is only saved once 'flushCallback' (the distiller's flush())
+# has returned, so that everything parsed up to it has been saved. They are
+# saved every 'intervalSecs', and whenever a file has been read to the end.
+# The checkpoint file is replaced atomically.
+class SftpLogCheckpoint:
+
+    INTERVAL_SECS   = 60
+    HEAD_BYTES      = 4096
+
+    def __init__(self, path, flushCallback, intervalSecs=INTERVAL_SECS):
+        self.path_          = path
+        self.flush_callback_= flushCallback
+        self.interval_secs_ = intervalSecs
+        self.last_save_     = time.monotonic()
+        self.save_cnt_      = 0
+
+        # File identity => record of the file; see _identify()
+        self.files_         = {}
+
+        # Identity of the file last read, and the parser state there
+        self.current_       = None
+        self.accounts_      = {}
+        self.sessions_      = []
+        self.tombstones_    = []
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as fhandle:
+                saved = json.load(fhandle)
+            self.files_     = saved["files"]
+            self.current_   = saved["current"]
+            self.accounts_  = saved["accounts"]
+            self.sessions_  = saved["sessions"]
+            self.tombstones_= saved.get("tombstones", [])
+
+    # Return (identity, record) for the file 'fName' as it is now, where the
+    # record's offset is yet to be filled in; or None for standard input.
+    # Given the file open as 'fhandle', that file is identified instead, as
+    # 'fName' may since have been rotated away from it.
+    @classmethod
+    def _identify(classobj, fName, fhandle=None, headBytes=HEAD_BYTES):
+        if len(fName) == 0:
+            return None
+
+        if fhandle is not None:
+            fd = fhandle.fileno()
+            fstat = os.fstat(fd)
+            head = os.pread(fd, min(headBytes, fstat.st_size), 0)
+        else:
+            with open(fName, "rb") as fhandle:
+                fstat = os.fstat(fhandle.fileno())
+                head = fhandle.read(min(headBytes, fstat.st_size))
+
+        identity = "{0}:{1}".format(fstat.st_dev, fstat.st_ino)
+        return (identity, {
+            "path"      : os.path.abspath(fName),
+            "size"      : fstat.st_size,
+            "headBytes" : len(head),
+            "headHash"  : hashlib.sha256(head).hexdigest(),
+            "offset"    : 0,
+            "done"      : False})
+
+    # Return the identity and checkpoint record of 'fName', if the file was
+    # read before (and hasn't been truncated or replaced since).
+    def _match(self, fName):
+        found = self._identify(fName)
+        if found is None:
+            return (None, None,)
+
+        identity, record = found
+        saved = self.files_.get(identity)
+        if saved is None:
+            return (identity, None,)
+
+        # The head must not have changed, nor the file shrunk
+        if saved["headBytes"] != record["headBytes"]:
+            found = self._identify(fName, headBytes=saved["headBytes"])
+            identity, record = found
+        if (record["headHash"] != saved["headHash"] or
+                record["size"] < saved["size"]):
+            return (identity, None,)
+
+        return (identity, saved)
+
+    # Given the files a parser is to read as one log, return the files left
+    # to read, the offset to start at in the first of them, and the parser
+    # state to restore: all accounts, plus the open sessions and tombstones
+    # if the checkpoint was taken while reading these files.
+    def resume(self, fNames):
+        if isinstance(fNames, str):
+            fNames = [fNames]
+
+        state = {"accounts": self.accounts_, "sessions": [], "tombstones": []}
+        identities = set()
+        for i, fName in enumerate(fNames):
+            identity, saved = self._match(fName)
+            identities.add(identity)
+
+            if saved is None:
+                break
+
+            # Skip files read to the end, unless they have grown since
+            if saved["done"] and os.path.getsize(fName) == saved["size"]:
+                print("Checkpoint: skipping {0}, already read".format(fName))
+                continue
+
+            if self.current_ in identities:
+                state["sessions"]   = self.sessions_
+                state["tombstones"] = self.tombstones_
+            print("Checkpoint: resuming {0} at byte {1}".format(
+                fName, saved["offset"]))
+            return (fNames[i:], saved["offset"], state,)
+        else:
+            return ([], 0, state,)
+
+        if self.current_ in identities:
+            state["sessions"]   = self.sessions_
+            state["tombstones"] = self.tombstones_
+        return (fNames[i:], 0, state,)
+
+    # Record that the lines of 'fName', open as 'fhandle', have been parsed
+    # up to 'offset' (or to the end, if 'done'), saving a checkpoint if one
+    # is due. 'parser' provides the state to save.
+    def update(self, fName, fhandle, offset, done, parser):
+        if not done and time.monotonic() - self.last_save_ < self.interval_secs_:
+            return
+
+        found = self._identify(fName, fhandle)
+        if found is None:
+            return
+
+        self.flush_callback_()
+
+        identity, record = found
+        record["offset"]    = offset
+        record["done"]      = done
+        self.files_[identity] = record
+
+        state = parser.saveState()
+        self.current_       = identity
+        self.accounts_      = state["accounts"]
+        self.sessions_      = state["sessions"]
+        self.tombstones_    = state["tombstones"]
+
+        self._save()
+
+    def _save(self):
+        tmpPath = self.path_ + ".tmp"
+        with open(tmpPath, "w", encoding="utf-8") as fhandle:
+            json.dump({
+                "files"     : self.files_,
+                "current"   : self.current_,
+                "accounts"  : self.accounts_,
+                "sessions"  : self.sessions_,
+                "tombstones": self.tombstones_}, fhandle, separators=(",", ":"))
+            fhandle.flush()
+            os.fsync(fhandle.fileno())
+        os.replace(tmpPath, self.path_)
+
+        self.last_save_ = time.monotonic()
+        self.save_cnt_ += 1
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+import abc
+
+# The interface of a consumer of the SFTP operations an SftpLogParser reads,
+# registered with SftpLogParser.addConsumer() alongside its account and
+# session callbacks, so that one read of a log feeds several passes over it
+# (e.g. distilling it and checking it for anomalies):
+#
+#   consume(timestamp, user, pid, operation)    per internal-sftp log line
+#   finish()                                    once the log has been parsed
+#
+# The line's fields are as tokenizeLine() splits them: the timestamp, user
+# and pid are the strings logged, while 'operation' is the (cmdType, target,
+# source) triple SftpOperationDecoder decodes, with cmdType an
+# SftpCommandTypes member. Lines are consumed in log order, before they are
+# applied to the parser's sessions. An exception raised by a consumer is
+# reported against the line, and doesn't keep the line from the parser or
+# other consumers.
+class SftpLogConsumer(abc.ABC):
+
+    @abc.abstractmethod
+    def consume(self, timestamp, user, pid, operation):
+        pass
+
+    def finish(self):
+        pass
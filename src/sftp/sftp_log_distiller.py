@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+import abc
+
+from sftp.sftp_session    import SftpSession
+from sftp.sftp_log_writer import SftpLogBatch
+from sftp.sftp_log_writer import SftpLogCoalescer
+from sftp.sftp_log_writer import SftpLogFlushStats
+
+# The interface of a sink for distilled accounts and sessions, as fed by
+# SftpLogParser (or SftpLogParserPool) in delta mode:
+#
+#   connect()                                   before parsing starts
+#   load_accounts()                             the accounts already saved
+#   process_account(acctId, account, state)     'N' new, 'X' existing
+#   process_session(sessId, session, state)     'N' new, 'X' existing, 'F' final
+#   poll()                                      while waiting for input
+#   flush()                                     at checkpoints
+#   cleanup()                                   once parsing is done
+#
+# Session documents are deltas (SftpSession.toDeltaJSON), to be merged by
+# sessionId and command sequenceId (SftpSession.mergeJSON). flush() and
+# cleanup() must write out everything still pending, and raise if anything
+# could not be written; flush() must not return until it has been. See
+# SftpLogCheckpoint. poll() writes out whatever has been pending for too
+# long, so that updates are written with bounded latency even when no more
+# input arrives. load_accounts() returns the accounts already in the sink, as
+# account name => ID, for SftpAccountRegistry.preload(); a sink that can't
+# look them up returns none.
+class SftpLogDistiller(abc.ABC):
+
+    def connect(self):
+        pass
+
+    def load_accounts(self):
+        return {}
+
+    @abc.abstractmethod
+    def process_account(self, acctId, account, state):
+        pass
+
+    @abc.abstractmethod
+    def process_session(self, sessId, session, state):
+        pass
+
+    def poll(self):
+        pass
+
+    @abc.abstractmethod
+    def flush(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+# A distiller that saves sessions in batches, which the PostgreSQL and CouchDb
+# sinks share. Session updates are merged into a cache of pending documents
+# and batched by SftpLogBatch (held back by an SftpLogCoalescer with
+# 'coalesce' set); a batch that is due is handed to the sink's writers. Once
+# handed over, a session's cached document keeps only its header, to collect
+# the commands that follow; final sessions are dropped from the cache.
+#
+# A sink provides process_account() and these primitives:
+#
+#   _flushAccounts()                    submit the pending account batch
+#   _submitSessions(sessDocs, finalIds, batchBytes, batchStart)
+#                                       submit a batch of session documents
+#
+# to the SftpLogWriters in 'writers_', which it starts in connect(),
+# and may hook _addSession(sessId, session), called for each session that
+# joins the cache, and _retainSession(session), which returns what stays
+# cached of a session once handed over.
+class SftpLogBatchDistiller(SftpLogDistiller):
+
+    def __init__(self, batchSize=SftpLogBatch.MAX_DOCS,
+                 batchBytes=SftpLogBatch.MAX_BYTES,
+                 batchSecs=SftpLogBatch.MAX_SECS, coalesce=False,
+                 checkpointSecs=SftpLogCoalescer.CHECKPOINT_SECS,
+                 acctBatchSize=None):
+
+        if acctBatchSize is None:
+            acctBatchSize = batchSize
+        self.account_batch_     = SftpLogBatch(acctBatchSize, None, batchSecs)
+
+        self.session_cache_     = {}
+        self.session_batch_     = SftpLogBatch(batchSize, batchBytes, batchSecs)
+        self.session_final_     = set()
+        self.session_peak_cnt_  = 0
+
+        # With 'coalesce' set, each session is written once it is final, or
+        # at a checkpoint if it stays open for long, rather than whenever it
+        # has been updated.
+        self.coalescer_         = None
+        if coalesce:
+            self.coalescer_     = SftpLogCoalescer(checkpointSecs)
+
+        # Totals of the session batches saved
+        self.flush_stats_       = SftpLogFlushStats()
+
+        self.writers_           = []
+
+    @abc.abstractmethod
+    def _flushAccounts(self):
+        pass
+
+    @abc.abstractmethod
+    def _submitSessions(self, sessDocs, finalIds, batchBytes, batchStart):
+        pass
+
+    def _addSession(self, sessId, session):
+        pass
+
+    # Both sinks save the commands of each update, and merge them with those
+    # already saved, so only the session header need be kept
+    def _retainSession(self, session):
+        header = {key: value for key, value in session.items() if key != "commands"}
+        header["commands"] = []
+        return header
+
+    # Hand the batch's documents over to the sink. Final sessions are done
+    # with altogether.
+    def _flushSessions(self):
+        if len(self.session_batch_) == 0:
+            return
+
+        sessDocs = []
+        finalIds = self.session_batch_.ids_ & self.session_final_
+        for sid in self.session_batch_:
+            session = self.session_cache_[sid]
+            sessDocs.append(session)
+
+            if sid in finalIds:
+                del self.session_cache_[sid]
+            else:
+                self.session_cache_[sid] = self._retainSession(session)
+
+        self.session_final_ -= self.session_batch_.ids_
+
+        batchBytes = self.session_batch_.bytes_
+        batchStart = self.session_batch_.start_
+        self.session_batch_.clear()
+
+        self._submitSessions(sessDocs, finalIds, batchBytes, batchStart)
+
+    # Process a JSON document 'session' with the specified 'state', either:
+    #   'N' => new
+    #   'X' => existing
+    #   'F' => final; the session is evicted from the cache once saved
+    # The document may be a full session or a delta (SftpSession.toDeltaJSON);
+    # either way it is merged into the pending document for the session.
+    def process_session(self, sessId, session, state):
+        try:
+
+            if sessId in self.session_cache_:
+                SftpSession.mergeJSON(self.session_cache_[sessId], session)
+            else:
+                self._addSession(sessId, session)
+                self.session_cache_[sessId] = session
+                if len(self.session_cache_) > self.session_peak_cnt_:
+                    self.session_peak_cnt_ = len(self.session_cache_)
+
+            if state == 'F':
+                self.session_final_.add(sessId)
+            else:
+                self.session_final_.discard(sessId)
+
+            # Hold the update back while coalescing, unless the session is
+            # already in the batch
+            if (self.coalescer_ is not None and sessId not in self.session_batch_ and
+                    not self.coalescer_.update(sessId, state == 'F')):
+                return
+
+            # Append the session update to the batch. The pending document
+            # counts in full when it joins the batch, and then grows by the
+            # commands in each update.
+            if sessId in self.session_batch_:
+                docBytes = SftpLogBatch.estimateBytes(session)
+            else:
+                docBytes = SftpLogBatch.estimateBytes(self.session_cache_[sessId])
+            self.session_batch_.add(sessId, docBytes)
+
+            if self.session_batch_.isFull():
+                self._flushSessions()
+
+        except Exception as err:
+            print("Error in {0}::process_session : {1}".format(
+                type(self).__name__, err))
+
+    # Add sessions held back while coalescing to the batch
+    def _batchHeldSessions(self, sessIds):
+        for sid in sessIds:
+            self.session_batch_.add(sid,
+                SftpLogBatch.estimateBytes(self.session_cache_[sid]))
+            if self.session_batch_.isFull():
+                self._flushSessions()
+
+    # Process any pending updates in the batch lists, including those held
+    # back while coalescing
+    def _flushPending(self):
+        self._flushAccounts()
+
+        if self.coalescer_ is not None:
+            self._batchHeldSessions(self.coalescer_.drain())
+
+        self._flushSessions()
+
+    # Flush the batches that are due by age, and checkpoint sessions held
+    # back for long enough; called while waiting for more of a followed log
+    def poll(self):
+        if self.account_batch_.isFull():
+            self._flushAccounts()
+
+        if self.coalescer_ is not None:
+            self._batchHeldSessions(self.coalescer_.due())
+
+        if self.session_batch_.isFull():
+            self._flushSessions()
+
+    # Save all pending updates, and wait until they have been saved
+    def flush(self):
+        self._flushPending()
+
+        errorCnt = 0
+        for writer in self.writers_:
+            writer.drain()
+            errorCnt += writer.error_cnt_
+
+        if errorCnt > 0:
+            raise RuntimeError(
+                "{0} batches could not be saved".format(errorCnt))
+
+    # Save all pending updates and stop the writers; returns the number of
+    # batches that could not be saved, which the sink raises on once it has
+    # closed its connection
+    def _closeWriters(self):
+        self._flushPending()
+
+        errorCnt = 0
+        for writer in self.writers_:
+            writer.close()
+            errorCnt += writer.error_cnt_
+        self.writers_ = []
+
+        print("{0} cached sessions (peak) : {1}".format(
+            type(self).__name__, self.session_peak_cnt_))
+        print("{0} session {1}".format(
+            type(self).__name__, self.flush_stats_.summary()))
+
+        return errorCnt
@@ -2,140 +2,381 @@
 
 import os
 import os.path
-import re
-import sys
+import time
 
 from sftp.sftp_account import SftpAccount
+from sftp.sftp_account import SftpAccountRegistry
 from sftp.sftp_session import SftpCommand
 from sftp.sftp_session import SftpCommandTypes
-from sftp.sftp_session import SftpCommandTypesMap
 from sftp.sftp_session import SftpSession
+from sftp.sftp_log_reader import SftpLogReader
+from sftp.sftp_log_tokenizer import SFTP_MARKER_BYTES
+from sftp.sftp_log_tokenizer import SftpOperationDecoder
+from sftp.sftp_log_tokenizer import SftpTimestampDecoder
+from sftp.sftp_log_tokenizer import tokenizeLine
 
-from datetime import timedelta
-from datetime import datetime
-from datetime import time
+from datetime import date
 
 class SftpLogParser :
 
-    def __init__(self, fName):
+    # 'fName' names the log to parse: a plain or compressed file, a list of
+    # them to be read back to back as one log, or "" for standard input.
+    #
+    # When 'deltaMode' is set, the session callback receives only the commands
+    # added or changed since the previous callback for that session (see
+    # SftpSession.toDeltaJSON), rather than the entire session document.
+    # Pass a shared 'acctRegistry' to keep account IDs consistent across
+    # parsers; by default each parser numbers its accounts from 1.
+    #
+    # Sessions are evicted once they have seen SessionFinish or, when
+    # 'idleTimeout' (seconds of log time) is set, once they have been idle
+    # for that long. A session's last callback has the state 'F': the one
+    # for its SessionFinish, or an (empty) one when it is evicted idle. The
+    # parser then only holds a tombstone of it, so that a session showing up
+    # again under the same key (the same account and pid, on the same or the
+    # next day) carries on from it, with its commands numbered on from those
+    # already reported.
+    #
+    # With 'follow' set, the (last) log file is followed as it grows and is
+    # rotated, like tail -F, until stop() is called; see SftpLogReader.
+    #
+    # Further passes over the log, such as anomaly checks, can be made in the
+    # same read of it by registering them with addConsumer().
+    def __init__(self, fName, deltaMode=False, acctRegistry=None, idleTimeout=None,
+                 follow=False):
         self.fname_     = fName
-        self.regex_     = re.compile('^.* internal-sftp.*time=(....-..?-..? .*) user=(.*) pid=([0-9]+) (.*)$')
+        self.delta_mode_= deltaMode
+        self.acct_reg_  = acctRegistry if acctRegistry else SftpAccountRegistry()
         self.acct_map_  = {}
         self.sess_map_  = {}
 
-    def _parseSftpOp(self, opString):
-
-        operation = SftpCommandTypes.Unknown
-        target = ""
-        opStr = ""
-        for pair in SftpCommandTypesMap.items():
-            if opString.startswith(pair[0]):
-                operation = pair[1]
-                opStr = pair[0]
-
-        if operation != SftpCommandTypes.Unknown:
-            if operation == SftpCommandTypes.StatusResponse:
-                target = opString[len(opStr):]
-
-            elif operation == SftpCommandTypes.SessionStart:
-                # Grab ID address from session start command output
-                ipStart = opString.find("[") + 1
-                ipEnd   = opString.rfind("]")
-                target  = opString[ipStart:ipEnd]
-
-            elif opString[len(opStr)] == '"':
-                start = len(opStr)+1
-                for char in opString[start:]:
-                    if char == "'" or char == '"':
-                        break
-                    target += char
-
-        return (operation,target,)
-
+        # Lookup key of an evicted session => its header and last command;
+        # see _dropSession(). Pruned once the key's date is out of reach.
+        self.tombstones_    = {}
+        self.tomb_date_     = 0
+        self.ts_decoder_= SftpTimestampDecoder(SftpSession.BIG_BANG)
+        self.op_decoder_= SftpOperationDecoder()
+
+        self.idle_timeout_  = int(idleTimeout * 1000) if idleTimeout else 0
+        self.next_sweep_    = 0
+        self.peak_sessions_ = 0
+
+        # While following: the reader, and the latest log time as of when the
+        # reader last caught up with the log (log time, monotonic time)
+        self.follow_        = follow
+        self.reader_        = None
+        self.idle_since_    = (0, 0,)
+
+        # SftpLogConsumers fed each line parsed, and the lines read by parse()
+        self.consumers_     = []
+        self.line_cnt_      = 0
+
+    # Feed the SFTP operations parsed to 'consumer' (an SftpLogConsumer) as
+    # well, and finish() it once the log has been parsed
+    def addConsumer(self, consumer):
+        self.consumers_.append(consumer)
+
+    # Determine if line is of interest with respect to file processing
+    # operations. If it is, return the captured fields as a record of
+    # (logTime, logDate, user, pid, cmdType, target, source), where logTime
+    # is in milliseconds since SftpSession.BIG_BANG and logDate is a date
+    # ordinal; otherwise None.
+    def tokenize(self, line):
+        fields = tokenizeLine(line)
+        if not fields:
+            return None
+
+        return self._decodeFields(fields)
+
+    # Decode the fields tokenizeLine() split a line into; see tokenize()
+    def _decodeFields(self, fields):
+        timestamp, user, pid, operation = fields
+
+        logTime, logDate = self.ts_decoder_.decode(timestamp)
+
+        cmdType, target, source = self.op_decoder_.decode(operation)
+
+        return (logTime, logDate, user, pid, cmdType, target, source,)
+
+    def _resolveAccount(self, user, accountCallback):
+        if user in self.acct_map_:
+            return self.acct_map_[user]
+
+        accountId, isNew = self.acct_reg_.lookup(user)
+        account = SftpAccount(accountId, user)
+        self.acct_map_[user] = account
+        if isNew:
+            accountCallback(accountId, SftpAccount.toJSON(account), 'N')
+
+        return account
+
+    def _feedConsumers(self, fields, record, lineCnt):
+        operation = record[4:]
+        for consumer in self.consumers_:
+            try:
+                consumer.consume(fields[0], fields[1], fields[2], operation)
+            except Exception as err:
+                print("Encountered error consuming log line {0}: '{1}'.".format(
+                    lineCnt,err))
+
+    # Session lookup by key (account, pid, date); returns a triple of
+    # (session, sessionKey, sessionAction), where sessionKey is the persisted
+    # key (SftpSession.sess_id_).
+    def _resolveSession(self, account, pid, logDate):
+
+        # Construct a key that ~should~ uniqueley identify a client session.
+        # It's possible, but unlikely, the PID could wrap in a given log
+        # period, and then be re-used by the same user.
+
+        sessionDaySpan = 2
+
+        if logDate > self.tomb_date_:
+            self._pruneTombstones(logDate - sessionDaySpan + 1)
+            self.tomb_date_ = logDate
+
+        # Try to handle log rollover event by considering
+        # sessionDaySpan days back in time when probing for key
+        for i in range(sessionDaySpan):
+            key = SftpSession.lookup_key(account.acct_id_, pid, logDate - i)
+            session = self.sess_map_.get(key)
+            if session:
+                return (session, session.sess_id_, "X",)
+
+            tombstone = self.tombstones_.pop(key, None)
+            if tombstone:
+                session = self._reviveSession(account.acct_id_, pid, logDate - i,
+                    tombstone)
+                return (session, session.sess_id_, "X",)
+
+        session = self._addSession(account.acct_id_, pid, logDate)
+        return (session, session.sess_id_, "N",)
+
+    def _addSession(self, acctId, pid, dateOrdinal):
+        session = SftpSession(acctId, pid, date.fromordinal(dateOrdinal))
+        self.sess_map_[session.sess_key_] = session
+        if len(self.sess_map_) > self.peak_sessions_:
+            self.peak_sessions_ = len(self.sess_map_)
+        return session
+
+    # Carry on with an evicted session from its tombstone. It holds the last
+    # command already reported, so that a status response can still update
+    # it, but is only dirty from the next one.
+    def _reviveSession(self, acctId, pid, dateOrdinal, tombstone):
+        session = self._addSession(acctId, pid, dateOrdinal)
+        (session.seq_base_, session.start_time_, session.end_time_,
+            session.ip_addr_, cmdType, timeOffset, target, source,
+            status) = tombstone
+
+        session.cmd_types_.append(cmdType)
+        session.time_offsets_.append(timeOffset)
+        session.statuses_.append(status)
+        session.targets_.append(target)
+        session.sources_.append(source)
+        session.dirty_from_ = 1
+        return session
+
+    # Drop the tombstones of sessions dated before 'firstDate'
+    def _pruneTombstones(self, firstDate):
+        for key in [key for key in self.tombstones_ if key[2] < firstDate]:
+            del self.tombstones_[key]
+
+    def _addCommand(self, session, logTime, cmdType, target, source):
+        if cmdType == SftpCommandTypes.SessionStart:
+            session.start_time_ = logTime
+        elif cmdType == SftpCommandTypes.SessionFinish:
+            session.end_time_ = logTime
+
+        session.add_command(SftpCommand(cmdType, logTime, target, source))
+        session.last_time_ = logTime
+
+    # Drop the session, leaving its tombstone: the session header, and the
+    # sequence ID and columns of its last command
+    def _dropSession(self, session):
+        self.sess_map_.pop(session.sess_key_, None)
+
+        last = session.command_count() - 1
+        if last < 0:
+            return
+        self.tombstones_[session.sess_key_] = (
+            session.seq_base_ + last, session.start_time_, session.end_time_,
+            session.ip_addr_, session.cmd_types_[last],
+            session.time_offsets_[last], session.targets_[last],
+            session.sources_[last], session.statuses_[last],)
+
+    # Hand the session to the callback a final time (state 'F') and drop it
+    def _evictSession(self, session, sessionCallback):
+        self._dropSession(session)
+        sessionCallback(session.sess_id_, self._sessionToJSON(session), "F")
+
+    # Evict sessions that have been idle for longer than the idle timeout,
+    # as of 'logTime'. The scan is repeated at most every 1/4 timeout.
+    def _sweepIdleSessions(self, logTime, sessionCallback):
+        if not self.idle_timeout_ or logTime < self.next_sweep_:
+            return
+
+        self.next_sweep_ = logTime + self.idle_timeout_ // 4
+        idleBefore = logTime - self.idle_timeout_
+        for session in list(self.sess_map_.values()):
+            if session.last_time_ < idleBefore:
+                self._evictSession(session, sessionCallback)
+
+    def _sessionToJSON(self, session):
+        if self.delta_mode_:
+            return SftpSession.toDeltaJSON(session)
+        return SftpSession.toJSON(session)
+
+    # Apply the records tokenized from one chunk of a log (see
+    # SftpLogParserPool.parseChunked) to the sessions known to this parser.
+    # 'users' lists the chunk's account names in order of first appearance;
+    # 'groups' maps (user, pid) to that pair's records in log order. Sessions
+    # only interact through their own (account, pid) key, so applying each
+    # group in turn is equivalent to applying the chunk line by line. Each
+    # session touched by the chunk gets a single callback, which is its final
+    # one if it finished. Idle sessions are swept once per chunk.
+    def stitch(self, users, groups, accountCallback, sessionCallback):
+        for user in users:
+            self._resolveAccount(user, accountCallback)
+
+        lastTime = 0
+        touched = {}
+        for (user, pid), records in groups.items():
+            account = self.acct_map_[user]
+            for logTime, logDate, cmdType, target, source in records:
+                session, sessionKey, sessionAction = self._resolveSession(
+                    account, pid, logDate)
+                self._addCommand(session, logTime, cmdType, target, source)
+                if id(session) not in touched:
+                    touched[id(session)] = (session, sessionKey, sessionAction,)
+
+                if cmdType == SftpCommandTypes.SessionFinish:
+                    del touched[id(session)]
+                    self._dropSession(session)
+                    sessionCallback(sessionKey, self._sessionToJSON(session), "F")
+
+                if logTime > lastTime:
+                    lastTime = logTime
+
+        for session, sessionKey, sessionAction in touched.values():
+            sessionCallback(sessionKey, self._sessionToJSON(session), sessionAction)
+
+        self._sweepIdleSessions(lastTime, sessionCallback)
+
+    # The state to resume parsing from (see SftpLogCheckpoint): every account
+    # registered so far, the open sessions, and the tombstones of evicted ones
+    def saveState(self):
+        sessions = []
+        for session in self.sess_map_.values():
+            sessions.append({
+                "lastTime"  : session.last_time_,
+                "session"   : SftpSession.toJSON(session)})
+
+        return {
+            "accounts"  : self.acct_reg_.accounts(),
+            "sessions"  : sessions,
+            "tombstones": [[list(key), list(tombstone)]
+                for key, tombstone in self.tombstones_.items()]}
+
+    # Restore a state returned by saveState(). Restored sessions are dirty,
+    # so each one's next callback holds the whole session.
+    def restoreState(self, state):
+        self.acct_reg_.preload(state["accounts"])
+
+        for saved in state["sessions"]:
+            session = SftpSession.fromJSON(saved["session"])
+            session.last_time_ = saved["lastTime"]
+            self.sess_map_[session.sess_key_] = session
+
+        if len(self.sess_map_) > self.peak_sessions_:
+            self.peak_sessions_ = len(self.sess_map_)
+
+        for key, tombstone in state.get("tombstones", []):
+            self.tombstones_[tuple(key)] = tuple(tombstone)
+
+    # Called while waiting for more of a followed log. With no new lines, log
+    # time is taken to advance with the wall clock from the latest log time
+    # seen, so that idle sessions are still evicted.
+    def _idle(self, sessionCallback, idleCallback):
+        if self.idle_timeout_ and len(self.sess_map_) > 0:
+            lastTime = max(session.last_time_ for session in self.sess_map_.values())
+            if lastTime != self.idle_since_[0]:
+                self.idle_since_ = (lastTime, time.monotonic(),)
+
+            idleMs = int((time.monotonic() - self.idle_since_[1]) * 1000)
+            self._sweepIdleSessions(lastTime + idleMs, sessionCallback)
+
+        if idleCallback:
+            idleCallback()
+
+    # Stop following the log; parse() returns once the lines read so far
+    # have been parsed. May be called from a signal handler.
+    def stop(self):
+        if self.reader_:
+            self.reader_.stop()
 
     # Return a dictionary hashed by session key, which is MD5 of :
     #       <start_time>_<acct_name>_<pid>
-    def parse(self, accountCallback, sessionCallback):
+    #
+    # With a 'checkpoint' (SftpLogCheckpoint), parsing resumes from where
+    # the checkpoint left off, and checkpoints are saved as it goes. While
+    # following, 'idleCallback()' is called whenever the parser has caught up
+    # with the log and is waiting for more. Registered consumers are fed each
+    # SFTP operation before the parser applies it, and are finished once the
+    # whole log has been parsed.
+    #
+    # A line that can't be parsed is reported and skipped. Any other failure,
+    # such as a checkpoint whose flush fails, is raised once reported.
+    def parse(self, accountCallback, sessionCallback, checkpoint=None,
+              idleCallback=None):
         lineCnt = 0
 
-        accountId  = 1
-
         try:
-            fhandle = sys.stdin
-            if len(self.fname_) > 0:
-                fhandle = open(self.fname_, "r")
+            fNames, startOffset, blockCallback = self.fname_, 0, None
+            if checkpoint:
+                fNames, startOffset, state = checkpoint.resume(self.fname_)
+                self.restoreState(state)
+                blockCallback = lambda fName, fhandle, offset, done: \
+                    checkpoint.update(fName, fhandle, offset, done, self)
+
+            self.reader_ = SftpLogReader(fNames, startOffset=startOffset,
+                blockCallback=blockCallback, follow=self.follow_,
+                idleCallback=lambda: self._idle(sessionCallback, idleCallback))
 
             matchCnt= 0
-            line = fhandle.readline()
-            while len(line) > 0:
+            for line in self.reader_:
                 try:
 
-                    # Use regex to determine if line is of interest with respect to file
-                    # processing operations.
-                    # If it is, capture the desired fields
-                    reMatch = self.regex_.match(line)
-                    if not reMatch:
+                    # Only decode lines that may be of interest
+                    if SFTP_MARKER_BYTES not in line:
+                        continue
+
+                    fields = tokenizeLine(
+                        line.decode("utf-8", errors="replace").rstrip("\r"))
+                    if not fields:
                         continue
 
+                    record = self._decodeFields(fields)
                     matchCnt += 1
-                    timestamp   = reMatch.group(1)
-                    user        = reMatch.group(2)
-                    pid         = reMatch.group(3)
-                    operation   = reMatch.group(4)
-
-                    logTime = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-
-                    account = None
-                    if user in self.acct_map_:
-                        account = self.acct_map_[user]
-                    else:
-                        account = SftpAccount(accountId, user)
-                        self.acct_map_[user] = account
-                        accountCallback(accountId, SftpAccount.toJSON(account), 'N')
-                        accountId += 1
-
-                    # Session lookup by key (account, pid, date)
-
-                    # Construct a key that ~should~ uniqueley identify a client session.
-                    # It's possible, but unlikely, the PID could wrap in a given log
-                    # period, and then be re-used by the same user.
-
-                    session = None
-                    sessionKey = None
-                    sessionDaySpan = 2
-                    sessionAction = ""
-
-                    # Try to handle log rollover event by considering
-                    # sessionDaySpan days back in time when probing for key
-                    for i in range(sessionDaySpan):
-                        logDate = logTime.date() - timedelta(i)
-                        sessionKey = SftpSession.calculate_key(account.acct_id_, pid, logDate)
-                        if sessionKey in self.sess_map_:
-                            session = self.sess_map_[sessionKey]
-                            sessionAction = "X"
-                            break
-
-                    if not session:
-                        session = SftpSession(account.acct_id_, pid, logTime.date())
-                        sessionKey = session.sess_id_
-                        self.sess_map_[sessionKey] = session
-                        sessionAction = "N"
-
-                    cmdPair = self._parseSftpOp(operation)
-
-                    if cmdPair[0] == SftpCommandTypes.SessionStart:
-                        session.start_time_ = logTime - SftpSession.BIG_BANG
-                    elif cmdPair[0] == SftpCommandTypes.SessionFinish:
-                        session.end_time_ = logTime - SftpSession.BIG_BANG
-
-
-                    cmdOffset = logTime - SftpSession.BIG_BANG
-                    command = SftpCommand(cmdPair[0], cmdOffset, cmdPair[1])
-
-                    session.add_command(command)
+
+                    if self.consumers_:
+                        self._feedConsumers(fields, record, lineCnt)
+
+                    logTime, logDate, user, pid, cmdType, target, source = record
+
+                    account = self._resolveAccount(user, accountCallback)
+
+                    session, sessionKey, sessionAction = self._resolveSession(
+                        account, pid, logDate)
+
+                    self._addCommand(session, logTime, cmdType, target, source)
+
+                    if cmdType == SftpCommandTypes.SessionFinish:
+                        self._dropSession(session)
+                        sessionAction = "F"
 
                     sessionCallback(
-                        sessionKey, SftpSession.toJSON(session), sessionAction)
+                        sessionKey, self._sessionToJSON(session), sessionAction)
+
+                    self._sweepIdleSessions(logTime, sessionCallback)
 
                 except Exception as err:
                     print("Encountered error reading log line {0}: '{1}'.".format(
@@ -147,14 +388,19 @@ class SftpLogParser :
                     if (lineCnt % 1000000) == 0:
                         print("Processed {0} lines: {1} matches so far.".format(lineCnt,matchCnt))
 
-                    line = fhandle.readline()
-
             print("SFTP log line count (total) : {0}".format(lineCnt))
+            print("SFTP live sessions (peak)   : {0}".format(self.peak_sessions_))
+
+            for consumer in self.consumers_:
+                consumer.finish()
 
         except Exception as e:
 
+            # Reading the log, saving a checkpoint or flushing the distiller
+            # failed, so the log was only parsed in part; the run must fail
             print("Encountered error at input line {0}: {1}".format(lineCnt, e))
+            raise
 
         finally:
-            fhandle.close()
 
+            self.line_cnt_ = lineCnt
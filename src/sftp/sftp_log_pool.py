@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import collections
+import concurrent.futures
+import os
+
+from sftp.sftp_log_parser import SftpLogParser
+from sftp.sftp_log_reader import SftpLogReader
+from sftp.sftp_log_tokenizer import SFTP_MARKER_BYTES
+
+# Split 'fName' into (fName, start, end) byte ranges of roughly 'chunkSize'
+# bytes, each of which begins at the start of a line. A compressed file
+# can't be split, so it is a single range with no 'end'.
+def _chunkRanges(fName, chunkSize):
+    if SftpLogReader.isCompressed(fName):
+        return [(fName, 0, None,)]
+
+    ranges = []
+    size = os.path.getsize(fName)
+    with open(fName, "rb") as fhandle:
+        start = 0
+        while start < size:
+            end = start + chunkSize
+            if end < size:
+                fhandle.seek(end)
+                fhandle.readline()
+                end = fhandle.tell()
+            else:
+                end = size
+            ranges.append((fName, start, end,))
+            start = end
+    return ranges
+
+# Yield (offset, line) for the lines of the byte range 'start' to 'end' of
+# the plain file 'fName', or of the whole of 'fName' if 'end' is None
+def _chunkLines(fName, start, end):
+    if end is None:
+        offset = 0
+        for line in SftpLogReader(fName):
+            yield (offset, line,)
+            offset += len(line) + 1
+        return
+
+    with open(fName, "rb") as fhandle:
+        fhandle.seek(start)
+        pos = start
+        while pos < end:
+            line = fhandle.readline()
+            if len(line) == 0:
+                break
+            yield (pos, line,)
+            pos += len(line)
+
+# Tokenize the lines of one (fName, start, end) chunk. Returns the line
+# count, the account names in order of first appearance, and the records
+# grouped by (user, pid) in log order; see SftpLogParser.stitch().
+def _tokenizeChunk(chunk):
+    fName, start, end = chunk
+    parser = SftpLogParser(fName)
+    users  = []
+    seen   = set()
+    groups = {}
+
+    lineCnt = 0
+    for offset, line in _chunkLines(fName, start, end):
+        lineCnt += 1
+
+        if SFTP_MARKER_BYTES not in line:
+            continue
+
+        try:
+            record = parser.tokenize(
+                line.decode("utf-8", errors="replace").rstrip("\r\n"))
+        except Exception as err:
+            print("Encountered error reading log line at offset {0}: '{1}'.".format(
+                offset, err))
+            continue
+
+        if not record:
+            continue
+
+        logTime, logDate, user, pid, cmdType, target, source = record
+        groupKey = (user, pid,)
+        if groupKey not in groups:
+            if user not in seen:
+                seen.add(user)
+                users.append(user)
+            groups[groupKey] = []
+        groups[groupKey].append((logTime, logDate, cmdType, target, source,))
+
+    return (lineCnt, users, groups,)
+
+# Parse SFTP logs in a pool of worker processes. Workers do the per-line
+# work (regex, timestamp and operation decoding) on chunks of the log; the
+# fragments are then stitched into sessions, in log order, by a single
+# parser in the calling process, so the result matches a sequential run of
+# that parser, including rollover, status-response attachment and sessions
+# that span the files of a rotated log. Every callback is made in the
+# calling process, which owns the single (batched) distiller.
+#
+# A chunk's records are stitched a session at a time, so a session that
+# goes idle within one chunk may be carried on where a sequential run
+# evicts it and later revives it; the merged sessions are the same.
+#
+# A worker that dies (e.g. killed for running out of memory) breaks the
+# pool, and the parse fails with BrokenProcessPool rather than waiting for
+# the chunks it had.
+class SftpLogParserPool:
+
+    CHUNK_SIZE       = 64 * 1024 * 1024
+
+    def __init__(self, workers, deltaMode=False, idleTimeout=None):
+        self.workers_       = workers
+        self.delta_mode_    = deltaMode
+        self.idle_timeout_  = idleTimeout
+
+    # Parse 'files', in the order given, as one log, in chunks of about
+    # 'chunkSize' bytes. Given 'acctRegistry', accounts are numbered by it.
+    def parse(self, files, accountCallback, sessionCallback, acctRegistry=None,
+              chunkSize=CHUNK_SIZE):
+        if len(files) == 0:
+            return
+
+        parser = SftpLogParser(files, self.delta_mode_, acctRegistry,
+            self.idle_timeout_)
+        self.parseChunked(parser, accountCallback, sessionCallback, chunkSize)
+
+    # Stitch the chunk tokenized by 'future'; returns its line count
+    def _stitchChunk(self, parser, future, accountCallback, sessionCallback):
+        chunkLines, users, groups = future.result()
+        parser.stitch(users, groups, accountCallback, sessionCallback)
+        return chunkLines
+
+    # Parse the log file(s) of 'parser' by splitting them into byte-range
+    # chunks at line boundaries, which are stitched by 'parser' in order.
+    # Compressed files can't be split, so each is tokenized whole by one
+    # worker.
+    #
+    # At most 2 chunks per worker are tokenized ahead of the one being
+    # stitched, so that the records held at once stay bounded however large
+    # a plain log is; for a compressed file, they grow with the file.
+    def parseChunked(self, parser, accountCallback, sessionCallback,
+                     chunkSize=CHUNK_SIZE):
+        fNames = parser.fname_
+        if isinstance(fNames, str):
+            fNames = [fNames]
+
+        lineCnt = 0
+        window = self.workers_ * 2
+        with concurrent.futures.ProcessPoolExecutor(self.workers_) as pool:
+            inFlight = collections.deque()
+            for fName in fNames:
+                for chunk in _chunkRanges(fName, chunkSize):
+                    if len(inFlight) >= window:
+                        lineCnt += self._stitchChunk(parser, inFlight.popleft(),
+                            accountCallback, sessionCallback)
+                    inFlight.append(pool.submit(_tokenizeChunk, chunk))
+
+            while inFlight:
+                lineCnt += self._stitchChunk(parser, inFlight.popleft(),
+                    accountCallback, sessionCallback)
+
+        parser.line_cnt_ = lineCnt
+        print("SFTP log line count (total) : {0}".format(lineCnt))
+        print("SFTP live sessions (peak)   : {0}".format(parser.peak_sessions_))
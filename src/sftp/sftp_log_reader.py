@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+import bz2
+import gzip
+import lzma
+import os
+import sys
+import time
+
+# Stream the lines of one or more (possibly compressed) SFTP log files as
+# bytes, without the trailing newline. Files are read in large blocks and
+# decompressed on the fly, so rotated .gz/.bz2/.xz logs need no temporary
+# copies; several files are read back to back as one stream. An empty file
+# name reads standard input.
+#
+# Reading may start 'startOffset' bytes into the first file, and
+# 'blockCallback(fName, fhandle, offset, done)' is called once the lines of
+# each block have been consumed, with the file being read and the offset
+# just past the last whole line read so far; 'done' is set at the end of the
+# file. Offsets count decompressed
+# bytes, so compressed files are decompressed up to the start offset rather
+# than seeked.
+#
+# With 'follow' set, the last file is followed like tail -F: at its end the
+# reader waits for more lines, polling every 'pollSecs', and carries on with
+# the new file once the log is rotated. A rotated file is read to its end
+# before moving on; a file truncated in place is read again from the start.
+# 'idleCallback()' is called whenever the reader is about to wait, and
+# following ends once stop() has been called. A partial last line is held
+# back until its newline arrives.
+class SftpLogReader:
+
+    BLOCK_SIZE = 1024 * 1024
+    POLL_SECS  = 1.0
+
+    # Compression is recognized by the file's leading magic bytes, so it does
+    # not depend on the file name.
+    MAGIC = [
+        (b"\x1f\x8b",               gzip.open),
+        (b"BZh",                    bz2.open),
+        (b"\xfd7zXZ\x00",           lzma.open)]
+
+    def __init__(self, fNames, blockSize=BLOCK_SIZE, startOffset=0,
+                 blockCallback=None, follow=False, pollSecs=POLL_SECS,
+                 idleCallback=None):
+        if isinstance(fNames, str):
+            fNames = [fNames]
+        self.fnames_         = fNames
+        self.block_size_     = blockSize
+        self.start_offset_   = startOffset
+        self.block_callback_ = blockCallback
+
+        self.follow_         = follow
+        self.poll_secs_      = pollSecs
+        self.idle_callback_  = idleCallback
+        self.stopped_        = False
+
+    # Stop following at the next wait; may be called from a signal handler
+    def stop(self):
+        self.stopped_ = True
+
+    @classmethod
+    def isCompressed(classobj, fName):
+        with open(fName, "rb") as fhandle:
+            head = fhandle.read(6)
+        return any(head.startswith(magic) for magic, opener in classobj.MAGIC)
+
+    @classmethod
+    def open(classobj, fName):
+        if len(fName) == 0:
+            return sys.stdin.buffer
+
+        with open(fName, "rb") as fhandle:
+            head = fhandle.read(6)
+
+        for magic, opener in classobj.MAGIC:
+            if head.startswith(magic):
+                return opener(fName, "rb")
+
+        return open(fName, "rb")
+
+    def _skip(self, fhandle, offset):
+        if fhandle.seekable():
+            fhandle.seek(offset)
+            return
+
+        while offset > 0:
+            block = fhandle.read(min(offset, self.block_size_))
+            if len(block) == 0:
+                break
+            offset -= len(block)
+
+    def _readLines(self, fhandle, fName, offset):
+        remainder = b""
+        while True:
+            block = fhandle.read(self.block_size_)
+            if len(block) == 0:
+                break
+
+            lines = (remainder + block).split(b"\n")
+            remainder = lines.pop()
+            yield from lines
+
+            offset += len(block)
+            if self.block_callback_:
+                self.block_callback_(fName, fhandle, offset - len(remainder), False)
+
+        if len(remainder) > 0:
+            yield remainder
+
+        if self.block_callback_:
+            self.block_callback_(fName, fhandle, offset, True)
+
+    # Whether the file open as 'fhandle' at 'offset' has been rotated away
+    # from 'fName' (ROTATED), truncated (TRUNCATED), or neither (None). A
+    # file renamed away with no new file in its place yet is neither.
+    ROTATED   = "rotated"
+    TRUNCATED = "truncated"
+
+    @classmethod
+    def _rotation(classobj, fhandle, fName, offset):
+        try:
+            pathStat = os.stat(fName)
+        except FileNotFoundError:
+            return None
+
+        fileStat = os.fstat(fhandle.fileno())
+        if (pathStat.st_dev, pathStat.st_ino) != (fileStat.st_dev, fileStat.st_ino):
+            return classobj.ROTATED
+        if fileStat.st_size < offset:
+            return classobj.TRUNCATED
+        return None
+
+    def _followLines(self, fhandle, fName, offset):
+        remainder = b""
+        draining  = False
+        try:
+            while True:
+                if fhandle is None:
+                    try:
+                        fhandle = open(fName, "rb")
+                        offset, remainder = 0, b""
+                        continue
+                    except FileNotFoundError:
+                        pass
+                else:
+                    block = fhandle.read(self.block_size_)
+                    if len(block) > 0:
+                        lines = (remainder + block).split(b"\n")
+                        remainder = lines.pop()
+                        yield from lines
+
+                        offset += len(block)
+                        if self.block_callback_:
+                            self.block_callback_(fName, fhandle, offset - len(remainder), False)
+                        continue
+
+                    # The rotated file has been read to its end
+                    if draining:
+                        if len(remainder) > 0:
+                            yield remainder
+                        if self.block_callback_:
+                            self.block_callback_(fName, fhandle, offset, True)
+                        fhandle.close()
+                        fhandle, draining = None, False
+                        continue
+
+                    rotation = self._rotation(fhandle, fName, offset)
+                    if rotation == SftpLogReader.ROTATED:
+                        draining = True
+                        continue
+                    if rotation == SftpLogReader.TRUNCATED:
+                        fhandle.seek(0)
+                        offset, remainder = 0, b""
+                        continue
+
+                if self.stopped_:
+                    break
+
+                if self.idle_callback_:
+                    self.idle_callback_()
+                time.sleep(self.poll_secs_)
+
+        finally:
+            if fhandle is not None:
+                fhandle.close()
+
+    def __iter__(self):
+        offset = self.start_offset_
+        for i, fName in enumerate(self.fnames_):
+
+            # Only a plain file can be followed; one that doesn't exist yet
+            # is waited for
+            if (self.follow_ and i == len(self.fnames_) - 1 and len(fName) > 0 and
+                    not (os.path.exists(fName) and self.isCompressed(fName))):
+                fhandle = None
+                if os.path.exists(fName):
+                    fhandle = open(fName, "rb")
+                    fhandle.seek(offset)
+                yield from self._followLines(fhandle, fName, offset)
+                break
+
+            fhandle = self.open(fName)
+            try:
+                if offset > 0:
+                    self._skip(fhandle, offset)
+                yield from self._readLines(fhandle, fName, offset)
+            finally:
+                if fhandle is not sys.stdin.buffer:
+                    fhandle.close()
+            offset = 0
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+import re
+
+from datetime import datetime
+from datetime import timedelta
+
+from sftp.sftp_session import SftpCommandTypes
+from sftp.sftp_session import SftpCommandTypesMap
+
+# The legacy pattern for SFTP-specific log lines; retained for reference and
+# for comparison by sftp_log_bench.py. tokenizeLine() returns the same groups.
+SFTP_LINE_REGEX = '^.* internal-sftp.*time=(....-..?-..? .*) user=(.*) pid=([0-9]+) (.*)$'
+
+SFTP_MARKER = " internal-sftp"
+
+# For prefiltering raw lines before they are decoded
+SFTP_MARKER_BYTES = SFTP_MARKER.encode()
+
+_millisecond = timedelta(milliseconds=1)
+
+# Anchored, non-backtracking check of the "YYYY-M(M)-D(D) " timestamp prefix
+_datePrefix = re.compile('[0-9]{4}-[0-9]{1,2}-[0-9]{1,2} ')
+
+# Split an SFTP log line into its (timestamp, user, pid, operation) fields,
+# or return None for lines that are not internal-sftp operations (e.g. sshd
+# authentication and connection events).
+#
+# Lines are rejected with a plain substring search before any field is
+# extracted, and fields are then located with str.find() from left to right,
+# so no line is ever backtracked over. Where a field value itself contains a
+# delimiter (" user=", " pid="), the first occurrence wins rather than the
+# last, as it would with the greedy legacy pattern.
+def tokenizeLine(line):
+    markerPos = line.find(SFTP_MARKER)
+    if markerPos < 0:
+        return None
+
+    timePos = line.find("time=", markerPos + len(SFTP_MARKER))
+    if timePos < 0:
+        return None
+    timePos += 5
+
+    if not _datePrefix.match(line, timePos):
+        return None
+
+    userPos = line.find(" user=", timePos)
+    if userPos < 0:
+        return None
+
+    pidPos = line.find(" pid=", userPos + 6)
+    if pidPos < 0:
+        return None
+
+    opPos = line.find(" ", pidPos + 5)
+    if opPos < 0:
+        return None
+
+    pid = line[pidPos+5:opPos]
+    if not (pid.isascii() and pid.isdigit()):
+        return None
+
+    opEnd = len(line)
+    if line.endswith("\n"):
+        opEnd -= 1
+
+    return (line[timePos:userPos], line[userPos+6:pidPos], pid, line[opPos+1:opEnd],)
+
+# Decode "YYYY-MM-DD HH:MM:SS.ffffff" log timestamps. Consecutive log lines
+# almost always share the same date, hour and minute, so that prefix is
+# parsed once and cached; only the seconds and fraction are decoded per line.
+class SftpTimestampDecoder:
+
+    def __init__(self, epoch):
+        self.epoch_         = epoch
+        self.prefix_        = None
+        self.prefix_time_   = None
+        self.prefix_ordinal_= 0
+        self.prefix_ms_     = 0
+
+    def _decodePrefix(self, prefix):
+        if prefix != self.prefix_:
+            prefixTime = datetime.strptime(prefix, "%Y-%m-%d %H:%M")
+            self.prefix_ms_     = (prefixTime - self.epoch_) // _millisecond
+            self.prefix_time_   = prefixTime
+            self.prefix_ordinal_= prefixTime.toordinal()
+            self.prefix_        = prefix
+
+    def _decodeSuffix(self, timestamp, colonPos):
+        dotPos = timestamp.find(".", colonPos)
+        if dotPos < 0:
+            raise ValueError(
+                "time data '{0}' does not match format '%Y-%m-%d %H:%M:%S.%f'".format(timestamp))
+
+        seconds  = timestamp[colonPos+1:dotPos]
+        fraction = timestamp[dotPos+1:]
+        if not (seconds.isascii() and seconds.isdigit() and len(seconds) <= 2 and
+                fraction.isascii() and fraction.isdigit() and len(fraction) <= 6):
+            raise ValueError(
+                "time data '{0}' does not match format '%Y-%m-%d %H:%M:%S.%f'".format(timestamp))
+
+        # strptime() parses a leap second, but datetime can't hold it
+        if int(seconds) > 59:
+            raise ValueError("second must be in 0..59")
+
+        return (int(seconds), int(fraction.ljust(6, "0")),)
+
+    # Return (milliseconds since 'epoch', date ordinal) for 'timestamp'. The
+    # milliseconds are truncated exactly, in integers; the timedelta offsets
+    # this replaced went through float seconds, which could leave them 1 ms
+    # off.
+    def decode(self, timestamp):
+        colonPos = timestamp.rfind(":")
+        self._decodePrefix(timestamp[:colonPos])
+        seconds, micros = self._decodeSuffix(timestamp, colonPos)
+        return (self.prefix_ms_ + seconds * 1000 + micros // 1000, self.prefix_ordinal_,)
+
+    # Return 'timestamp' as a datetime, as datetime.strptime() would
+    def decodeDateTime(self, timestamp):
+        colonPos = timestamp.rfind(":")
+        self._decodePrefix(timestamp[:colonPos])
+        seconds, micros = self._decodeSuffix(timestamp, colonPos)
+        return self.prefix_time_ + timedelta(seconds=seconds, microseconds=micros)
+
+# Decode the operation part of an SFTP log line into an
+# (operation, target, source) triple.
+#
+# Candidate prefixes from SftpCommandTypesMap are dispatched on the first
+# word of the operation and tried longest first, so the longest matching
+# prefix always wins. Targets are taken in a single slice up to the closing
+# quote; for renames the old path becomes the source and the new path the
+# target. Operations are reported as members of 'opTypes', which must name
+# its members as SftpCommandTypes does.
+class SftpOperationDecoder:
+
+    def __init__(self, opTypes=SftpCommandTypes):
+        self.unknown_   = opTypes.Unknown
+        self.dispatch_  = {}
+
+        for prefix, cmdType in SftpCommandTypesMap.items():
+            token = prefix.split(" ", 1)[0]
+            candidates = self.dispatch_.setdefault(token, [])
+            candidates.append((prefix, cmdType, opTypes[cmdType.name],))
+
+        for candidates in self.dispatch_.values():
+            candidates.sort(key=lambda c: len(c[0]), reverse=True)
+
+    @classmethod
+    def _quotedValue(classobj, opString, start):
+        end = opString.find('"', start)
+        if end < 0:
+            end = len(opString)
+        quotePos = opString.find("'", start, end)
+        if quotePos >= 0:
+            end = quotePos
+        return (opString[start:end], end,)
+
+    def decode(self, opString):
+        candidates = self.dispatch_.get(opString.split(" ", 1)[0])
+        if not candidates:
+            return (self.unknown_, "", "",)
+
+        for prefix, cmdType, operation in candidates:
+            if opString.startswith(prefix):
+                break
+        else:
+            return (self.unknown_, "", "",)
+
+        start = len(prefix)
+
+        if cmdType == SftpCommandTypes.StatusResponse:
+            return (operation, opString[start:], "",)
+
+        if cmdType == SftpCommandTypes.SessionStart:
+            # Grab IP address from session start command output
+            ipStart = opString.find("[") + 1
+            ipEnd   = opString.rfind("]")
+            return (operation, opString[ipStart:ipEnd], "",)
+
+        if not opString.startswith('"', start):
+            return (operation, "", "",)
+
+        target, end = self._quotedValue(opString, start + 1)
+
+        if cmdType == SftpCommandTypes.Rename or cmdType == SftpCommandTypes.PosixRename:
+            newPos = opString.find(' new "', end)
+            if newPos >= 0:
+                return (operation, self._quotedValue(opString, newPos + 6)[0], target,)
+
+        return (operation, target, "",)
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+import collections
+import queue
+import threading
+import time
+
+# Run a distiller's database writes on a background thread, so that parsing
+# carries on while a batch is being saved.
+#
+# Writes are run one at a time, in the order submitted. At most 'maxInFlight'
+# writes may be pending at once; submit() blocks while that many are queued or
+# running, which holds the parser back when the database can't keep up. With
+# 'maxInFlight' of 0 each write is run inline by submit().
+#
+# A write owns its arguments once submitted: the caller must not change them
+# afterwards.
+class SftpLogWriter:
+
+    MAX_IN_FLIGHT = 2
+
+    def __init__(self, maxInFlight=MAX_IN_FLIGHT):
+        self.max_in_flight_ = maxInFlight
+        self.write_cnt_     = 0
+        self.error_cnt_     = 0
+
+        self.queue_         = None
+        self.slots_         = None
+        self.thread_        = None
+
+        if maxInFlight > 0:
+            self.queue_     = queue.Queue()
+            self.slots_     = threading.BoundedSemaphore(maxInFlight)
+            self.thread_    = threading.Thread(
+                target=self._run, name="SftpLogWriter", daemon=True)
+            self.thread_.start()
+
+    def _write(self, func, args):
+        try:
+            func(*args)
+        except Exception as err:
+            self.error_cnt_ += 1
+            print("Error in SftpLogWriter::{0} : {1}".format(func.__name__, err))
+        finally:
+            self.write_cnt_ += 1
+
+    def _run(self):
+        while True:
+            task = self.queue_.get()
+            if task is None:
+                self.queue_.task_done()
+                break
+
+            try:
+                self._write(*task)
+            finally:
+                self.slots_.release()
+                self.queue_.task_done()
+
+    # Queue 'func(*args)' to be run after every write submitted before it
+    def submit(self, func, *args):
+        if self.thread_ is None:
+            self._write(func, args)
+            return
+
+        self.slots_.acquire()
+        self.queue_.put((func, args,))
+
+    # Wait for all submitted writes to complete
+    def drain(self):
+        if self.thread_ is not None:
+            self.queue_.join()
+
+    # Wait for all submitted writes to complete, then stop the writer thread
+    def close(self):
+        if self.thread_ is None:
+            return
+
+        self.queue_.put(None)
+        self.thread_.join()
+        self.thread_ = None
+
+# The pending batch of a distiller, which is due to be flushed once it holds
+# 'maxDocs' distinct documents, roughly 'maxBytes' of serialized documents,
+# or has held an update for 'maxSecs', whichever comes first. A limit of None
+# is not applied.
+class SftpLogBatch:
+
+    # Default limits of a distiller's batches
+    MAX_DOCS  = 1000
+    MAX_BYTES = 16 * 1024 * 1024
+    MAX_SECS  = 10
+
+    # Rough serialized size of a session header, and of a command less its
+    # target and source paths
+    DOC_BYTES = 160
+    CMD_BYTES = 100
+
+    def __init__(self, maxDocs, maxBytes=None, maxSecs=None):
+        self.max_docs_  = maxDocs
+        self.max_bytes_ = maxBytes
+        self.max_secs_  = maxSecs
+
+        self.ids_       = set()
+        self.bytes_     = 0
+        self.start_     = 0
+
+    # Estimate the serialized size of a session (or account) document
+    @classmethod
+    def estimateBytes(classobj, doc):
+        docBytes = classobj.DOC_BYTES
+        for cmd in doc.get("commands", ()):
+            docBytes += classobj.CMD_BYTES + len(cmd["target"]) + len(cmd["source"])
+        return docBytes
+
+    def __len__(self):
+        return len(self.ids_)
+
+    def __contains__(self, docId):
+        return docId in self.ids_
+
+    def __iter__(self):
+        return iter(self.ids_)
+
+    def add(self, docId, docBytes):
+        if len(self.ids_) == 0:
+            self.start_ = time.monotonic()
+        self.ids_.add(docId)
+        self.bytes_ += docBytes
+
+    # Seconds since the batch's first update
+    def age(self):
+        if len(self.ids_) == 0:
+            return 0.0
+        return time.monotonic() - self.start_
+
+    def isFull(self):
+        if len(self.ids_) >= self.max_docs_:
+            return True
+        if self.max_bytes_ is not None and self.bytes_ >= self.max_bytes_:
+            return True
+        if self.max_secs_ is not None and len(self.ids_) > 0:
+            return time.monotonic() - self.start_ >= self.max_secs_
+        return False
+
+    def clear(self):
+        self.ids_.clear()
+        self.bytes_ = 0
+        self.start_ = 0
+
+# Running totals of the session batches a distiller has flushed: how many,
+# the documents and estimated bytes they held, the seconds from each one's
+# first update until it was saved (including any wait behind other
+# batches), and the seconds the saves took. Only the save times of the last
+# 'latencyCnt' batches are kept (or all of them, given None), so the stats
+# stay bounded however long a followed log runs.
+class SftpLogFlushStats:
+
+    LATENCY_CNT = 1000
+
+    def __init__(self, latencyCnt=LATENCY_CNT):
+        self.flush_cnt_     = 0
+        self.doc_cnt_       = 0
+        self.byte_cnt_      = 0
+        self.wait_secs_     = 0.0
+        self.save_secs_     = 0.0
+        self.max_save_secs_ = 0.0
+        self.latencies_     = collections.deque(maxlen=latencyCnt)
+
+    def add(self, docCnt, byteCnt, waitSecs, saveSecs):
+        self.flush_cnt_ += 1
+        self.doc_cnt_   += docCnt
+        self.byte_cnt_  += byteCnt
+        self.wait_secs_ += waitSecs
+        self.save_secs_ += saveSecs
+        self.max_save_secs_ = max(self.max_save_secs_, saveSecs)
+        self.latencies_.append(saveSecs)
+
+    def summary(self):
+        if self.flush_cnt_ == 0:
+            return "0 flushes"
+
+        flushCnt = self.flush_cnt_
+        return ("{0} flushes; per flush {1:.0f} docs, {2:.0f} KB, "
+                "{3:.0f} ms pending, {4:.0f} ms saving (max {5:.0f} ms)").format(
+            flushCnt,
+            self.doc_cnt_ / flushCnt,
+            self.byte_cnt_ / flushCnt / 1024,
+            1000 * self.wait_secs_ / flushCnt,
+            1000 * self.save_secs_ / flushCnt,
+            1000 * self.max_save_secs_)
+
+# Hold back a distiller's session updates so that each session is written
+# once, when it is final, rather than in every batch it is updated in.
+# Sessions still open are checkpointed once their oldest unsaved update is
+# 'checkpointSecs' old or they have 'checkpointUpdates' unsaved updates, so
+# long-lived sessions are still saved (and trimmed) now and then.
+class SftpLogCoalescer:
+
+    CHECKPOINT_SECS     = 300
+    CHECKPOINT_UPDATES  = 10000
+
+    def __init__(self, checkpointSecs=CHECKPOINT_SECS,
+                 checkpointUpdates=CHECKPOINT_UPDATES):
+        self.checkpoint_secs_    = checkpointSecs
+        self.checkpoint_updates_ = checkpointUpdates
+
+        # Document ID => [time of oldest unsaved update, unsaved updates]
+        self.pending_            = {}
+
+    def __len__(self):
+        return len(self.pending_)
+
+    # Record an update to 'docId'; return True if the document is due to be
+    # written, in which case it is no longer pending.
+    def update(self, docId, final=False):
+        now = time.monotonic()
+        pending = self.pending_.get(docId)
+        if pending is None:
+            pending = [now, 0]
+            self.pending_[docId] = pending
+        pending[1] += 1
+
+        if (final or now - pending[0] >= self.checkpoint_secs_ or
+                pending[1] >= self.checkpoint_updates_):
+            del self.pending_[docId]
+            return True
+
+        return False
+
+    # The document is being written anyway
+    def discard(self, docId):
+        self.pending_.pop(docId, None)
+
+    # Return the IDs of documents whose oldest unsaved update is due for a
+    # checkpoint, which are no longer pending; for use while no updates are
+    # arriving to trigger one.
+    def due(self):
+        dueBefore = time.monotonic() - self.checkpoint_secs_
+        docIds = [docId for docId, pending in self.pending_.items()
+                  if pending[0] <= dueBefore]
+        for docId in docIds:
+            del self.pending_[docId]
+        return docIds
+
+    # Return the IDs of all pending documents, which are no longer pending
+    def drain(self):
+        docIds = list(self.pending_)
+        self.pending_.clear()
+        return docIds
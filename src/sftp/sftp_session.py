@@ -1,11 +1,13 @@
 #!/usr/bin/python3
 
+import array
 import base64
 import datetime
 import enum
 import hashlib
 import ipaddress
 import json
+import sys
 
 # Set of possible client commands in an SFTP session
 class SftpCommandTypes(enum.Enum):
@@ -60,6 +62,9 @@ class SftpStatusTypes(enum.Enum):
 
 class SftpCommand:
 
+    __slots__ = ("cmd_type_", "time_offset_", "target_", "source_", "status_")
+
+    # 'timeOffset' is in integer milliseconds since SftpSession.BIG_BANG
     def __init__(self, cmdType, timeOffset, target="", source=""):
         self.cmd_type_      = cmdType
         self.time_offset_   = timeOffset
@@ -73,8 +78,18 @@ class SftpCommand:
 
 # Encapsulate the data and context of a client's SFTP session, as described in
 # an SFTP log file.
+#
+# A session may hold a very large number of commands, so rather than keeping
+# an SftpCommand per command it stores them column-wise: type and status
+# codes and time offsets in typed arrays, targets and sources as (interned)
+# strings.
 class SftpSession :
 
+    __slots__ = ("acct_id_", "pid_", "session_date_", "sess_key_", "sess_hash_",
+                 "start_time_", "end_time_", "last_time_", "ip_addr_",
+                 "cmd_types_", "time_offsets_", "statuses_", "targets_",
+                 "sources_", "dirty_from_", "was_saved_", "seq_base_")
+
     # The beginning of our time offset
     BIG_BANG = datetime.datetime(2000,1,1,0,0,0)
 
@@ -83,19 +98,38 @@ class SftpSession :
         #   => numeric account ID
         #   => numeric Linux process ID
         #   => session date
-        self.sess_id_       = self.calculate_key(acctId, pid, sessionDate)
         self.acct_id_       = acctId
         self.pid_           = pid
         self.session_date_  = sessionDate
 
+        # In-process lookup key; see lookup_key(). The persisted key
+        # (sess_id_) is only hashed on first use.
+        self.sess_key_      = self.lookup_key(acctId, pid, sessionDate.toordinal())
+        self.sess_hash_     = None
+
+        # Session start/end and latest activity, in milliseconds since BIG_BANG
         self.start_time_  = 0
         self.end_time_    = 0
-        self.ip_addr_     = 0
+        self.last_time_   = 0
+        self.ip_addr_     = 0     # IPv4 address as an integer
+
+        # Command columns, indexed by command sequence ID less seq_base_. A
+        # session carried on after eviction (see SftpLogParser) holds only
+        # the commands from seq_base_ on.
+        self.seq_base_      = 0
+        self.cmd_types_     = array.array('B')
+        self.time_offsets_  = array.array('q')
+        self.statuses_      = array.array('B')
+        self.targets_       = []
+        self.sources_       = []
 
-        self.commands_    = []
+        # Dirty watermark for delta emission: commands at or above this index
+        # are new, or have had their status changed, since the last flush.
+        self.dirty_from_  = 0
 
         self.was_saved_   = False
 
+    # The persisted session key; matches moonshyne_sftp.get_session_key()
     @classmethod
     def calculate_key(classobj, acctId, pid, sessionDate):
         keyhash = hashlib.sha256()
@@ -103,61 +137,134 @@ class SftpSession :
         keyhash.update(key.encode())
         return base64.b64encode(keyhash.digest()).decode('utf-8')
 
+    # A cheap key for in-process session maps, identifying the same session
+    # as calculate_key() without hashing.
+    @classmethod
+    def lookup_key(classobj, acctId, pid, dateOrdinal):
+        return (acctId, pid, dateOrdinal,)
+
+    @property
+    def sess_id_(self):
+        if self.sess_hash_ is None:
+            self.sess_hash_ = self.calculate_key(
+                self.acct_id_, self.pid_, self.session_date_)
+        return self.sess_hash_
+
     def session_start_as_milliseconds(self):
-        if self.start_time_:
-            return int(self.start_time_.total_seconds() * 1000)
-        else:
-            return 0
+        return self.start_time_
 
     def session_end_as_milliseconds(self):
-        if self.end_time_:
-            return int(self.end_time_.total_seconds() * 1000)
-        else:
-            return 0
+        return self.end_time_
+
+    def command_count(self):
+        return len(self.cmd_types_)
 
     def add_command(self, sftpCommand):
 
         if sftpCommand.cmd_type_ == SftpCommandTypes.StatusResponse:
-            cmdCnt = len(self.commands_)
+            cmdCnt = len(self.cmd_types_)
             if cmdCnt > 0:
-                lastCommand = self.commands_[cmdCnt-1]
-                lastCommand.status_ = sftpCommand.status_
+                self.statuses_[cmdCnt-1] = sftpCommand.status_.value
+                if self.dirty_from_ > cmdCnt-1:
+                    self.dirty_from_ = cmdCnt-1
 
         else:
             if sftpCommand.cmd_type_ == SftpCommandTypes.SessionStart:
-                self.ip_addr_ = ipaddress.IPv4Address(sftpCommand.target_)
+                self.ip_addr_ = int(ipaddress.IPv4Address(sftpCommand.target_))
 
-            self.commands_.append(sftpCommand)
+            self.cmd_types_.append(sftpCommand.cmd_type_.value)
+            self.time_offsets_.append(sftpCommand.time_offset_)
+            self.statuses_.append(sftpCommand.status_.value)
+            self.targets_.append(sys.intern(sftpCommand.target_))
+            self.sources_.append(sys.intern(sftpCommand.source_))
 
     @classmethod
     def toStr(classobj, sftpSession):
         return SftpSessionJsonEncoder().encode(sftpSession)
 
     @classmethod
-    def toJSON(classobj, sftpSession):
-        jsonObj = {
+    def _commandsToJSON(classobj, sftpSession, first):
+        cmdList = []
+        for i in range(first, len(sftpSession.cmd_types_)):
+            cmdList.append({
+                "sequenceId" : sftpSession.seq_base_ + i,
+                "type"       : sftpSession.cmd_types_[i],
+                "timeOffset" : sftpSession.time_offsets_[i],
+                "target"     : sftpSession.targets_[i],
+                "source"     : sftpSession.sources_[i],
+                "status"     : sftpSession.statuses_[i]})
+        return cmdList
+
+    @classmethod
+    def _headerToJSON(classobj, sftpSession):
+        return {
             "sessionId"     : sftpSession.sess_id_,
             "accountId"     : sftpSession.acct_id_,
             "sessionDate"   : sftpSession.session_date_.toordinal(),
             "pid"           : sftpSession.pid_,
             "startTime"     : sftpSession.session_start_as_milliseconds(),
             "endTime"       : sftpSession.session_end_as_milliseconds(),
-            "ipAddress"     : int(sftpSession.ip_addr_)}
+            "ipAddress"     : sftpSession.ip_addr_}
 
-        cmdList = []
-        for i in range(len(sftpSession.commands_)):
-            cmd = sftpSession.commands_[i]
-            cmdList.append({
-                "sequenceId" : i,
-                "type"       : cmd.cmd_type_.value,
-                "timeOffset" : int(cmd.time_offset_.total_seconds() * 1000),
-                "target"     : cmd.target_,
-                "source"     : cmd.source_,
-                "status"     : cmd.status_.value})
-
-        jsonObj["commands"] = cmdList
+    @classmethod
+    def toJSON(classobj, sftpSession):
+        jsonObj = classobj._headerToJSON(sftpSession)
+        jsonObj["commands"] = classobj._commandsToJSON(sftpSession, 0)
         return jsonObj
 
+    # Rebuild a session from a toJSON() document, e.g. one saved in a
+    # checkpoint. All of its commands are dirty, so the next delta holds the
+    # whole session.
+    @classmethod
+    def fromJSON(classobj, jsonObj):
+        session = classobj(jsonObj["accountId"], jsonObj["pid"],
+            datetime.date.fromordinal(jsonObj["sessionDate"]))
+        session.start_time_ = jsonObj["startTime"]
+        session.end_time_   = jsonObj["endTime"]
+        session.ip_addr_    = jsonObj["ipAddress"]
+
+        if jsonObj["commands"]:
+            session.seq_base_ = jsonObj["commands"][0]["sequenceId"]
+        for cmd in jsonObj["commands"]:
+            session.cmd_types_.append(cmd["type"])
+            session.time_offsets_.append(cmd["timeOffset"])
+            session.statuses_.append(cmd["status"])
+            session.targets_.append(sys.intern(cmd["target"]))
+            session.sources_.append(sys.intern(cmd["source"]))
+
+        return session
+
+    # Return the session header plus only those commands that are new, or
+    # whose status changed, since the previous call; then advance the dirty
+    # watermark. Apply the result to a prior document with mergeJSON().
+    @classmethod
+    def toDeltaJSON(classobj, sftpSession):
+        jsonObj = classobj._headerToJSON(sftpSession)
+        jsonObj["commands"] = classobj._commandsToJSON(
+            sftpSession, sftpSession.dirty_from_)
+        sftpSession.dirty_from_ = len(sftpSession.cmd_types_)
+        return jsonObj
+
+    # Merge a (delta or full) session document into 'target' in place.
+    # Commands are matched by sequenceId; 'target' may hold a contiguous
+    # tail of the command list rather than the whole of it.
+    @classmethod
+    def mergeJSON(classobj, target, delta):
+        for key, value in delta.items():
+            if key != "commands":
+                target[key] = value
+
+        cmdList = target.setdefault("commands", [])
+        for cmd in delta["commands"]:
+            base = cmdList[0]["sequenceId"] if cmdList else cmd["sequenceId"]
+            idx = cmd["sequenceId"] - base
+            if 0 <= idx < len(cmdList):
+                cmdList[idx] = cmd
+            else:
+                cmdList.append(cmd)
+
+        return target
+
 class SftpSessionJsonEncoder(json.JSONEncoder):
 
     def default(self, obj):
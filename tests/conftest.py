@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The moonshyne modules are imported from the src directory, as the tools run
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
@@ -0,0 +1,77 @@
+import copy
+import json
+
+# An in-memory stand-in for a pycouchdb Database, serving the requests
+# SftpCdbBulkStore makes through resource.post(): _all_docs lookups by key
+# (with or without include_docs), and _bulk_docs saves, which are rejected
+# with a conflict unless they carry the stored revision, as CouchDb does.
+class FakeCouchResource:
+
+    def __init__(self):
+        self.docs_  = {}
+        self.posts_ = []
+
+    # Store 'doc' as another client would, bumping its revision
+    def put(self, doc):
+        stored = self.docs_.get(doc["_id"])
+        revNum = int(stored["_rev"].split("-")[0]) + 1 if stored else 1
+        doc = copy.deepcopy(doc)
+        doc["_rev"] = "{0}-fake".format(revNum)
+        self.docs_[doc["_id"]] = doc
+        return doc["_rev"]
+
+    def post(self, path, data=None, params=None):
+        body = json.loads(data)
+        self.posts_.append((path, body, params,))
+
+        if path == "_all_docs":
+            return (None, self._allDocs(body["keys"],
+                bool(params and params.get("include_docs") == "true")),)
+        if path == "_bulk_docs":
+            return (None, self._bulkDocs(body["docs"]),)
+        raise ValueError("unexpected request '{0}'".format(path))
+
+    def _allDocs(self, keys, includeDocs):
+        rows = []
+        for key in keys:
+            stored = self.docs_.get(key)
+            if stored is None:
+                rows.append({"key": key, "error": "not_found"})
+                continue
+            row = {"id": key, "key": key, "value": {"rev": stored["_rev"]}}
+            if includeDocs:
+                row["doc"] = copy.deepcopy(stored)
+            rows.append(row)
+        return {"rows": rows}
+
+    def _bulkDocs(self, docs):
+        results = []
+        for doc in docs:
+            stored = self.docs_.get(doc["_id"])
+            if (stored["_rev"] if stored else None) != doc.get("_rev"):
+                results.append({"id": doc["_id"], "error": "conflict",
+                                "reason": "Document update conflict."})
+                continue
+            results.append({"ok": True, "id": doc["_id"], "rev": self.put(doc)})
+        return results
+
+    # The paths posted so far, in order
+    def paths(self):
+        return [path for path, body, params in self.posts_]
+
+class FakeCouchDatabase:
+
+    def __init__(self):
+        self.resource = FakeCouchResource()
+
+    def cleanup(self):
+        pass
+
+# A stand-in for a pycouchdb Server, holding one FakeCouchDatabase per name
+class FakeCouchServer:
+
+    def __init__(self):
+        self.databases_ = {}
+
+    def database(self, name):
+        return self.databases_.setdefault(name, FakeCouchDatabase())
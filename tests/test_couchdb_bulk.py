@@ -0,0 +1,114 @@
+import pytest
+
+from fake_couchdb import FakeCouchDatabase
+
+from couchdb.couchdb_bulk import SftpCdbBulkStore
+
+def _doc(docId, value):
+    return {"_id": docId, "value": value}
+
+def test_missing_revs_fetched_once_per_batch():
+    database = FakeCouchDatabase()
+    database.resource.put(_doc("a", 0))
+    database.resource.put(_doc("a", 1))
+
+    store = SftpCdbBulkStore(database)
+    store.save([_doc("a", 2), _doc("b", 2)])
+
+    # One lookup for the whole batch, finding the stored "a" only
+    assert database.resource.paths() == ["_all_docs", "_bulk_docs"]
+    assert database.resource.posts_[0][1] == {"keys": ["a", "b"]}
+    assert store.fetch_cnt_ == 1
+    assert store.conflict_cnt_ == 0
+    assert database.resource.docs_["a"]["value"] == 2
+    assert database.resource.docs_["a"]["_rev"] == "3-fake"
+    assert database.resource.docs_["b"]["_rev"] == "1-fake"
+
+    # Both revisions are now known, so saving again needs no lookup
+    store.save([_doc("a", 3), _doc("b", 3)])
+    assert database.resource.paths()[2:] == ["_bulk_docs"]
+    assert store.revs_ == {"a": "4-fake", "b": "2-fake"}
+
+def test_conflict_retried_with_fresh_rev():
+    database = FakeCouchDatabase()
+    store = SftpCdbBulkStore(database)
+    store.save([_doc("a", 0), _doc("b", 0)])
+
+    # Another client updates "a", leaving the cached revision stale
+    database.resource.put(_doc("a", "other"))
+
+    store.save([_doc("a", 1), _doc("b", 1)])
+
+    assert store.conflict_cnt_ == 1
+    assert database.resource.paths()[2:] == ["_bulk_docs", "_all_docs", "_bulk_docs"]
+    assert database.resource.posts_[3][1] == {"keys": ["a"]}
+    assert [doc["_id"] for doc in database.resource.posts_[4][1]["docs"]] == ["a"]
+    assert database.resource.docs_["a"]["value"] == 1
+    assert database.resource.docs_["a"]["_rev"] == "3-fake"
+    assert store.revs_["a"] == "3-fake"
+
+def test_conflict_merged_with_fresh_doc():
+    database = FakeCouchDatabase()
+    database.resource.put({"_id": "a", "items": [1]})
+    store = SftpCdbBulkStore(database)
+
+    # The first attempt reads the stored document, but another client saves
+    # it again before the merged document reaches _bulk_docs
+    def merge(stored, doc):
+        if len(database.resource.paths()) == 1:
+            database.resource.put({"_id": "a", "items": [1, 2]})
+        doc = dict(doc, _rev=stored["_rev"])
+        doc["items"] = stored["items"] + doc["items"]
+        return doc
+
+    store.save([{"_id": "a", "items": [3]}], merge)
+
+    assert store.conflict_cnt_ == 1
+    assert database.resource.docs_["a"]["items"] == [1, 2, 3]
+
+def test_conflicts_fail_after_retries():
+    database = FakeCouchDatabase()
+    store = SftpCdbBulkStore(database)
+
+    # Every attempt is beaten to the save by another client
+    def merge(stored, doc):
+        database.resource.put({"_id": "a", "items": []})
+        return dict(doc, _rev=stored["_rev"]) if stored else doc
+
+    with pytest.raises(RuntimeError, match="1 of 1 documents not saved"):
+        store.save([{"_id": "a", "items": [1]}], merge)
+    assert database.resource.paths().count("_bulk_docs") == \
+        SftpCdbBulkStore.CONFLICT_RETRIES + 1
+
+def test_rev_cache_evicts_least_recently_used():
+    database = FakeCouchDatabase()
+    store = SftpCdbBulkStore(database, revCacheSize=2)
+
+    store.save([_doc("a", 0), _doc("b", 0)])
+    store.save([_doc("a", 1)])
+    store.save([_doc("c", 0)])
+
+    # "b" was used least recently, so its revision was dropped
+    assert list(store.revs_) == ["a", "c"]
+    fetchCnt = store.fetch_cnt_
+
+    store.save([_doc("a", 2)])
+    assert store.fetch_cnt_ == fetchCnt
+
+    store.save([_doc("b", 1)])
+    assert store.fetch_cnt_ == fetchCnt + 1
+    assert store.conflict_cnt_ == 0
+    assert database.resource.docs_["b"]["value"] == 1
+    assert list(store.revs_) == ["a", "b"]
+
+def test_forget_drops_rev():
+    database = FakeCouchDatabase()
+    store = SftpCdbBulkStore(database)
+    store.save([_doc("a", 0)])
+
+    store.forget("a")
+    store.save([_doc("a", 1)])
+
+    assert store.fetch_cnt_ == 2
+    assert store.conflict_cnt_ == 0
+    assert database.resource.docs_["a"]["_rev"] == "2-fake"
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("pycouchdb")
+
+from fake_couchdb import FakeCouchServer
+
+from couchdb.couchdb_distiller import SftpLogCdbDistiller
+
+def _command(seqId):
+    return {"sequenceId": seqId, "timeOffset": seqId * 10, "type": 1,
+            "target": "/home/u1/f{0}".format(seqId), "source": "", "status": 0}
+
+# A delta of session "s1" holding the commands 'seqIds'
+def _delta(seqIds, endTime=0):
+    return {"sessionId": "s1", "accountId": 1, "pid": "10",
+            "sessionDate": 18322, "startTime": 1000, "endTime": endTime,
+            "ipAddress": 167837953,
+            "commands": [_command(seqId) for seqId in seqIds]}
+
+def test_saved_session_keeps_only_header_cached():
+    server = FakeCouchServer()
+    distiller = SftpLogCdbDistiller("", maxInFlight=0, batchSize=1)
+    distiller.connect(server=server)
+    sessions = server.database(SftpLogCdbDistiller.SESSION_DB).resource
+
+    # Once saved, only the header of the open session stays cached
+    distiller.process_session("s1", _delta([0, 1]), 'N')
+    assert distiller.session_cache_["s1"]["commands"] == []
+    assert distiller.session_cache_["s1"]["startTime"] == 1000
+
+    # Later commands are merged into the stored document
+    distiller.process_session("s1", _delta([2]), 'X')
+    assert distiller.session_cache_["s1"]["commands"] == []
+    assert sessions.posts_[-2][2] == {"include_docs": "true"}
+
+    distiller.process_session("s1", _delta([3, 4], 2000), 'F')
+    assert "s1" not in distiller.session_cache_
+
+    stored = sessions.docs_["s1"]
+    assert [cmd["sequenceId"] for cmd in stored["commands"]] == [0, 1, 2, 3, 4]
+    assert stored["endTime"] == 2000
+
+    distiller.cleanup()
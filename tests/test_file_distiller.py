@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.parquet
+
+from localfile.file_distiller import SftpLogFileDistiller
+from sftp.sftp_log_parser     import SftpLogParser
+
+LOG_LINES = [
+    'time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'time=2020-03-01 22:00:00.474 user=u2 pid=1002 sent status No such file',
+    'time=2020-03-01 22:00:01.100 user=u3 pid=1003 session opened for local user u3 from [192.168.1.20]',
+    'time=2020-03-01 22:00:01.611 user=u2 pid=1002 stat name "/home/u2"',
+    'time=2020-03-01 22:00:02.200 user=u3 pid=1003 rename old "/home/u3/a" new "/home/u3/b"',
+    'time=2020-03-01 22:00:03.000 user=u2 pid=1002 session closed for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:04.000 user=u3 pid=1003 session closed for local user u3 from [192.168.1.20]',
+]
+
+def _distill(logFile, outDir, outFormat):
+    distiller = SftpLogFileDistiller(str(outDir), outFormat)
+    distiller.connect()
+    parser = SftpLogParser(str(logFile), deltaMode=True)
+    parser.parse(distiller.process_account, distiller.process_session)
+    distiller.cleanup()
+    assert distiller.error_cnt_ == 0
+
+def _readNdjson(fName):
+    with open(fName, encoding="utf-8") as fhandle:
+        return [json.loads(line) for line in fhandle]
+
+def test_parquet_matches_ndjson(tmp_path):
+    logFile = tmp_path / "sftp.log"
+    logFile.write_text("".join(
+        "Mar  1 22:00:00 host internal-sftp[1]: {0}\n".format(line)
+        for line in LOG_LINES))
+
+    _distill(logFile, tmp_path / "ndjson", "ndjson")
+    _distill(logFile, tmp_path / "parquet", "parquet")
+
+    accounts = _readNdjson(tmp_path / "ndjson" / "accounts.ndjson")
+    assert pyarrow.parquet.read_table(
+        tmp_path / "parquet" / "accounts.parquet").to_pylist() == accounts
+
+    sessions = _readNdjson(tmp_path / "ndjson" / "sessions.ndjson")
+    assert len(sessions) > 0
+
+    sessionRows = []
+    commandRows = []
+    for session in sessions:
+        for cmd in session.pop("commands"):
+            commandRows.append(dict(cmd, sessionId=session["sessionId"]))
+        sessionRows.append(dict(session, pid=int(session["pid"])))
+
+    table = pyarrow.parquet.read_table(tmp_path / "parquet" / "sessions.parquet")
+    assert table.schema.field("pid").type == pyarrow.int64()
+    assert table.schema.field("ipAddress").type == pyarrow.int64()
+    assert table.to_pylist() == [
+        {name: row[name] for name in table.column_names} for row in sessionRows]
+
+    table = pyarrow.parquet.read_table(tmp_path / "parquet" / "commands.parquet")
+    assert table.to_pylist() == [
+        {name: row[name] for name in table.column_names} for row in commandRows]
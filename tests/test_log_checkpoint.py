@@ -0,0 +1,111 @@
+import copy
+
+import pytest
+
+from sftp.sftp_log_checkpoint import SftpLogCheckpoint
+from sftp.sftp_log_parser     import SftpLogParser
+from sftp.sftp_log_reader     import SftpLogReader
+from sftp.sftp_session        import SftpSession
+
+LOG_LINES = [
+    'time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'time=2020-03-01 22:00:03.000 user=u2 pid=1002 session closed for local user u2 from [10.0.60.253]',
+]
+
+def _writeLog(path, lines):
+    path.write_text("".join(
+        "Mar  1 22:00:00 host internal-sftp[1]: {0}\n".format(line)
+        for line in lines))
+    return str(path)
+
+def test_failed_flush_fails_parse(tmp_path):
+    logFile = _writeLog(tmp_path / "sftp.log", LOG_LINES)
+
+    def flush():
+        raise RuntimeError("sink can't be flushed")
+
+    checkpoint = SftpLogCheckpoint(str(tmp_path / "ck.json"), flush, 0)
+    parser = SftpLogParser(logFile, deltaMode=True)
+
+    with pytest.raises(RuntimeError, match="sink can't be flushed"):
+        parser.parse(lambda *args: None, lambda *args: None, checkpoint)
+    assert not (tmp_path / "ck.json").exists()
+
+# Sessions that span the two files, and a pid reused once its session is
+# closed; the first file is a rotated one
+ROTATED_LINES = [
+    'time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'time=2020-03-01 22:00:00.474 user=u2 pid=1002 sent status No such file',
+    'time=2020-03-01 22:00:01.100 user=u3 pid=1003 session opened for local user u3 from [192.168.1.20]',
+    'time=2020-03-01 22:00:01.611 user=u2 pid=1002 opendir "/home/u2"',
+    'time=2020-03-01 22:00:02.200 user=u3 pid=1003 rename old "/home/u3/a" new "/home/u3/b"',
+]
+CURRENT_LINES = [
+    'time=2020-03-01 22:00:02.300 user=u3 pid=1003 sent status Failure',
+    'time=2020-03-01 22:00:02.900 user=u2 pid=1002 closedir "/home/u2"',
+    'time=2020-03-01 22:00:03.000 user=u2 pid=1002 session closed for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:04.000 user=u4 pid=1002 session opened for local user u4 from [192.168.1.21]',
+    'time=2020-03-01 22:00:05.000 user=u3 pid=1003 remove name "/home/u3/b"',
+    'time=2020-03-01 22:00:05.500 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:05.600 user=u2 pid=1002 stat name "/home/u2"',
+    'time=2020-03-01 22:00:06.000 user=u3 pid=1003 session closed for local user u3 from [192.168.1.20]',
+]
+
+# A sink that only keeps what has been flushed, as a database would through
+# a crash
+class _Sink:
+
+    def __init__(self, saved, crashAt=None):
+        self.saved_     = saved
+        self.pending_   = []
+        self.flush_cnt_ = 0
+        self.crash_at_  = crashAt
+
+    def process_session(self, sessId, session, state):
+        self.pending_.append((sessId, copy.deepcopy(session),))
+
+    def flush(self):
+        self.flush_cnt_ += 1
+        if self.flush_cnt_ == self.crash_at_:
+            raise RuntimeError("crashed")
+
+        for sessId, session in self.pending_:
+            if sessId in self.saved_:
+                SftpSession.mergeJSON(self.saved_[sessId], session)
+            else:
+                self.saved_[sessId] = session
+        self.pending_ = []
+
+def _run(logFiles, ckPath, saved, crashAt=None):
+    sink = _Sink(saved, crashAt)
+    checkpoint = SftpLogCheckpoint(ckPath, sink.flush, 0)
+    SftpLogParser(logFiles, deltaMode=True).parse(
+        lambda *args: None, sink.process_session, checkpoint)
+    return sink.flush_cnt_
+
+# A run that crashes at any checkpoint, and is then run again, saves the
+# same sessions as one that doesn't
+def test_resumed_run_matches_clean_run(tmp_path, monkeypatch):
+    # Read a couple of lines at a time, so checkpoints fall within files
+    defaults = SftpLogReader.__init__.__defaults__
+    monkeypatch.setattr(SftpLogReader.__init__, "__defaults__",
+        (200,) + defaults[1:])
+
+    logFiles = [_writeLog(tmp_path / "sftp.log.1", ROTATED_LINES),
+                _writeLog(tmp_path / "sftp.log", CURRENT_LINES)]
+
+    expected = {}
+    flushCnt = _run(logFiles, str(tmp_path / "clean.json"), expected)
+    assert flushCnt > 4
+    assert len(expected) == 3
+
+    for crashAt in range(1, flushCnt + 1):
+        ckPath = str(tmp_path / "ck{0}.json".format(crashAt))
+        saved = {}
+        with pytest.raises(RuntimeError, match="crashed"):
+            _run(logFiles, ckPath, saved, crashAt)
+        _run(logFiles, ckPath, saved)
+
+        assert saved == expected, "crashed at flush {0}".format(crashAt)
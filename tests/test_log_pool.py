@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from sftp.sftp_log_parser import SftpLogParser
+from sftp.sftp_log_pool   import SftpLogParserPool
+from sftp.sftp_session    import SftpSession
+
+# Two sessions that span the rotation at ROTATE_AT, and one that doesn't
+LOG_LINES = [
+    'time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'time=2020-03-01 22:00:00.474 user=u2 pid=1002 sent status No such file',
+    'time=2020-03-01 22:00:01.100 user=u3 pid=1003 session opened for local user u3 from [192.168.1.20]',
+    'time=2020-03-01 22:00:01.611 user=u2 pid=1002 stat name "/home/u2"',
+    'time=2020-03-01 22:00:02.200 user=u3 pid=1003 rename old "/home/u3/a" new "/home/u3/b"',
+    'time=2020-03-01 22:00:02.300 user=u3 pid=1003 sent status Failure',
+    'time=2020-03-01 22:00:02.900 user=u2 pid=1002 opendir "/home/u2"',
+    'time=2020-03-01 22:00:03.000 user=u2 pid=1002 closedir "/home/u2"',
+    'time=2020-03-01 22:00:03.500 user=u4 pid=1004 session opened for local user u4 from [192.168.1.21]',
+    'time=2020-03-01 22:00:03.600 user=u4 pid=1004 session closed for local user u4 from [192.168.1.21]',
+    'time=2020-03-01 22:00:04.000 user=u2 pid=1002 session closed for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:05.000 user=u3 pid=1003 remove name "/home/u3/b"',
+    'time=2020-03-01 22:00:06.000 user=u3 pid=1003 session closed for local user u3 from [192.168.1.20]',
+]
+
+ROTATE_AT = 6
+
+def _logText(lines):
+    return "".join("Mar  1 22:00:00 host internal-sftp[1]: {0}\n".format(line)
+        for line in lines)
+
+# The log as one file, and as a rotated (compressed) file and the current
+# one, oldest first
+@pytest.fixture
+def logs(tmp_path):
+    whole = tmp_path / "whole.log"
+    whole.write_text(_logText(LOG_LINES))
+
+    rotated = tmp_path / "sftp.log.1.gz"
+    with gzip.open(rotated, "wt") as fhandle:
+        fhandle.write(_logText(LOG_LINES[:ROTATE_AT]))
+    current = tmp_path / "sftp.log"
+    current.write_text(_logText(LOG_LINES[ROTATE_AT:]))
+
+    return (str(whole), [str(rotated), str(current)],)
+
+# Run 'parse(accountCallback, sessionCallback)', returning the accounts, the
+# sessions merged from their updates and those that were made final
+def _collect(parse):
+    accounts = {}
+    sessions = {}
+    finals   = set()
+
+    def accountCallback(acctId, account, state):
+        accounts[acctId] = account
+
+    def sessionCallback(sessId, session, state):
+        if sessId in sessions:
+            SftpSession.mergeJSON(sessions[sessId], session)
+        else:
+            sessions[sessId] = json.loads(json.dumps(session))
+        if state == 'F':
+            finals.add(sessId)
+
+    parse(accountCallback, sessionCallback)
+    return (accounts, sessions, finals,)
+
+def _sequential(fName):
+    return _collect(SftpLogParser(fName, deltaMode=True).parse)
+
+def test_rotated_files_parse_as_one_log(logs):
+    whole, files = logs
+    expected = _sequential(whole)
+
+    accounts, sessions, finals = _sequential(files)
+    assert (accounts, sessions, finals) == expected
+    assert len(sessions) == 3
+    assert all(session["endTime"] > 0 for session in sessions.values())
+
+def test_pool_parses_rotated_files_as_one_log(logs):
+    whole, files = logs
+    expected = _sequential(whole)
+
+    pool = SftpLogParserPool(2, deltaMode=True)
+    assert _collect(lambda accountCallback, sessionCallback: pool.parse(
+        files, accountCallback, sessionCallback, chunkSize=200)) == expected
+
+# Sessions left open go idle for longer than IDLE_SECS, one of them
+# carrying on afterwards
+IDLE_LINES = LOG_LINES + [
+    'time=2020-03-01 22:00:07.000 user=u5 pid=1005 session opened for local user u5 from [192.168.1.22]',
+    'time=2020-03-01 22:00:07.500 user=u5 pid=1005 open "/home/u5/g" flags WRITE,CREATE,TRUNCATE mode 0644',
+    'time=2020-03-01 22:00:08.000 user=u6 pid=1006 session opened for local user u6 from [192.168.1.23]',
+    'time=2020-03-01 22:05:00.000 user=u7 pid=1007 session opened for local user u7 from [192.168.1.24]',
+    'time=2020-03-01 22:05:00.100 user=u5 pid=1005 close "/home/u5/g" bytes read 0 written 1024',
+    'time=2020-03-01 22:05:01.000 user=u7 pid=1007 session closed for local user u7 from [192.168.1.24]',
+    'time=2020-03-01 22:10:00.000 user=u5 pid=1005 session closed for local user u5 from [192.168.1.22]',
+]
+
+IDLE_SECS = 60
+
+@pytest.mark.parametrize("idleTimeout", [None, IDLE_SECS])
+@pytest.mark.parametrize("chunkSize", [150, 1000, SftpLogParserPool.CHUNK_SIZE])
+def test_chunked_parse_matches_sequential(tmp_path, idleTimeout, chunkSize):
+    logPath = str(tmp_path / "sftp.log")
+    with open(logPath, "w") as fhandle:
+        fhandle.write(_logText(IDLE_LINES))
+
+    expected = _collect(SftpLogParser(logPath, deltaMode=True,
+        idleTimeout=idleTimeout).parse)
+
+    parser = SftpLogParser(logPath, deltaMode=True, idleTimeout=idleTimeout)
+    pool = SftpLogParserPool(2, deltaMode=True, idleTimeout=idleTimeout)
+    assert _collect(lambda accountCallback, sessionCallback: pool.parseChunked(
+        parser, accountCallback, sessionCallback, chunkSize)) == expected
+    assert parser.line_cnt_ == len(IDLE_LINES)
@@ -0,0 +1,86 @@
+import re
+
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from sftp.sftp_log_tokenizer import SFTP_LINE_REGEX
+from sftp.sftp_log_tokenizer import SftpTimestampDecoder
+from sftp.sftp_log_tokenizer import tokenizeLine
+
+EPOCH = datetime(1970, 1, 1)
+
+LOG_LINES = [
+    'Mar  1 22:00:00 host internal-sftp[1]: time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'Mar  1 22:00:00 host internal-sftp[1]: time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'Mar  1 22:00:00 host internal-sftp[1]: time=2020-3-1 22:00:00.474 user=u2 pid=1002 sent status No such file',
+    'Mar  1 22:00:01 host internal-sftp[1]: time=2020-03-01 22:00:01.1 user=first.last pid=7 rename old "/a b" new "/c d"',
+    'Mar  1 22:00:01 host internal-sftp[1]: time=2020-03-01 22:00:01.100 user=u3 pid=1003 stat name "/time=x/user=y"\n',
+    # Not internal-sftp operations
+    'Mar  1 22:00:02 host sshd[1]: Accepted publickey for u3 from 192.168.1.20 port 22',
+    'Mar  1 22:00:02 host internal-sftp[1]: session opened for local user u3',
+    'Mar  1 22:00:02 host internal-sftp[1]: time=yesterday user=u3 pid=1003 stat name "/"',
+    'Mar  1 22:00:02 host internal-sftp[1]: time=2020-03-01 22:00:02.000 user=u3 pid=abc stat name "/"',
+    'Mar  1 22:00:02 host internal-sftp[1]: time=2020-03-01 22:00:02.000 user=u3 pid=1003',
+    '',
+]
+
+# The legacy regex, as the parser used it
+def _regexFields(line):
+    match = re.match(SFTP_LINE_REGEX, line.rstrip("\n"))
+    return match.groups() if match else None
+
+@pytest.mark.parametrize("line", LOG_LINES)
+def test_tokenize_matches_regex(line):
+    assert tokenizeLine(line) == _regexFields(line)
+
+# Where a field holds a delimiter, the first occurrence wins rather than
+# the last, as it would with the greedy regex
+def test_tokenize_splits_at_first_delimiter():
+    line = ('Mar  1 22:00:01 host internal-sftp[1]: time=2020-03-01 22:00:01.100 '
+            'user=u3 pid=1003 stat name "/x pid=9 y"')
+    assert tokenizeLine(line) == (
+        "2020-03-01 22:00:01.100", "u3", "1003", 'stat name "/x pid=9 y"')
+
+TIMESTAMPS = [
+    "2020-03-01 22:00:00.069",
+    "2020-03-01 22:00:00.5",
+    "2020-03-01 22:00:59.999999",
+    "2020-03-01 22:01:00.000001",
+    "2020-3-1 22:01:7.25",
+    "2020-12-31 23:59:59.999",
+    "2021-01-01 00:00:00.001",
+    "2020-02-29 12:34:56.789012",
+]
+
+@pytest.mark.parametrize("timestamp", TIMESTAMPS)
+def test_timestamp_decoder_matches_strptime(timestamp):
+    decoder = SftpTimestampDecoder(EPOCH)
+    expected = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+
+    assert decoder.decodeDateTime(timestamp) == expected
+    assert decoder.decode(timestamp) == (
+        (expected - EPOCH) // timedelta(milliseconds=1), expected.toordinal(),)
+
+# The cached prefix must not leak from one timestamp into the next
+def test_timestamp_decoder_in_sequence():
+    decoder = SftpTimestampDecoder(EPOCH)
+    for timestamp in TIMESTAMPS + list(reversed(TIMESTAMPS)):
+        assert decoder.decodeDateTime(timestamp) == datetime.strptime(
+            timestamp, "%Y-%m-%d %H:%M:%S.%f")
+
+@pytest.mark.parametrize("timestamp", [
+    "2020-03-01 22:00:05",
+    "2020-03-01 22:00:05.",
+    "2020-03-01 22:00:05.1234567",
+    "2020-03-01 22:00:+5.1",
+    "2020-03-01 22:00:60.0",
+    "2020-03-01 24:00:05.1",
+    "2020-02-30 22:00:05.1",
+])
+def test_timestamp_decoder_rejects_as_strptime(timestamp):
+    with pytest.raises(ValueError):
+        datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+    with pytest.raises(ValueError):
+        SftpTimestampDecoder(EPOCH).decode(timestamp)
@@ -0,0 +1,15 @@
+from sftp.sftp_log_writer import SftpLogFlushStats
+
+def test_flush_stats_stay_bounded():
+    stats = SftpLogFlushStats(latencyCnt=3)
+    assert stats.summary() == "0 flushes"
+
+    for flush in range(10):
+        stats.add(10, 2048, 0.5, (flush + 1) / 1000)
+
+    # Totals cover every flush; only the latest save times are kept
+    assert stats.flush_cnt_ == 10
+    assert stats.doc_cnt_ == 100
+    assert list(stats.latencies_) == [0.008, 0.009, 0.010]
+    assert stats.summary() == ("10 flushes; per flush 10 docs, 2 KB, "
+        "500 ms pending, 6 ms saving (max 10 ms)")
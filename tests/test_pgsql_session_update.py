@@ -0,0 +1,79 @@
+# Regression test for the session update in moonshyne_sftp.save_sessions()
+# and update_sessions(): a batch must touch only the rows of its own
+# sessions. Runs against a scratch database with the moonshyne schema
+# loaded, given by MOONSHYNE_PG_DSN, in a transaction that is rolled back;
+# skipped when there is none.
+
+import json
+import os
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+PG_DSN = os.environ.get("MOONSHYNE_PG_DSN", "dbname=postgres user=postgres")
+
+ACCOUNT_ID   = 990001
+SESSION_DATE = 2460000
+
+def _session(pid, endTime):
+    return {
+        "accountId": ACCOUNT_ID, "pid": pid, "sessionDate": SESSION_DATE,
+        "startTime": 1000, "endTime": endTime, "ipAddress": 169090561,
+        "commands": [],
+    }
+
+@pytest.fixture
+def pgsql_cmd():
+    try:
+        pgdb_server = psycopg2.connect(PG_DSN)
+    except psycopg2.Error as err:
+        pytest.skip("no PostgreSQL at '{0}': {1}".format(PG_DSN, err))
+
+    try:
+        cursor = pgdb_server.cursor()
+        cursor.execute("select to_regclass('moonshyne_sftp.sessions');")
+        if cursor.fetchone()[0] is None:
+            pytest.skip("moonshyne schema not loaded at '{0}'".format(PG_DSN))
+        yield cursor
+        cursor.close()
+    finally:
+        pgdb_server.rollback()
+        pgdb_server.close()
+
+def _call(pgsql_cmd, func, sessions):
+    pgsql_cmd.execute(
+        "select moonshyne_sftp.{0}(cast(%s as json));".format(func),
+        (json.dumps(sessions),))
+    return pgsql_cmd.fetchone()[0]
+
+# Row versions by pid; an updated row gets a new ctid
+def _versions(pgsql_cmd):
+    pgsql_cmd.execute(
+        "select session_pid, ctid::text, session_end "
+        "from moonshyne_sftp.sessions where account_id = %s;", (ACCOUNT_ID,))
+    return {pid: (ctid, end,) for pid, ctid, end in pgsql_cmd.fetchall()}
+
+@pytest.mark.parametrize("func", ["save_sessions", "update_sessions"])
+def test_session_update_touches_only_batch_rows(pgsql_cmd, func):
+    seeded = [_session(pid, 2000) for pid in (101, 102, 103)]
+    assert _call(pgsql_cmd, "save_sessions", seeded) == 3
+
+    before = _versions(pgsql_cmd)
+    assert len(before) == 3
+
+    assert _call(pgsql_cmd, func, [_session(102, 5000)]) == 1
+
+    after = _versions(pgsql_cmd)
+    assert after[102][1] == 5000
+    assert after[102][0] != before[102][0]
+    for pid in (101, 103):
+        assert after[pid] == before[pid]
+
+def test_save_sessions_counts_new_and_existing_rows(pgsql_cmd):
+    assert _call(pgsql_cmd, "save_sessions", [_session(201, 2000)]) == 1
+
+    batch = [_session(201, 3000), _session(202, 2000)]
+    assert _call(pgsql_cmd, "save_sessions", batch) == 2
+    assert _call(pgsql_cmd, "update_sessions", batch) == 2
+    assert _call(pgsql_cmd, "update_sessions", [_session(299, 2000)]) == 0
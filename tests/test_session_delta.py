@@ -0,0 +1,62 @@
+import copy
+import json
+
+from sftp.sftp_log_parser import SftpLogParser
+from sftp.sftp_session    import SftpSession
+
+# Status responses update commands already sent in an earlier delta
+LOG_LINES = [
+    'time=2020-03-01 22:00:00.069 user=u2 pid=1002 session opened for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:00.459 user=u2 pid=1002 open "/home/u2/f1" flags READ mode 0666',
+    'time=2020-03-01 22:00:00.474 user=u2 pid=1002 sent status No such file',
+    'time=2020-03-01 22:00:01.100 user=u3 pid=1003 session opened for local user u3 from [192.168.1.20]',
+    'time=2020-03-01 22:00:01.611 user=u2 pid=1002 opendir "/home/u2"',
+    'time=2020-03-01 22:00:02.200 user=u3 pid=1003 rename old "/home/u3/a" new "/home/u3/b"',
+    'time=2020-03-01 22:00:02.300 user=u3 pid=1003 sent status Failure',
+    'time=2020-03-01 22:00:02.900 user=u2 pid=1002 closedir "/home/u2"',
+    'time=2020-03-01 22:00:03.000 user=u2 pid=1002 session closed for local user u2 from [10.0.60.253]',
+    'time=2020-03-01 22:00:05.000 user=u3 pid=1003 remove name "/home/u3/b"',
+    'time=2020-03-01 22:00:05.100 user=u3 pid=1003 sent status Permission denied',
+]
+
+def _writeLog(path, lines):
+    with open(path, "w") as fhandle:
+        for line in lines:
+            fhandle.write("Mar  1 22:00:00 host internal-sftp[1]: {0}\n".format(line))
+
+# Return the session documents sent by a parse of 'fName', in order
+def _sessionDocs(fName, deltaMode):
+    docs = []
+    SftpLogParser(fName, deltaMode=deltaMode).parse(lambda *args: None,
+        lambda sessId, session, state: docs.append(
+            (sessId, json.loads(json.dumps(session)),)))
+    return docs
+
+def test_merged_deltas_equal_full_sessions(tmp_path):
+    logPath = str(tmp_path / "sftp.log")
+    _writeLog(logPath, LOG_LINES)
+
+    # Each full document supersedes the last
+    full = {}
+    for sessId, session in _sessionDocs(logPath, False):
+        full[sessId] = session
+
+    deltas = _sessionDocs(logPath, True)
+    merged = {}
+    for sessId, delta in deltas:
+        if sessId in merged:
+            SftpSession.mergeJSON(merged[sessId], delta)
+        else:
+            merged[sessId] = copy.deepcopy(delta)
+
+    assert merged == full
+    assert len(full) == 2
+
+    # Deltas only carry commands added or updated since the last one
+    assert sum(len(delta["commands"]) for sessId, delta in deltas) < sum(
+        len(session["commands"]) for sessId, session in _sessionDocs(logPath, False))
+
+    # Replaying the deltas (as on resuming from a checkpoint) changes nothing
+    for sessId, delta in deltas:
+        SftpSession.mergeJSON(merged[sessId], copy.deepcopy(delta))
+    assert merged == full